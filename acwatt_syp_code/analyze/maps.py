@@ -9,12 +9,13 @@ import matplotlib.pyplot as plt
 import geopandas as gpd
 import seaborn as sns
 from pathlib import Path
-from shapely.geometry import Point
 # Third-party Imports
 # Local Imports
 from ..utils.config import PATHS
+from ..utils.geo_cache import load_layer
 
 plt.style.use('ggplot')
+US_STATEFP = [f'{fips:02d}' for fips in range(1, 60)]
 
 
 def sensor_df_to_geo(df, area: str, by=None):
@@ -26,35 +27,31 @@ def sensor_df_to_geo(df, area: str, by=None):
     """
     area = area.lower()
     if area == 'world':
-        base_gdf = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+        base_gdf = load_layer('world')
     elif area in ['us', 'california']:
-        path_ = PATHS.data.gis / 'cb_2018_us_state_5m' / 'cb_2018_us_state_5m.shp'
-        base_gdf = gpd.read_file(path_)
         if area == 'us':
-            base_gdf = (base_gdf
-                .loc[base_gdf.STATEFP.astype(int) < 60]
-                # .loc[~base_gdf.NAME.isin(['Alaska', 'Hawaii'])]
-            )
+            # States, DC and territory FIPS codes are < 60
+            base_gdf = load_layer('states', statefp=US_STATEFP)
+            # base_gdf = base_gdf.loc[~base_gdf.NAME.isin(['Alaska', 'Hawaii'])]
         elif area == 'california':
             if by is None:
-                base_gdf = base_gdf.loc[base_gdf.NAME.isin(['California'])]
+                base_gdf = load_layer('states', statefp='06')
             elif by == 'county':
-                path_ = PATHS.data.gis / 'cb_2018_us_county_500k' / 'cb_2018_us_county_500k.shp'
-                base_gdf = gpd.read_file(path_)
-                base_gdf = base_gdf.loc[base_gdf.STATEFP.astype(int) == 6]
+                base_gdf = load_layer('counties', statefp='06')
     elif area == 'benton county':
-        path_ = PATHS.data.gis / 'cb_2018_us_county_500k' / 'cb_2018_us_county_500k.shp'
-        base_gdf = gpd.read_file(path_)
-        base_gdf = (base_gdf
-            .loc[base_gdf.STATEFP.astype(int) == 41]
-            .loc[base_gdf.NAME == 'Benton'])
+        base_gdf = load_layer('counties', statefp='41')
+        base_gdf = base_gdf.loc[base_gdf.NAME == 'Benton']
     else:
         print(f'area = {area}: Not a supported area parameter.')
         raise
 
-    sensor_points = [Point(xy) for xy in zip(df['lon'], df['lat'])]
+    # Only points in the area's bounding box can be in its polygons
+    xmin, ymin, xmax, ymax = base_gdf.total_bounds
+    df = df.loc[df['lon'].between(xmin, xmax) & df['lat'].between(ymin, ymax)]
+    sensor_points = gpd.points_from_xy(df['lon'], df['lat'])
     sensors_gdf = gpd.GeoDataFrame(df, crs=base_gdf.crs, geometry=sensor_points)
-    sensors_gdf = gpd.tools.sjoin(sensors_gdf, base_gdf, how='inner')
+    # sjoin queries the polygons' spatial index, which is kept with each cached layer
+    sensors_gdf = gpd.sjoin(sensors_gdf, base_gdf, how='inner')
     return sensors_gdf, base_gdf
 
 
@@ -10,7 +10,9 @@ Uses the AWS SDK for Python (Boto3) to create an AWS Lambda function from `lambd
 invoke it for a specific sensor ID, and delete it.
 """
 
+import base64
 import datetime as dt
+import hashlib
 import io
 import json
 import logging
@@ -30,11 +32,16 @@ from ratelimiter import RateLimiter
 
 # Local imports
 from ...utils.config import PATHS, AWS, PA
+from ...utils.timing import TIMER
+from .local_lambda import LocalLambdaClient, LOCAL_ROLE
 
 logger = logging.getLogger(__name__)
 WRITE_LOCK = threading.Lock()
 PRINT_LOCK = threading.Lock()
 LAMBDA_LOCK = threading.Lock()
+# Klayers packages for the lambda functions. boto3 is included because the runtime's
+# bundled boto3 can be older than the conditional puts s3_layout needs (Dec 2024).
+LAYER_PACKAGES = ['numpy', 'pandas', 'requests', 'boto3']
 
 
 def exponential_retry(func, error_code, *func_args, **func_kwargs):
@@ -66,23 +73,37 @@ def exponential_retry(func, error_code, *func_args, **func_kwargs):
     return func_return
 
 
-def create_lambda_deployment_package(function_file_name):
+def create_lambda_deployment_package(function_file_name,
+                                     module_file_names=('build/aws/s3_layout.py', 'utils/timing.py')):
     """
     Creates a Lambda deployment package in ZIP format in an in-memory buffer. This
     buffer can be passed directly to AWS Lambda when creating the function.
 
+    The zip is byte-for-byte the same for the same code (fixed timestamps and
+    permissions), so its hash tells whether the deployed code is up to date.
+
     @param function_file_name: The name of the file that contains the Lambda handler
                                function.
+    @param module_file_names: other modules the handler imports, relative to
+                              the package root; saved next to the handler
     @return: The deployment package.
     """
-    cwd = os.getcwd()
-    os.chdir(PATHS.code / 'build' / 'aws')
+    file_paths = [f'build/aws/{function_file_name}'] + list(module_file_names)
     buffer = io.BytesIO()
     with zipfile.ZipFile(buffer, 'w') as zipped:
-        zipped.write(function_file_name)
-    buffer.seek(0)
-    os.chdir(cwd)
-    return buffer.read()
+        for file_path in file_paths:
+            with open(PATHS.code / file_path, 'rb') as f:
+                code = f.read()
+            info = zipfile.ZipInfo(os.path.basename(file_path), date_time=(1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zipped.writestr(info, code)
+    return buffer.getvalue()
+
+
+def package_sha256(deployment_package):
+    """Return hash of deployment package in the format of Lambda's CodeSha256."""
+    return base64.b64encode(hashlib.sha256(deployment_package).digest()).decode()
 
 
 def get_package_arn(package_name):
@@ -204,6 +225,18 @@ def create_iam_role_for_lambda(iam_resource, iam_role_name, bucket_arn):
     return role
 
 
+def get_existing_role(iam_resource, iam_role_name):
+    """Return the IAM role if it already exists, else None."""
+    role = iam_resource.Role(iam_role_name)
+    try:
+        role.load()
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchEntity':
+            return None
+        raise
+    return role
+
+
 def deploy_lambda_function(aws_objects, function_name):
     """
     Deploys the AWS Lambda function.
@@ -298,7 +331,11 @@ def invoke_lambda_function(lambda_client, function_name, function_params):
             Payload=json.dumps(function_params).encode(),
         )
         with WRITE_LOCK:
-            logger.info(f"Invoked function {function_name} for {function_params['sensor_id']}.")
+            if 'work_units' in function_params:
+                logger.info(f"Invoked function {function_name} for "
+                            f"{len(function_params['work_units'])} work units.")
+            else:
+                logger.info(f"Invoked function {function_name} for {function_params['sensor_id']}.")
     except ClientError:
         with WRITE_LOCK:
             logger.exception("Couldn't invoke function %s.", function_name)
@@ -336,8 +373,54 @@ def create_function(lambda_function_name, aws_objects, concurrency=200):
     )
 
     # Add dependencies (package layers to make the code runable)
-    package_name_list = ['numpy', 'pandas', 'requests']
-    add_package_layers(lambda_function_name, lambda_client, package_name_list)
+    if aws_objects.get('local'):
+        return  # local handlers use this environment's packages
+    add_package_layers(lambda_function_name, lambda_client, LAYER_PACKAGES)
+
+
+def ensure_function(lambda_function_name, aws_objects, concurrency=200):
+    """Create the lambda function, or update only what differs from aws_objects.
+
+    The deployed code's CodeSha256 is compared to the deployment package, so an
+    unchanged function is reused without uploading code or waiting on AWS.
+
+    @return: 'created', 'updated' or 'unchanged'
+    """
+    lambda_client = aws_objects['lambda_client']
+    try:
+        config = lambda_client.get_function(FunctionName=lambda_function_name)['Configuration']
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        create_function(lambda_function_name, aws_objects, concurrency=concurrency)
+        return 'created'
+
+    status = 'unchanged'
+    package = aws_objects['deployment_package']
+    if package is not None and config.get('CodeSha256') != package_sha256(package):
+        logger.info(f"Updating code of lambda function {lambda_function_name}")
+        lambda_client.update_function_code(FunctionName=lambda_function_name,
+                                           ZipFile=package, Publish=True)
+        lambda_client.get_waiter('function_updated').wait(FunctionName=lambda_function_name)
+        status = 'updated'
+    if config.get('Handler') != aws_objects['lambda_handler_name']:
+        logger.info(f"Updating handler of lambda function {lambda_function_name}")
+        lambda_client.update_function_configuration(FunctionName=lambda_function_name,
+                                                    Handler=aws_objects['lambda_handler_name'])
+        lambda_client.get_waiter('function_updated').wait(FunctionName=lambda_function_name)
+        status = 'updated'
+
+    reserved = lambda_client.get_function_concurrency(FunctionName=lambda_function_name)
+    if reserved.get('ReservedConcurrentExecutions') != concurrency:
+        lambda_client.put_function_concurrency(FunctionName=lambda_function_name,
+                                               ReservedConcurrentExecutions=concurrency)
+    layer_arns = [layer['Arn'] for layer in config.get('Layers', [])]
+    if not aws_objects.get('local') and not all(any(f'-{package}:' in arn for arn in layer_arns)
+                                                for package in LAYER_PACKAGES):
+        add_package_layers(lambda_function_name, lambda_client, LAYER_PACKAGES)
+        status = 'updated'
+    logger.info(f"Lambda function {lambda_function_name} {status}.")
+    return status
 
 
 @RateLimiter(max_calls=1, period=0.2)
@@ -346,11 +429,12 @@ def run_function(lambda_function_name, aws_objects, lambda_params):
     time1 = dt.datetime.now()
     with PRINT_LOCK:
         print(f"Starting {lambda_params['sensor_id'] :07d} download")
-    with LAMBDA_LOCK:
+    with LAMBDA_LOCK, TIMER.span('invoke', sensor=lambda_params['sensor_id']):
         response = invoke_lambda_function(aws_objects['lambda_client'],
                                       lambda_function_name,
                                       lambda_params)
     result = json.load(response['Payload'])
+    TIMER.extend(result.get('timings', []), source='lambda')
     sensor_id = result['sensor_id']
     successful = result['successful']
     with PRINT_LOCK:
@@ -360,7 +444,62 @@ def run_function(lambda_function_name, aws_objects, lambda_params):
     return result
 
 
-def setup_aws_objects(function_filename, role_name):
+def run_batch_function(lambda_function_name, aws_objects, lambda_params):
+    """Invoke the batch handler on a list of work units and record the results.
+
+    @param lambda_params: parameters for lambda_timing_test_script.batch_handler,
+        including 'work_units'
+    @return: list of result dicts, one for each work unit
+    """
+    time1 = dt.datetime.now()
+    units = lambda_params['work_units']
+    with PRINT_LOCK:
+        print(f"Starting batch of {len(units)} work units "
+              f"({units[0]['sensor_id']:07d} to {units[-1]['sensor_id']:07d})")
+    with TIMER.span('invoke', units=len(units)):
+        response = invoke_lambda_function(aws_objects['lambda_client'],
+                                          lambda_function_name,
+                                          lambda_params)
+    payload = json.load(response['Payload'])
+    TIMER.extend(payload.get('timings', []), source='lambda')
+    if 'results' not in payload:
+        # Lambda errors (e.g. timeouts) come back as an error payload instead
+        logger.error(f"Batch failed: {payload}")
+        results = [{'sensor_id': u['sensor_id'], 'date_start': u.get('date_start'),
+                    'date_end': u.get('date_end'), 'status': 'failed',
+                    'error': str(payload.get('errorMessage', payload))} for u in units]
+    else:
+        results = payload['results']
+    time_taken = dt.datetime.now() - time1
+    with PRINT_LOCK:
+        statuses = pd.Series([r['status'] for r in results]).value_counts().to_dict()
+        print(f"Batch finished in {time_taken}: {statuses}")
+    save_work_unit_results(results)
+    return results
+
+
+def setup_aws_objects(function_filename, role_name, local: bool = False,
+                      local_concurrency: int = 4, local_latency: float = 0.0,
+                      reuse_role: bool = True):
+    """Return dict of AWS objects needed to create and invoke lambda functions.
+
+    @param reuse_role: use the IAM role if it already exists instead of
+        recreating it and waiting for it to propagate
+
+    @param local: run handlers in local processes (see local_lambda.py) instead
+        of on AWS Lambda; no deployment package or IAM role is created
+    @param local_concurrency: max # of local handlers running at the same time
+    @param local_latency: seconds added to each local invocation
+    """
+    if local:
+        print(f"Using local lambda executor with {local_concurrency} processes.")
+        return {'iam_resource': None,
+                'lambda_client': LocalLambdaClient(max_workers=local_concurrency,
+                                                   latency=local_latency),
+                'deployment_package': None,
+                'iam_role': LOCAL_ROLE,
+                'local': True}
+
     config = botocore_config.Config(
         read_timeout=900,
         connect_timeout=900,
@@ -384,8 +523,10 @@ def setup_aws_objects(function_filename, role_name):
     deployment_package = create_lambda_deployment_package(function_filename)
 
     # Create AWS IAM Role (permissions to be given to lambda function)
-    iam_role = create_iam_role_for_lambda(iam_resource, role_name, AWS.bucket_arn)
-    print('Sleeping for 10 to let the role propagate'); time.sleep(10);
+    iam_role = get_existing_role(iam_resource, role_name) if reuse_role else None
+    if iam_role is None:
+        iam_role = create_iam_role_for_lambda(iam_resource, role_name, AWS.bucket_arn)
+        print('Sleeping for 10 to let the role propagate'); time.sleep(10);
     aws_objects = {'iam_resource': iam_resource,
                    'lambda_client': lambda_client,
                    'deployment_package': deployment_package,
@@ -394,6 +535,12 @@ def setup_aws_objects(function_filename, role_name):
 
 
 def teardown_aws_objects(aws_objects, function_list):
+    if aws_objects.get('local'):
+        for function in function_list:
+            delete_lambda_function(aws_objects['lambda_client'], function)
+        aws_objects['lambda_client'].shutdown()
+        return
+
     # Delete all roles
     iam_role = aws_objects['iam_role']
     for policy in iam_role.attached_policies.all():
@@ -431,6 +578,15 @@ def save_success(sensor_id, time_taken):
         df.to_csv(filepath, index=False)
 
 
+def save_work_unit_results(results):
+    """Append batch work unit results to work_units_downloaded.csv."""
+    filepath = PATHS.data.purpleair / 'work_units_downloaded.csv'
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    df = pd.DataFrame(results).drop(columns=['successful', 'empty', 'failed'], errors='ignore')
+    with WRITE_LOCK:
+        df.to_csv(filepath, mode='a', index=False, header=not filepath.exists())
+
+
 def start_function(sensor_tuple, aws_objects):
     sensor_id, date_created, last_modified = sensor_tuple
     lambda_params = {'sensor_id': sensor_id,
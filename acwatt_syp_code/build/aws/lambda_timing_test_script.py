@@ -6,6 +6,8 @@
 PURPOSE:
 Writes IP address used during lambda function execution to S3 bucket CSV.
 """
+import gzip
+import io
 import logging
 import time
 import random
@@ -15,10 +17,16 @@ import datetime as dt
 import requests
 import os
 import threading
-from multiprocessing import Process, Pipe
+from multiprocessing.pool import ThreadPool
 
 import boto3
 from botocore.exceptions import ClientError
+try:  # imported as part of the package
+    from . import s3_layout
+    from ...utils.timing import TIMER
+except ImportError:  # on AWS Lambda, where s3_layout.py and timing.py are next to this file
+    import s3_layout
+    from timing import TIMER
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -93,12 +101,14 @@ def ts_request(channel_id, start_date, api_key,
     status_code = 300
     wait_time = 0.5
     while status_code >= 300 and wait_time < 1000:
-        response = requests.get(url, params=query_str)
+        with TIMER.span('thingspeak_request', channel=int(channel_id)):
+            response = requests.get(url, params=query_str)
         status_code = response.status_code
         m = f"Status code {status_code}, TS channel {channel_id}, {start_date.strftime('%Y-%m-%d')}. Waiting {wait_time}."
         if status_code >= 300:
             logger.info(m)
-        time.sleep(wait_time)
+        # The wait after a successful request keeps us under the rate limit
+        TIMER.sleep(wait_time, 'backoff' if status_code >= 300 else 'throttle')
         wait_time = wait_time*2
 
     if response.status_code >= 300:
@@ -110,15 +120,17 @@ def ts_request(channel_id, start_date, api_key,
 
 
 def dl_sensor_week(sensor_info: dict, date_start: dt.datetime, params: dict,
-                   connection, average: int = 60):
+                   connection=None, average: int = 60):
     """Download a week's (hourly) averages of data for sensor from all 4 channels.
 
     @param sensor_info: information about sensor
     @param date_start: date to start downloading from, with the 6 days following
-    @param timezone: string of a datetime timezone to use for correcting the time
-        of the datapoints being downloaded
-    @param connection:
+    @param params: dict with 'timezone', a string of a datetime timezone to use
+        for correcting the time of the datapoints being downloaded
+    @param connection: not used
     @param average: number of minutes to average over
+    @return: dataframe of the 4 channels' data, None if any channel has no data.
+        Raises ConnectionError if a channel can't be downloaded.
     """
     date_end = date_start + dt.timedelta(days=7)
     # with print_lock: print(date_start)
@@ -139,15 +151,17 @@ def dl_sensor_week(sensor_info: dict, date_start: dt.datetime, params: dict,
                     if df is False:
                         return
                     break
-                except ConnectionError or requests.exceptions.HTTPError:
+                except (ConnectionError, requests.exceptions.RequestException):
                     print(f'ts_request failed. Trying again. Previous errors = {errors}')
-                    time.sleep(0.2)
+                    TIMER.sleep(0.2, 'retry')
                     errors += 1
             if errors == 5:
-                print(f'Reached maximum tries for channel {channel}, type {type_}, date {date_start} - {date_end}.')
-                print('Skipping')
-                continue
-            if df is not None:
+                raise ConnectionError(f'Reached maximum tries for channel {channel}, '
+                                      f'type {type_}, date {date_start} - {date_end}.')
+            if df is None:
+                raise ConnectionError(f'ThingSpeak request failed for channel {channel}, '
+                                      f'type {type_}, date {date_start} - {date_end}.')
+            else:
                 if len(df) > 0:
                     df.insert(loc=1, column='sensor_id', value=sensor_info['sensor_index'])
                     df.insert(loc=2, column='channel', value=channel)
@@ -162,16 +176,204 @@ def dl_sensor_week(sensor_info: dict, date_start: dt.datetime, params: dict,
     if len(df_list) == 4:
         df2 = pd.concat(df_list, ignore_index=True)
         logger.info(f"{sensor_id:06d}: Finished {date_start.strftime('%Y-%m-%d')}")
-        filepath = f"/tmp/{sensor_id:07d}_{date_start.strftime('%Y-%m-%d')}.csv"
-        with WRITE_LOCK:
-            df2.to_csv(filepath, index=False)
-            # upload_file_(filepath, params['bucket_name'])
         return df2
     else:
         logger.info(f"{sensor_id:06d}: No data for {date_start.strftime('%Y-%m-%d')}")
         return None
 
 
+def iter_weeks(sensor_info: dict, week_starts, params: dict,
+               max_threads: int = 1, time_between_starts: float = 0.0):
+    """Download weeks of sensor data on a bounded thread pool, yielding them in order.
+
+    At most 2 * max_threads weeks are held in memory at a time.
+    @param week_starts: dates to start each week's download on
+    @param params: dict with 'timezone', see dl_sensor_week()
+    @param max_threads: # of weeks downloading at the same time
+    @param time_between_starts: min seconds between the start of each week's download
+    @return: generator of (start_date, dataframe or None, error message or None)
+    """
+    start_lock = threading.Lock()
+    next_start = [time.monotonic()]
+
+    def download(start_date):
+        if time_between_starts:
+            with start_lock:
+                wait = next_start[0] - time.monotonic()
+                next_start[0] = max(next_start[0], time.monotonic()) + time_between_starts
+            if wait > 0:
+                TIMER.sleep(wait, 'start_spacing')
+        try:
+            return start_date, dl_sensor_week(sensor_info, start_date, params), None
+        except Exception as e:
+            logger.exception(f"{sensor_info['sensor_index']}: {start_date.strftime('%Y-%m-%d')} failed")
+            return start_date, None, repr(e)
+
+    week_starts = list(week_starts)
+    step = 2 * max_threads
+    pool = ThreadPool(processes=max_threads)
+    try:
+        for i in range(0, len(week_starts), step):
+            yield from pool.map(download, week_starts[i:i + step])
+    finally:
+        pool.close()
+        pool.join()
+
+
+class S3MultipartWriter:
+    """Gzipped CSV uploaded to S3 in parts while it is being written.
+
+    Only the current part (part_size bytes, compressed) is held in memory. If
+    an error happens inside the with block, the upload is aborted and nothing
+    is saved to S3. Nothing is saved if no rows were written.
+    :param bucket: bucket to upload to
+    :param object_name: S3 object name, e.g. '0000123.csv.gz'
+    :param part_size: bytes per part; S3 requires at least 5 MB for all but the last
+    """
+    def __init__(self, bucket, object_name, part_size=5 * 1024 ** 2):
+        self.s3_client = boto3.client('s3')
+        self.bucket = bucket
+        self.object_name = object_name
+        self.part_size = part_size
+        self.buffer = io.BytesIO()
+        self.gzip = gzip.GzipFile(fileobj=self.buffer, mode='wb')
+        self.upload_id = None
+        self.parts = []
+        self.columns = None
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write_df(self, df):
+        """Append dataframe rows; columns are matched to the first dataframe written."""
+        if self.columns is None:
+            self.columns = df.columns
+            header = True
+        else:
+            df = df.reindex(columns=self.columns)
+            header = False
+        self.gzip.write(df.to_csv(index=False, header=header).encode())
+        self.rows += len(df)
+        if self.buffer.tell() >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        with TIMER.span('s3_upload', part=len(self.parts) + 1):
+            self._upload_part_()
+
+    def _upload_part_(self):
+        if self.upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.object_name)
+            self.upload_id = response['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.object_name,
+                                              UploadId=self.upload_id, PartNumber=part_number,
+                                              Body=self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        """Finish the upload. Return True if an object was saved to S3."""
+        self.gzip.close()
+        if self.rows == 0:
+            self.abort()
+            return False
+        if self.upload_id is None:  # small enough for a single request
+            with TIMER.span('s3_upload', part=1):
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.object_name,
+                                          Body=self.buffer.getvalue())
+            return True
+        self._upload_part()
+        with TIMER.span('s3_upload', part='complete'):
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                     UploadId=self.upload_id,
+                                                     MultipartUpload={'Parts': self.parts})
+        return True
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                  UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def stream_weeks_to_s3(sensor_info: dict, week_starts, params: dict, bucket, object_name,
+                       max_threads: int = 1, time_between_starts: float = 0.0):
+    """Download weeks of sensor data and stream them, wide, to a gzipped CSV on S3.
+
+    See iter_weeks() for the parameters.
+    @return: True if an object was saved, and dict of lists of weeks that were
+        successful, empty (no data) and failed (errors)
+    """
+    weeks = {'successful': [], 'empty': [], 'failed': []}
+    last_created = None
+    with S3MultipartWriter(bucket, object_name) as writer:
+        for start_date, df, error in iter_weeks(sensor_info, week_starts, params,
+                                                max_threads, time_between_starts):
+            week = start_date.strftime('%Y-%m-%d')
+            if error is not None:
+                weeks['failed'].append(week)
+            elif df is None:
+                weeks['empty'].append(week)
+            else:
+                weeks['successful'].append(week)
+                df = make_wide(df)
+                # Consecutive weeks can both include the hour they meet at
+                if last_created is not None:
+                    df = df[df[('created_at', '')] > last_created]
+                if len(df) > 0:
+                    last_created = df[('created_at', '')].max()
+                    writer.write_df(df)
+    return writer.rows > 0, weeks
+
+
+def write_partitioned(sensor_info: dict, week_starts, params: dict, bucket,
+                      max_threads: int = 1, time_between_starts: float = 0.0):
+    """Download weeks of sensor data and save them, wide, to the sensor's weekly S3 partitions.
+
+    See iter_weeks() for the parameters and s3_layout for the layout. Each
+    downloaded week only writes rows before the next week's start, so work
+    units that start on Sundays never write to the same partition.
+    @return: True if any partition was saved, and dict of lists of weeks that
+        were successful, empty (no data) and failed (errors)
+    """
+    s3_client = boto3.client('s3')
+    sensor_id = int(sensor_info['sensor_index'])
+    weeks = {'successful': [], 'empty': [], 'failed': []}
+    entries = {}
+    try:
+        for start_date, df, error in iter_weeks(sensor_info, week_starts, params,
+                                                max_threads, time_between_starts):
+            week = start_date.strftime('%Y-%m-%d')
+            if error is not None:
+                weeks['failed'].append(week)
+            elif df is None:
+                weeks['empty'].append(week)
+            else:
+                weeks['successful'].append(week)
+                df = make_wide(df)
+                # The hour the next week starts at is downloaded (and saved) with that week
+                next_week = (start_date + dt.timedelta(days=7)).strftime('%Y-%m-%d')
+                df = df[df[s3_layout.CREATED].str[:10] < next_week]
+                with TIMER.span('s3_upload', week=week):
+                    for entry in s3_layout.write_wide(s3_client, bucket, sensor_id, df):
+                        entries[entry['key']] = entry
+    finally:
+        # List what was saved even if a later week failed
+        if entries:
+            with TIMER.span('s3_upload', week='manifest'):
+                s3_layout.write_manifest(s3_client, bucket, sensor_id, list(entries.values()))
+    return len(entries) > 0, weeks
+
+
 def generate_weeks_list(sensor_info_dict: dict):
     """Return list of dates to iterate through for sensor downloading.
 
@@ -196,7 +398,8 @@ def pa_request_single_sensor(sensor_id, pa_api_key):
              'pm2.5, primary_id_a, primary_key_a, secondary_id_a, secondary_key_a, ' \
              'primary_id_b, primary_key_b, secondary_id_b, secondary_key_b'
     query = {'api_key': pa_api_key, 'fields': fields.replace(' ', '')}
-    response = requests.get(url, params=query)
+    with TIMER.span('metadata', sensor=int(sensor_id)):
+        response = requests.get(url, params=query)
     return response.json()
 
 
@@ -222,8 +425,137 @@ def upload_file_(file_path, bucket, object_name=None):
     return response
 
 
+def make_wide(df):
+    """Return sensor data with primary and secondary subchannels side by side, sorted by time."""
+    with TIMER.span('concat'):
+        df = df.sort_values(by=['created_at', 'sensor_id', 'channel', 'subchannel_type'])
+        # Make wide (combine primary and secondary data from each channel)
+        df = df.pivot_table(index=['created_at', 'channel', 'sensor_id'], columns='subchannel_type').reset_index()
+        # Drop empty rows
+        df = df.dropna(subset=[('PM2.5 (CF=1)', 'primary'), ('2.5um', 'secondary')])
+    return df
+
+
+def work_unit_weeks(unit: dict, sensor_info: dict):
+    """Return week start dates for a work unit, the sensor's full history if it has no dates.
+
+    Weeks start on Sunday, like the S3 partitions, so each week is saved to
+    exactly one partition.
+    """
+    if unit.get('date_start') is None:
+        return generate_weeks_list(sensor_info)
+    date_start = s3_layout.sunday_of(unit['date_start'])
+    date_end = unit.get('date_end') or dt.datetime.today().strftime('%Y-%m-%d')
+    week_starts = pd.date_range(date_start, date_end, freq='7D')
+    return week_starts[week_starts < pd.Timestamp(date_end)]
+
+
+def work_unit_key(unit: dict):
+    """S3 object name for a work unit; full histories are saved as {sensor_id}.csv.gz."""
+    sensor_id = int(unit['sensor_id'])
+    if unit.get('date_start') is None:
+        return f'{sensor_id:07d}.csv.gz'
+    return f"{sensor_id:07d}_{unit['date_start']}_{unit.get('date_end') or 'now'}.csv.gz"
+
+
+def run_work_unit(unit: dict, p: dict, get_sensor_info):
+    """Download all weeks of one (sensor, week-range) work unit and upload them to S3."""
+    sensor_id = int(unit['sensor_id'])
+    result = {'sensor_id': sensor_id,
+              'date_start': unit.get('date_start'),
+              'date_end': unit.get('date_end'),
+              'status': 'failed',
+              'successful': [],
+              'empty': [],
+              'failed': []}
+    time1 = time.perf_counter()
+    try:
+        sensor_info = get_sensor_info(sensor_id)
+        week_params = {'timezone': unit['timezone']}
+        if p.get('layout', 'partitioned') == 'partitioned':
+            key = s3_layout.manifest_key(sensor_id)
+            uploaded, weeks = write_partitioned(sensor_info, work_unit_weeks(unit, sensor_info),
+                                                week_params, p['bucket_name'])
+        else:
+            key = work_unit_key(unit)
+            uploaded, weeks = stream_weeks_to_s3(sensor_info, work_unit_weeks(unit, sensor_info),
+                                                 week_params, p['bucket_name'], key)
+        result.update(weeks)
+        if uploaded:
+            # Units with failed weeks are uploaded but reported as partial, to be retried
+            status = 'partial' if weeks['failed'] else 'uploaded'
+            result.update({'status': status, 'key': key})
+        elif not weeks['failed']:
+            result['status'] = 'empty'
+    except Exception as e:
+        logger.exception(f"{sensor_id}: work unit failed")
+        result['error'] = repr(e)
+    result['seconds'] = round(time.perf_counter() - time1, 2)
+    return result
+
+
+def batch_handler(p, lambda_context):
+    """Download many (sensor, week-range) work units in one invocation.
+
+    Amortizes the cold start and per-invocation overhead over many sensors.
+    :param p: dict with keys
+        - work_units: list of dicts with sensor_id, timezone and optional
+          date_start / date_end ('YYYY-MM-DD'); without dates the sensor's
+          full history is downloaded
+        - max_threads: number of work units to run at the same time
+        - layout: 'partitioned' (default) to save weekly partitions and a
+          manifest (see s3_layout), or 'flat' for one object per work unit
+        - bucket_name, PA_api_key
+    :param lambda_context: not used, but required by Boto3-AWS-Lambda-client.invoke()
+    :return: dict with a result for each work unit, in the same order, and
+        the timed spans of the invocation (see utils/timing.py)
+    """
+    TIMER.reset()  # spans from an earlier invocation of a warm container
+    ip = get_ip()
+    units = p['work_units']
+    logger.info(f"Batch of {len(units)} work units ({ip}).")
+    # Sensor metadata is requested once per sensor, however many units it has
+    sensor_infos = {}
+    info_lock = threading.Lock()
+
+    def get_sensor_info(sensor_id):
+        with info_lock:
+            if sensor_id not in sensor_infos:
+                sensor_infos[sensor_id] = pa_request_single_sensor(sensor_id, p['PA_api_key'])['sensor']
+            return sensor_infos[sensor_id]
+
+    # A sensor's units run one after another, so they don't merge into its
+    # partitions and manifest at the same time
+    sensor_units = {}
+    for i, unit in enumerate(units):
+        sensor_units.setdefault(int(unit['sensor_id']), []).append(i)
+
+    def run_sensor_units(indexes):
+        return [(i, run_work_unit(units[i], p, get_sensor_info)) for i in indexes]
+
+    pool = ThreadPool(processes=p.get('max_threads', 4))
+    results = [None] * len(units)
+    for sensor_results in pool.map(run_sensor_units, list(sensor_units.values())):
+        for i, result in sensor_results:
+            results[i] = result
+    pool.close()
+    pool.join()
+    return {'results': results, 'ip': ip, 'timings': TIMER.reset()}
+
+
 def thread_test(p, lambda_context):
+    """Download a sensor's full history and upload it to S3.
+
+    Weeks are downloaded on a pool of p['max_threads'] threads, with at least
+    p['time_between_processes'] seconds between the start of each week's
+    download. With p['layout'] = 'partitioned' (default) they are saved to
+    weekly partitions (see s3_layout), with 'flat' they are streamed to
+    {sensor_id}.csv.gz as they finish.
+    :return: dict of the sensor's weeks that were successful, empty and failed,
+        and the timed spans of the invocation (see utils/timing.py)
+    """
     sensor_id = int(p['sensor_id'])
+    TIMER.reset()  # spans from an earlier invocation of a warm container
     ip = get_ip()
     logger.info(f"{sensor_id}: Full test of PA download, concatenation, S3 upload ({ip}).")
 
@@ -231,62 +563,20 @@ def thread_test(p, lambda_context):
     sensor_info = pa_request_single_sensor(sensor_id, p['PA_api_key'])['sensor']
     # Get list of dates
     week_starts = generate_weeks_list(sensor_info)
-    # Iterate through list of dates
-    processes = []
-    parent_connections = []
-    for start_date in week_starts:
-        # create a pipe for communication
-        parent_conn, child_conn = Pipe()
-        parent_connections.append(parent_conn)
-        # create the process, pass instance and connection
-        # process = Process(target=sleep_random, args=(start_date.date(), child_conn))
-        process = Process(target=dl_sensor_week, args=(sensor_info, start_date, p, child_conn))
-        processes.append(process)
-
-    # start all processes
-    i = 0
-    for process in processes:
-        process.start()
-        logger.info(f"{sensor_id:06d}: Starting the process for {week_starts[i].strftime('%Y-%m-%d')}")
-        time.sleep(p['time_between_processes'])
-        i += 1
-
-    # make sure that all processes have finished
-    for process in processes:
-        process.join()
-
-    df_list, successful = [], []
-    for file in os.listdir("/tmp"):
-        if file.endswith(".csv"):
-            filepath = os.path.join("/tmp", file)
-            df_list.append(pd.read_csv(filepath))
-            week = file.split('_')[1].split('.')[0]
-            successful.append(week)
-
-    # Concatenate all dataframes
-    df = pd.concat(df_list)
-    df = df.sort_values(by=['created_at', 'sensor_id', 'channel', 'subchannel_type'])
-
-    # Make wide (combine primary and secondary data from each channel)
-    df = df.pivot_table(index=['created_at', 'channel', 'sensor_id'], columns='subchannel_type').reset_index()
-    # Drop empty rows
-    df = df.dropna(subset=[('PM2.5 (CF=1)', 'primary'), ('2.5um', 'secondary')])
-
-    # Save dataframe to CSV
-    filepath = f'/tmp/{sensor_id:07d}.csv'
-    df.to_csv(filepath, index=False)
-
-    # Upload dataframe to S3 bucket
-    upload_file_(filepath, p['bucket_name'])
-
-    # Delete files
-    for file in os.listdir("/tmp"):
-        if file.endswith(".csv"):
-            filepath = os.path.join("/tmp", file)
-            os.remove(filepath)
-
-    return {'successful': successful,
+    # Download all weeks, make wide and upload to S3 bucket
+    threads = {'max_threads': p.get('max_threads', 8),
+               'time_between_starts': p.get('time_between_processes', 0)}
+    if p.get('layout', 'partitioned') == 'partitioned':
+        uploaded, weeks = write_partitioned(sensor_info, week_starts, p, p['bucket_name'], **threads)
+    else:
+        uploaded, weeks = stream_weeks_to_s3(sensor_info, week_starts, p,
+                                             p['bucket_name'], f'{sensor_id:07d}.csv.gz', **threads)
+
+    return {'successful': weeks['successful'],
+            'empty': weeks['empty'],
+            'failed': weeks['failed'],
             'sensor_id': sensor_id,
-            'ip': ip}
+            'ip': ip,
+            'timings': TIMER.reset()}
 
 
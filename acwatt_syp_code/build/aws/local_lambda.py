@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+PURPOSE:
+Run lambda handlers in local processes through the same client API as boto3's
+Lambda client, so the download orchestration in lambda_services can be run and
+timed without AWS (no IAM role, deployment package or propagation sleeps).
+
+The handlers still read and write whatever they normally would (e.g. the S3
+bucket), only the Lambda service is replaced.
+"""
+
+# Built-in Imports
+import importlib
+import io
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+# Third-party Imports
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+LOCAL_ROLE = SimpleNamespace(name='local-lambda-role', arn='arn:aws:iam::000000000000:role/local-lambda-role')
+
+
+def _run_handler(handler_name: str, payload: bytes, latency: float):
+    """Import and run module.function handler_name on the JSON payload (in a worker process)."""
+    time.sleep(latency)
+    module_name, function_name = handler_name.rsplit('.', 1)
+    try:
+        module = importlib.import_module(f'{__package__}.{module_name}')
+        result = getattr(module, function_name)(json.loads(payload), None)
+        return json.dumps(result).encode(), None
+    except Exception as e:
+        error = {'errorMessage': str(e),
+                 'errorType': type(e).__name__,
+                 'stackTrace': traceback.format_exc().splitlines()}
+        return json.dumps(error).encode(), 'Unhandled'
+
+
+def sleep_handler(params, lambda_context):
+    """Handler that only sleeps, for timing the orchestration without downloading.
+
+    Sleeps params['seconds'] (default 1) and returns results shaped like
+    thread_test or batch_handler, depending on the params.
+    """
+    time.sleep(params.get('seconds', 1))
+    if 'work_units' in params:
+        results = [{'sensor_id': u['sensor_id'], 'date_start': u.get('date_start'),
+                    'date_end': u.get('date_end'), 'status': 'empty',
+                    'successful': [], 'empty': [], 'failed': []} for u in params['work_units']]
+        return {'results': results, 'ip': 'local'}
+    return {'successful': [], 'empty': [], 'failed': [], 'sensor_id': params.get('sensor_id'), 'ip': 'local'}
+
+
+class _NoWaiter:
+    """Local functions are active as soon as they are created."""
+    def wait(self, **kwargs):
+        return None
+
+
+class LocalLambdaClient:
+    """Stand-in for boto3.client('lambda') that runs handlers in a local process pool.
+
+    Supports the calls made in lambda_services: create_function, get_function,
+    get_waiter, put/get_function_concurrency, update_function_configuration,
+    update_function_code, get_function_configuration, invoke and delete_function.
+
+    @param max_workers: number of handler processes that can run at once
+    @param latency: seconds each invocation waits before running the handler,
+        to mimic invocation overhead and cold starts
+    """
+    def __init__(self, max_workers: int = 4, latency: float = 0.0):
+        self.max_workers = max_workers
+        self.latency = latency
+        self.functions = {}
+        self._lock = threading.Lock()
+        # Spawned workers start clean: the orchestrator's threads hold locks (LAMBDA_LOCK,
+        # logging) and boto3 clients that a forked child would inherit
+        self._pool = ProcessPoolExecutor(max_workers=max_workers,
+                                         mp_context=multiprocessing.get_context('spawn'))
+
+    @staticmethod
+    def _error(code: str, operation: str, message: str):
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+    def _function(self, name: str, operation: str):
+        with self._lock:
+            if name not in self.functions:
+                raise self._error('ResourceNotFoundException', operation, f'Function not found: {name}')
+            return self.functions[name]
+
+    def create_function(self, FunctionName, Handler, **kwargs):
+        with self._lock:
+            if FunctionName in self.functions:
+                raise self._error('ResourceConflictException', 'CreateFunction',
+                                  f'Function already exist: {FunctionName}')
+            config = {'FunctionName': FunctionName,
+                      'FunctionArn': f'arn:aws:lambda:local:000000000000:function:{FunctionName}',
+                      'Handler': Handler,
+                      'State': 'Active',
+                      'LastUpdateStatus': 'Successful'}
+            config.update({k: v for k, v in kwargs.items() if k != 'Code'})
+            self.functions[FunctionName] = {'config': config,
+                                            'semaphore': threading.BoundedSemaphore(self.max_workers)}
+        logger.info(f"Created local function {FunctionName} ({Handler}).")
+        return dict(config)
+
+    def get_function(self, FunctionName):
+        return {'Configuration': dict(self._function(FunctionName, 'GetFunction')['config'])}
+
+    def get_function_configuration(self, FunctionName):
+        return dict(self._function(FunctionName, 'GetFunctionConfiguration')['config'])
+
+    def update_function_configuration(self, FunctionName, **kwargs):
+        function = self._function(FunctionName, 'UpdateFunctionConfiguration')
+        function['config'].update(kwargs)
+        return dict(function['config'])
+
+    def update_function_code(self, FunctionName, **kwargs):
+        """Handlers are imported from the source tree, so there is no code to update."""
+        return dict(self._function(FunctionName, 'UpdateFunctionCode')['config'])
+
+    def put_function_concurrency(self, FunctionName, ReservedConcurrentExecutions):
+        """Limit simultaneous invocations; can't exceed the process pool size."""
+        function = self._function(FunctionName, 'PutFunctionConcurrency')
+        function['semaphore'] = threading.BoundedSemaphore(min(ReservedConcurrentExecutions, self.max_workers))
+        function['concurrency'] = ReservedConcurrentExecutions
+        return {'ReservedConcurrentExecutions': ReservedConcurrentExecutions}
+
+    def get_function_concurrency(self, FunctionName):
+        function = self._function(FunctionName, 'GetFunctionConcurrency')
+        if 'concurrency' not in function:
+            return {}
+        return {'ReservedConcurrentExecutions': function['concurrency']}
+
+    def get_waiter(self, waiter_name):
+        return _NoWaiter()
+
+    def invoke(self, FunctionName, Payload=b'{}', **kwargs):
+        """Run the function's handler and wait for it, like a RequestResponse invocation."""
+        function = self._function(FunctionName, 'Invoke')
+        if isinstance(Payload, str):
+            Payload = Payload.encode()
+        with function['semaphore']:
+            future = self._pool.submit(_run_handler, function['config']['Handler'], Payload, self.latency)
+            result, function_error = future.result()
+        response = {'StatusCode': 200, 'ExecutedVersion': '$LATEST', 'Payload': io.BytesIO(result)}
+        if function_error is not None:
+            response['FunctionError'] = function_error
+        return response
+
+    def delete_function(self, FunctionName):
+        self._function(FunctionName, 'DeleteFunction')
+        with self._lock:
+            del self.functions[FunctionName]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
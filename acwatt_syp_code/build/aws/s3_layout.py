@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+PURPOSE:
+Partitioned layout of PurpleAir sensor data in the S3 bucket.
+
+Each sensor's data is split into one gzipped wide CSV per week (weeks start on
+Sunday, local time), with a manifest listing every partition's row count,
+time range and checksum:
+
+    sensors/0001234/manifest.json
+    sensors/0001234/year=2021/week=2021-01-03.csv.gz
+    sensors/0001234/year=2021/week=2021-01-10.csv.gz
+
+Readers use the manifest to fetch only the weeks they need. Partitions and
+manifests are updated with conditional puts (If-Match on the etag that was
+read, If-None-Match for new objects), retried on conflict, so workers writing
+the same sensor at the same time merge their rows instead of overwriting them.
+IfMatch / IfNoneMatch on put_object need a boto3/botocore release from
+December 2024 or later (older clients reject the parameters), so the lambda
+functions get boto3 from a layer instead of the runtime's bundled copy (see
+lambda_services.LAYER_PACKAGES).
+
+This module is shipped in the lambda deployment package next to
+lambda_timing_test_script.py, so it must only import what the lambda layers
+provide (pandas, numpy, requests, boto3).
+"""
+
+# Built-in Imports
+import datetime as dt
+import gzip
+import hashlib
+import io
+import functools
+import json
+import logging
+
+# Third-party Imports
+import pandas as pd
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+SENSOR_PREFIX = 'sensors'
+CREATED = ('created_at', '')
+CHANNEL = ('channel', '')
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')
+MAX_WRITE_ATTEMPTS = 10
+
+
+def sensor_prefix(sensor_id: int):
+    return f'{SENSOR_PREFIX}/{int(sensor_id):07d}/'
+
+
+def manifest_key(sensor_id: int):
+    return f'{sensor_prefix(sensor_id)}manifest.json'
+
+
+def partition_key(sensor_id: int, week: str):
+    """Return key of the partition for the week starting on date string week ('YYYY-MM-DD')."""
+    return f'{sensor_prefix(sensor_id)}year={week[:4]}/week={week}.csv.gz'
+
+
+def week_of(created_at: pd.Series):
+    """Return the (local) Sunday starting the week of each created_at, as 'YYYY-MM-DD'."""
+    local_date = pd.to_datetime(created_at.str[:10])
+    return (local_date - pd.to_timedelta((local_date.dt.dayofweek + 1) % 7, unit='D')).dt.strftime('%Y-%m-%d')
+
+
+def sunday_of(date):
+    """Return the Sunday starting the week of date, as a Timestamp."""
+    date = pd.Timestamp(date).normalize()
+    return date - pd.Timedelta(days=(date.dayofweek + 1) % 7)
+
+
+def gzip_bytes(data: bytes):
+    """Return gzipped data, the same bytes for the same data (no timestamp)."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def read_wide_csv(buffer, compression=None):
+    """Read a wide sensor CSV (two header rows, field and subchannel_type)."""
+    df = pd.read_csv(buffer, header=[0, 1], compression=compression)
+    # Index columns have no subchannel; pandas reads those as "Unnamed: ..."
+    df.columns = pd.MultiIndex.from_tuples(
+        [(a, '' if b.startswith('Unnamed:') else b) for a, b in df.columns])
+    return df
+
+
+def read_object(s3_client, bucket, key):
+    """Return (body, etag) of object, (None, None) if it doesn't exist."""
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None, None
+        raise
+    return obj['Body'].read(), obj['ETag']
+
+
+@functools.lru_cache(maxsize=None)
+def _supports_conditional_put(service_model):
+    members = service_model.operation_model('PutObject').input_shape.members
+    return 'IfMatch' in members and 'IfNoneMatch' in members
+
+
+def check_conditional_put(s3_client):
+    """Raise RuntimeError if the S3 client's botocore can't send conditional puts."""
+    meta = getattr(s3_client, 'meta', None)
+    if meta is None:
+        return  # not a botocore client (e.g. fake_api.LocalS3Client)
+    if not _supports_conditional_put(meta.service_model):
+        import botocore
+        raise RuntimeError(f"botocore {botocore.__version__} has no IfMatch/IfNoneMatch for put_object, "
+                           f"which s3_layout needs to merge concurrent writes. Use a boto3/botocore "
+                           f"release from December 2024 or later.")
+
+
+def put_if_unchanged(s3_client, bucket, key, body: bytes, etag: str = None, **kwargs):
+    """Save object only if it still has etag (still doesn't exist if etag is None).
+
+    @return: True if saved, False if another writer changed the object first
+    """
+    check_conditional_put(s3_client)
+    condition = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+    try:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body, **condition, **kwargs)
+    except ClientError as error:
+        if error.response['Error']['Code'] in CONFLICT_CODES:
+            return False
+        raise
+    return True
+
+
+def read_manifest(s3_client, bucket, sensor_id: int):
+    """Return the sensor's manifest dict, None if the sensor has no partitions."""
+    body, _ = read_object(s3_client, bucket, manifest_key(sensor_id))
+    return json.loads(body) if body is not None else None
+
+
+def write_manifest(s3_client, bucket, sensor_id: int, partitions, replace: bool = False):
+    """Add or replace partition entries in the sensor's manifest.
+
+    The manifest is read right before writing and only saved if no other worker
+    changed it in the meantime; otherwise the entries are merged again. An
+    entry with fewer rows than the one listed is from an older version of the
+    partition (written before another worker merged into it) and is ignored.
+    @param replace: drop the entries already in the manifest (see rebuild_manifest())
+    @return: the manifest, None if there are no partitions
+    """
+    if not partitions:
+        return read_manifest(s3_client, bucket, sensor_id)
+    key = manifest_key(sensor_id)
+    for _ in range(MAX_WRITE_ATTEMPTS):
+        body, etag = read_object(s3_client, bucket, key)
+        manifest = {'sensor_id': int(sensor_id), 'partitions': []}
+        if body is not None and not replace:
+            manifest = json.loads(body)
+        entries = {p['key']: p for p in manifest['partitions']}
+        for p in partitions:
+            # Partitions only gain rows, so a smaller entry is from an older version
+            if p['key'] not in entries or p['rows'] >= entries[p['key']]['rows']:
+                entries[p['key']] = p
+        manifest['partitions'] = sorted(entries.values(), key=lambda p: p['week'])
+        manifest['rows'] = sum(p['rows'] for p in manifest['partitions'])
+        manifest['first'] = manifest['partitions'][0]['first']
+        manifest['last'] = max(p['last'] for p in manifest['partitions'])
+        manifest['updated'] = dt.datetime.utcnow().isoformat()
+        if put_if_unchanged(s3_client, bucket, key, json.dumps(manifest, indent=1).encode(), etag,
+                            ContentType='application/json'):
+            return manifest
+    raise RuntimeError(f'{key} kept changing, gave up after {MAX_WRITE_ATTEMPTS} attempts')
+
+
+def read_partition(s3_client, bucket, key):
+    obj = s3_client.get_object(Bucket=bucket, Key=key)
+    return read_wide_csv(io.BytesIO(obj['Body'].read()), compression='gzip')
+
+
+def write_week(s3_client, bucket, key: str, week: str, df_week):
+    """Merge rows of one week into its partition and save it; return the manifest entry."""
+    for _ in range(MAX_WRITE_ATTEMPTS):
+        saved, etag = read_object(s3_client, bucket, key)
+        df = df_week
+        if saved is not None:
+            df = pd.concat([read_wide_csv(io.BytesIO(saved), compression='gzip'), df], ignore_index=True)
+        df = (df
+              .drop_duplicates([CREATED, CHANNEL], keep='last')
+              .sort_values(by=[CREATED, CHANNEL]))
+        body = gzip_bytes(df.to_csv(index=False).encode())
+        entry = {'key': key,
+                 'week': week,
+                 'rows': int(len(df)),
+                 'first': str(df[CREATED].iloc[0]),
+                 'last': str(df[CREATED].iloc[-1]),
+                 'md5': hashlib.md5(body).hexdigest()}
+        # Metadata lets rebuild_manifest() recover entries without reading the data
+        if put_if_unchanged(s3_client, bucket, key, body, etag,
+                            Metadata={k: str(entry[k]) for k in ['week', 'rows', 'first', 'last', 'md5']}):
+            return entry
+    raise RuntimeError(f'{key} kept changing, gave up after {MAX_WRITE_ATTEMPTS} attempts')
+
+
+def write_wide(s3_client, bucket, sensor_id: int, df):
+    """Save wide sensor data to its weekly partitions, merging with rows already saved.
+
+    Each partition is read right before it is written, so rows saved by other
+    workers (or earlier in the same run) are kept.
+    @param df: wide sensor data (see make_wide()), any number of weeks
+    @return: list of manifest entries for the partitions written
+    """
+    return [write_week(s3_client, bucket, partition_key(sensor_id, week), week, df_week)
+            for week, df_week in df.groupby(week_of(df[CREATED]))]
+
+
+def plan_fetch(manifest, date_start: str = None, date_end: str = None):
+    """Return keys of partitions with data between local dates date_start and date_end ('YYYY-MM-DD')."""
+    keys = []
+    for p in manifest['partitions']:
+        if date_start is not None and p['last'][:10] < date_start:
+            continue
+        if date_end is not None and p['first'][:10] > date_end:
+            continue
+        keys.append(p['key'])
+    return keys
+
+
+def read_sensor(s3_client, bucket, sensor_id: int, date_start: str = None, date_end: str = None):
+    """Return wide data for sensor between local dates, from its partitions.
+
+    @return: dataframe, or None if the sensor has no manifest or no data in the range
+    """
+    manifest = read_manifest(s3_client, bucket, sensor_id)
+    if manifest is None:
+        return None
+    keys = plan_fetch(manifest, date_start, date_end)
+    if not keys:
+        return None
+    df = pd.concat([read_partition(s3_client, bucket, key) for key in keys], ignore_index=True)
+    created_date = df[CREATED].str[:10]
+    keep = pd.Series(True, index=df.index)
+    if date_start is not None:
+        keep &= created_date >= date_start
+    if date_end is not None:
+        keep &= created_date <= date_end
+    df = df[keep]
+    return df.drop_duplicates([CREATED, CHANNEL], keep='last').reset_index(drop=True)
+
+
+def rebuild_manifest(s3_client, bucket, sensor_id: int):
+    """Rewrite the sensor's manifest from the partitions in the bucket.
+
+    For partitions saved by a worker that stopped before updating the manifest.
+    """
+    entries = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=sensor_prefix(sensor_id)):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('.csv.gz'):
+                continue
+            metadata = s3_client.head_object(Bucket=bucket, Key=obj['Key'])['Metadata']
+            entries.append({'key': obj['Key'],
+                            'week': metadata['week'],
+                            'rows': int(metadata['rows']),
+                            'first': metadata['first'],
+                            'last': metadata['last'],
+                            'md5': metadata['md5']})
+    if not entries:
+        return None
+    return write_manifest(s3_client, bucket, sensor_id, entries, replace=True)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+PURPOSE:
+Durable queues of download jobs (e.g. one sensor-week each), so the state of a
+download run survives the orchestrator crashing, and any number of workers can
+pull jobs at their own pace.
+
+Jobs follow SQS semantics: a received job is invisible to other workers for
+visibility_timeout seconds. If it isn't completed in that time (worker died),
+it becomes visible again. Jobs that fail max_attempts times are dead-lettered.
+Enqueueing and completing are idempotent. Workers don't treat a queue with
+hidden (in-flight) jobs as empty, and a resumed SQLite queue can release the
+jobs a crashed run left hidden instead of waiting out their timeout.
+
+SQLiteWorkQueue keeps the queue in a local file; SQSWorkQueue has the same
+interface on AWS SQS.
+"""
+
+# Built-in Imports
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+from pathlib import Path
+
+# Third-party Imports
+import boto3
+
+# Local Imports
+from ...utils.config import PATHS, AWS
+
+logger = logging.getLogger(__name__)
+Job = namedtuple('Job', ['receipt', 'body', 'attempts'])
+
+
+def job_key(body: dict):
+    """Return id of a job, the same for the same sensor and dates."""
+    return f"{int(body['sensor_id']):07d}_{body.get('date_start')}_{body.get('date_end')}"
+
+
+class _Connection:
+    """Close the sqlite connection when leaving the with block."""
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        return self.con
+
+    def __exit__(self, *exc):
+        if self.con.in_transaction:
+            self.con.execute("ROLLBACK")
+        self.con.close()
+
+
+class SQLiteWorkQueue:
+    """Work queue in a local SQLite file.
+
+    @param path: SQLite file to keep the queue in
+    @param visibility_timeout: seconds a received job is hidden from other workers
+    @param max_attempts: times a job can be received before it is dead-lettered
+    """
+    def __init__(self, path: Path = None, visibility_timeout: float = 900, max_attempts: int = 3):
+        self.path = Path(path or PATHS.data.purpleair / 'work_queue.sqlite')
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                               job_id TEXT PRIMARY KEY,
+                               body TEXT NOT NULL,
+                               status TEXT NOT NULL DEFAULT 'queued',
+                               attempts INTEGER NOT NULL DEFAULT 0,
+                               visible_at REAL NOT NULL DEFAULT 0,
+                               receipt TEXT,
+                               error TEXT,
+                               updated REAL)""")
+            con.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, visible_at)")
+
+    def _connect(self):
+        # New connection per call, so the queue can be shared between threads
+        con = sqlite3.connect(str(self.path), timeout=60, isolation_level=None)
+        con.execute('PRAGMA journal_mode=WAL')
+        return _Connection(con)
+
+    def enqueue(self, bodies):
+        """Add jobs, ignoring any already in the queue. Return # of jobs added."""
+        rows = [(job_key(b), json.dumps(b), time.time()) for b in bodies]
+        with self._connect() as con:
+            before = con.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+            con.execute("BEGIN IMMEDIATE")
+            con.executemany("INSERT OR IGNORE INTO jobs (job_id, body, updated) VALUES (?, ?, ?)", rows)
+            con.execute("COMMIT")
+            after = con.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        return after - before
+
+    def receive(self, max_jobs: int = 1):
+        """Return up to max_jobs visible jobs, hiding them for visibility_timeout seconds."""
+        now = time.time()
+        with self._connect() as con:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute("""UPDATE jobs SET status = 'dead', updated = ?
+                           WHERE status = 'queued' AND visible_at <= ? AND attempts >= ?""",
+                        (now, now, self.max_attempts))
+            rows = con.execute("""SELECT job_id, body, attempts FROM jobs
+                                  WHERE status = 'queued' AND visible_at <= ?
+                                  ORDER BY visible_at LIMIT ?""", (now, max_jobs)).fetchall()
+            jobs = []
+            for job_id, body, attempts in rows:
+                receipt = f'{job_id}|{uuid.uuid4().hex}'
+                con.execute("""UPDATE jobs SET attempts = ?, visible_at = ?, receipt = ?, updated = ?
+                               WHERE job_id = ?""",
+                            (attempts + 1, now + self.visibility_timeout, receipt, now, job_id))
+                jobs.append(Job(receipt, json.loads(body), attempts + 1))
+            con.execute("COMMIT")
+        return jobs
+
+    def complete(self, receipt: str):
+        """Mark job done. Completing a job again (e.g. after redelivery) does nothing."""
+        job_id = receipt.split('|')[0]
+        with self._connect() as con:
+            con.execute("UPDATE jobs SET status = 'done', updated = ? WHERE job_id = ? AND status != 'done'",
+                        (time.time(), job_id))
+
+    def fail(self, receipt: str, error: str = None):
+        """Make job visible again for a retry, or dead-letter it if out of attempts."""
+        now = time.time()
+        with self._connect() as con:
+            # A stale receipt means the job was already received again; leave it be
+            con.execute("""UPDATE jobs
+                           SET status = CASE WHEN attempts >= ? THEN 'dead' ELSE 'queued' END,
+                               visible_at = ?, error = ?, updated = ?
+                           WHERE receipt = ? AND status = 'queued'""",
+                        (self.max_attempts, now, error, now, receipt))
+
+    def in_flight(self):
+        """Return # of queued jobs currently hidden by a worker's receive."""
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND visible_at > ?",
+                               (time.time(),)).fetchone()[0]
+
+    def release(self):
+        """Make all hidden jobs visible again, e.g. when resuming after the workers crashed.
+
+        Only call this when no other workers are using the queue. The receive of
+        a released job isn't counted against its attempts.
+        @return: # of jobs released
+        """
+        now = time.time()
+        with self._connect() as con:
+            cursor = con.execute("""UPDATE jobs SET visible_at = ?, receipt = NULL, attempts = MAX(attempts - 1, 0),
+                                        updated = ?
+                                    WHERE status = 'queued' AND visible_at > ?""", (now, now, now))
+            return cursor.rowcount
+
+    def counts(self):
+        """Return dict of # of jobs in each status (queued, done, dead)."""
+        with self._connect() as con:
+            return dict(con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def dead_letters(self):
+        """Return list of (job body, last error) for dead-lettered jobs."""
+        with self._connect() as con:
+            rows = con.execute("SELECT body, error FROM jobs WHERE status = 'dead'").fetchall()
+        return [(json.loads(body), error) for body, error in rows]
+
+    def requeue_dead(self):
+        """Give dead-lettered jobs a fresh set of attempts."""
+        with self._connect() as con:
+            con.execute("UPDATE jobs SET status = 'queued', attempts = 0, visible_at = 0 WHERE status = 'dead'")
+
+
+class SQSWorkQueue:
+    """Work queue on AWS SQS, with a dead-letter queue after max_attempts receives.
+
+    Uses FIFO queues, so enqueueing a job already sent in the last 5 minutes is
+    ignored by SQS's deduplication. Each job is its own message group so jobs
+    aren't held up behind each other.
+
+    @param name: name of the queue (without .fifo)
+    @param visibility_timeout: seconds a received job is hidden from other workers
+    @param max_attempts: times a job can be received before it is dead-lettered
+    """
+    def __init__(self, name: str = 'purpleair-download-jobs', visibility_timeout: int = 900,
+                 max_attempts: int = 3):
+        self.sqs = boto3.client('sqs', region_name=AWS.region,
+                                aws_access_key_id=AWS.access_key,
+                                aws_secret_access_key=AWS.secret_key)
+        self.max_attempts = max_attempts
+        dead_url = self.sqs.create_queue(QueueName=f'{name}-dead.fifo',
+                                         Attributes={'FifoQueue': 'true'})['QueueUrl']
+        dead_arn = self.sqs.get_queue_attributes(QueueUrl=dead_url, AttributeNames=['QueueArn'])
+        redrive = {'deadLetterTargetArn': dead_arn['Attributes']['QueueArn'],
+                   'maxReceiveCount': str(max_attempts)}
+        self.dead_url = dead_url
+        self.url = self.sqs.create_queue(QueueName=f'{name}.fifo',
+                                         Attributes={'FifoQueue': 'true',
+                                                     'VisibilityTimeout': str(int(visibility_timeout)),
+                                                     'RedrivePolicy': json.dumps(redrive)})['QueueUrl']
+
+    def enqueue(self, bodies, max_attempts: int = 3):
+        """Send jobs to the queue in batches of 10. Return # of jobs sent.
+
+        SQS only deduplicates for 5 minutes, so leave out jobs already done
+        before enqueueing again (see queue_sensor_weeks()). Entries SQS fails
+        to accept are sent again, up to max_attempts times.
+        """
+        bodies = list(bodies)
+        sent = 0
+        for i in range(0, len(bodies), 10):
+            entries = [{'Id': str(j),
+                        'MessageBody': json.dumps(b),
+                        'MessageGroupId': job_key(b),
+                        'MessageDeduplicationId': job_key(b)} for j, b in enumerate(bodies[i:i + 10])]
+            for attempt in range(max_attempts):
+                response = self.sqs.send_message_batch(QueueUrl=self.url, Entries=entries)
+                sent += len(response.get('Successful', []))
+                failed = {f['Id']: f for f in response.get('Failed', [])}
+                entries = [e for e in entries if e['Id'] in failed]
+                if not entries:
+                    break
+                logger.warning(f"SQS didn't accept {len(entries)} jobs (attempt {attempt + 1}): "
+                               f"{[f['Code'] for f in failed.values()]}")
+                time.sleep(2 ** attempt)
+            if entries:
+                raise RuntimeError(f"SQS didn't accept {len(entries)} jobs after {max_attempts} attempts: "
+                                   f"{[json.loads(e['MessageBody']) for e in entries]}")
+        return sent
+
+    def receive(self, max_jobs: int = 1):
+        response = self.sqs.receive_message(QueueUrl=self.url,
+                                            MaxNumberOfMessages=min(max_jobs, 10),
+                                            AttributeNames=['ApproximateReceiveCount'],
+                                            WaitTimeSeconds=1)
+        return [Job(m['ReceiptHandle'], json.loads(m['Body']),
+                    int(m['Attributes']['ApproximateReceiveCount']))
+                for m in response.get('Messages', [])]
+
+    def complete(self, receipt: str):
+        self.sqs.delete_message(QueueUrl=self.url, ReceiptHandle=receipt)
+
+    def fail(self, receipt: str, error: str = None):
+        """Make job visible again now; SQS moves it to the dead-letter queue after max_attempts."""
+        self.sqs.change_message_visibility(QueueUrl=self.url, ReceiptHandle=receipt,
+                                           VisibilityTimeout=0)
+
+    def in_flight(self):
+        """Return approximate # of received jobs still hidden from other workers."""
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.url, AttributeNames=['ApproximateNumberOfMessagesNotVisible'])['Attributes']
+        return int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
+    def counts(self):
+        def count(url):
+            attributes = self.sqs.get_queue_attributes(
+                QueueUrl=url, AttributeNames=['ApproximateNumberOfMessages',
+                                              'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+            return sum(int(v) for v in attributes.values())
+        return {'queued': count(self.url), 'dead': count(self.dead_url)}
+
+
+def run_worker(queue, handle_jobs, batch_size: int = 1, stop_when_empty: bool = True,
+               poll_interval: float = 5.0, stop_event: threading.Event = None):
+    """Receive jobs from queue and process them until the queue is empty.
+
+    @param queue: SQLiteWorkQueue or SQSWorkQueue
+    @param handle_jobs: function taking a list of job bodies and returning a
+        list of error messages, None for jobs that succeeded
+    @param batch_size: # of jobs to receive and handle at a time
+    @param stop_when_empty: return when no jobs are visible or in flight, else
+        keep polling. Jobs hidden by another (possibly dead) worker are waited
+        for, since they come back when their visibility timeout ends.
+    @param stop_event: return when this event is set
+    @return: dict of # of jobs completed and failed by this worker
+    """
+    done = failed = 0
+    while stop_event is None or not stop_event.is_set():
+        jobs = queue.receive(batch_size)
+        if not jobs:
+            if stop_when_empty and queue.in_flight() == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+        try:
+            errors = handle_jobs([job.body for job in jobs])
+        except Exception as e:
+            logger.exception(f"Worker failed on {len(jobs)} jobs")
+            errors = [repr(e)] * len(jobs)
+        for job, error in zip(jobs, errors):
+            if error is None:
+                queue.complete(job.receipt)
+                done += 1
+            else:
+                queue.fail(job.receipt, error)
+                failed += 1
+    return {'done': done, 'failed': failed}
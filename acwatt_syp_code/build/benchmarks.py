@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+PURPOSE:
+Benchmarks of the calculate_pm design value pipeline on synthetic data.
+
+Each stage (transform_pa_df, average_sensors, fill_in_missing_with_OLS,
+daily_data, annual_data) is run the way the pipeline runs it: per sensor for
+transform_pa_df, per site for the rest. Wall time and peak traced memory are
+recorded for each stage at each scale (# of EPA sites x # of PurpleAir
+sensors), and appended to output/benchmarks/calculate_pm.csv so runs can be
+compared over time. The stages run with PATHS pointed at a scratch directory
+(as in load_test), so the tables they write don't end up in the real output.
+
+With --imports, the time to import each module in a fresh interpreter is
+measured instead (appended to output/benchmarks/imports.csv), with the
+packages that take longest to import.
+
+Usage:
+    python -m acwatt_syp_code.build.benchmarks
+    python -m acwatt_syp_code.build.benchmarks --scales 1x5 5x50 --repeat 3 --label my-change
+    python -m acwatt_syp_code.build.benchmarks --imports --label before
+"""
+
+# Built-in Imports
+import argparse
+import datetime as dt
+import logging
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Third-party Imports
+import numpy as np
+import pandas as pd
+
+# Local Imports
+from . import calculate_pm
+from .load_test import use_root
+from ..utils import synthetic
+from ..utils.config import PATHS
+
+logger = logging.getLogger(__name__)
+IMPORT_MODULES = ['acwatt_syp_code.utils.config',
+                  'acwatt_syp_code.build.calculate_pm',
+                  'acwatt_syp_code.build.epa_download',
+                  'acwatt_syp_code.build.purpleair_download',
+                  'run']
+
+
+def measure(func, make_args, repeat: int = 1, memory: bool = True):
+    """Return (fastest wall seconds, peak traced MB, result) of func(*make_args()).
+
+    Arguments are made fresh for every run (outside the timing), since some
+    stages change their input in place. Memory is traced in an extra run so
+    tracing doesn't slow down the timed runs.
+    """
+    seconds = []
+    for _ in range(repeat):
+        args = make_args()
+        t0 = time.perf_counter()
+        result = func(*args)
+        seconds.append(time.perf_counter() - t0)
+    peak = np.nan
+    if memory:
+        args = make_args()
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return min(seconds), peak, result
+
+
+def benchmark_scale(n_sites: int, n_sensors: int, weeks: int = 4, years: int = 4,
+                    repeat: int = 1, memory: bool = True, seed: int = 0):
+    """Return dataframe of wall time and peak memory of each stage at one scale.
+
+    Seconds are summed over all calls of a stage (e.g. every sensor), peak
+    memory is the largest of any single call.
+    @param weeks: weeks of hourly data for each sensor
+    @param years: years of hourly EPA-PA data for each site
+    """
+    rng = np.random.default_rng(seed)
+    stats = {}
+
+    def add(stage, seconds, peak, rows):
+        s = stats.setdefault(stage, {'calls': 0, 'rows': 0, 'seconds': 0.0, 'peak_mb': 0.0})
+        s['calls'] += 1
+        s['rows'] += rows
+        s['seconds'] += seconds
+        s['peak_mb'] = np.nanmax([s['peak_mb'], peak])
+
+    times = synthetic.hourly_times('2021-01-03', weeks * 7 * 24)
+    sites = synthetic.make_sites(n_sites, n_sensors, rng)
+    for (county, site), sensor_list in sites.groupby(['county', 'site']):
+        logger.info(f"{n_sites}x{n_sensors}: site {county}-{site}, {len(sensor_list)} sensors")
+        # PurpleAir sensors -> hourly weighted average
+        ambient = synthetic.ambient_pm(times, rng)
+        df_list = []
+        for sensor_id, dist in zip(sensor_list['sensor_index'], sensor_list['dist_mile']):
+            df_wide = synthetic.wide_sensor_df(sensor_id, times, ambient, rng)
+            seconds, peak, df_pa = measure(calculate_pm.transform_pa_df, lambda: (df_wide.copy(),),
+                                           repeat, memory)
+            add('transform_pa_df', seconds, peak, len(df_wide))
+            df_pa['weight_raw'] = 1 / dist
+            df_list.append(df_pa)
+        df_pa = pd.concat(df_list, ignore_index=True)
+        seconds, peak, _ = measure(calculate_pm.average_sensors, lambda: (df_pa,), repeat, memory)
+        add('average_sensors', seconds, peak, len(df_pa))
+
+        # Combined EPA-PA data -> design values, as in create_site_dvs()
+        # (county 'synthetic' keeps the OLS tables apart from the real sites' tables)
+        site_dict = {'county': 'synthetic', 'site': f'{county}-{site}'}
+        df = synthetic.combined_df(county, site, rng, years=years)
+        df = calculate_pm.fill_in_missing_with_idw(df)
+        seconds, peak, df = measure(calculate_pm.fill_in_missing_with_OLS,
+                                    lambda: (df.copy(), site_dict), repeat, memory)
+        add('fill_in_missing_with_OLS', seconds, peak, len(df))
+        seconds, peak, df_daily = measure(calculate_pm.daily_data, lambda: (df,), repeat, memory)
+        add('daily_data', seconds, peak, len(df))
+        pm_types = [col[:-len('_valid_quarter')] for col in df_daily.columns if col.endswith('_valid_quarter')]
+        for pm_type in pm_types:
+            seconds, peak, _ = measure(calculate_pm.annual_data, lambda: (df_daily, pm_type), repeat, memory)
+            add('annual_data', seconds, peak, len(df_daily))
+
+    df_stats = pd.DataFrame.from_dict(stats, orient='index').rename_axis('function').reset_index()
+    df_stats.insert(0, 'n_sensors', n_sensors)
+    df_stats.insert(0, 'n_sites', n_sites)
+    return df_stats
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PATHS.root,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def import_time(module: str, repeat: int = 3, top: int = 8):
+    """Return seconds to import module in a fresh interpreter (fastest of repeat), and the slowest packages.
+
+    @param top: # of packages to list, by cumulative import time
+    @return: (seconds, list of (package, seconds) pairs)
+    """
+    code = f"import time; t0 = time.perf_counter(); import {module}; print(time.perf_counter() - t0)"
+    seconds = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-c', code], cwd=PATHS.root, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True, check=True)
+        seconds.append(float(result.stdout.strip().splitlines()[-1]))
+    # -X importtime lines: "import time: {self us} | {cumulative us} | {indented module name}"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=PATHS.root,
+                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    packages = {}
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if '.' not in name and name != module:
+            packages[name] = max(packages.get(name, 0), int(parts[1]) / 1e6)
+    return min(seconds), sorted(packages.items(), key=lambda x: -x[1])[:top]
+
+
+def run_import_benchmarks(modules=None, repeat: int = 3, label: str = ''):
+    """Time importing each module in a fresh interpreter and append results to csv.
+
+    Run before and after a change (with different labels) to compare startup costs.
+    @param modules: module names, default IMPORT_MODULES
+    @return: dataframe of this run's results
+    """
+    rows = []
+    for module in modules or IMPORT_MODULES:
+        seconds, packages = import_time(module, repeat)
+        logger.info(f"import {module}: {seconds:.2f} s")
+        rows.append({'module': module, 'seconds': seconds,
+                     'slowest_packages': ', '.join(f'{name} {t:.2f}' for name, t in packages)})
+    df = pd.DataFrame(rows)
+    df.insert(0, 'label', label)
+    df.insert(0, 'revision', git_revision())
+    df.insert(0, 'run_at', dt.datetime.now().isoformat(timespec='seconds'))
+    p = PATHS.output / 'benchmarks' / 'imports.csv'
+    p.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(p, mode='a', header=not p.exists(), index=False)
+    return df
+
+
+def run_benchmarks(scales=None, label: str = '', root=None, **kwargs):
+    """Benchmark all stages at each (n_sites, n_sensors) scale and append results to csv.
+
+    @param scales: list of (n_sites, n_sensors), default synthetic.SCALES
+    @param label: free text saved with the results, e.g. the change being measured
+    @param root: scratch directory the stages write to, a temporary one
+        (removed afterwards) if None
+    @param kwargs: passed to benchmark_scale()
+    @return: dataframe of this run's results
+    """
+    scales = synthetic.SCALES if scales is None else scales
+    revision = git_revision()
+    df_list = []
+    with tempfile.TemporaryDirectory(prefix='are219-benchmarks-') as scratch, use_root(root or scratch):
+        for n_sites, n_sensors in scales:
+            logger.info(f"Benchmarking {n_sites} sites, {n_sensors} sensors")
+            df_list.append(benchmark_scale(n_sites, n_sensors, **kwargs))
+    df = pd.concat(df_list, ignore_index=True)
+    df.insert(0, 'label', label)
+    df.insert(0, 'revision', revision)
+    df.insert(0, 'run_at', dt.datetime.now().isoformat(timespec='seconds'))
+    p = PATHS.output / 'benchmarks' / 'calculate_pm.csv'
+    p.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(p, mode='a', header=not p.exists(), index=False)
+    logger.info(f"Saved benchmark results to {p}")
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--scales', nargs='+', default=None,
+                        help="SITESxSENSORS pairs, e.g. 1x5 100x5000 (default: all of synthetic.SCALES)")
+    parser.add_argument('--weeks', type=int, default=4, help="weeks of data per sensor")
+    parser.add_argument('--years', type=int, default=4, help="years of data per site")
+    parser.add_argument('--repeat', type=int, default=1, help="timed runs per call (fastest is kept)")
+    parser.add_argument('--no-memory', action='store_true', help="skip the memory-traced runs")
+    parser.add_argument('--label', default='', help="text saved with the results")
+    parser.add_argument('--imports', action='store_true', help="time module imports instead of the stages")
+    parser.add_argument('--root', default=None, help="scratch directory for the stages' output "
+                                                     "(default: a temporary directory)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.imports:
+        df = run_import_benchmarks(repeat=max(args.repeat, 3), label=args.label)
+        print(df[['module', 'seconds', 'slowest_packages']].to_string(index=False, float_format='{:.3f}'.format))
+        return
+    scales = None
+    if args.scales is not None:
+        scales = [tuple(int(n) for n in scale.split('x')) for scale in args.scales]
+    df = run_benchmarks(scales, label=args.label, root=args.root, weeks=args.weeks, years=args.years,
+                        repeat=args.repeat, memory=not args.no_memory)
+    print(df.drop(columns=['run_at', 'revision', 'label']).to_string(index=False, float_format='{:.3f}'.format))
+
+
+if __name__ == "__main__":
+    main()
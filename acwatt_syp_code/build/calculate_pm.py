@@ -6,27 +6,26 @@
 import logging
 import datetime as dt
 
-import botocore.exceptions
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point
-from shapely import wkt
 import numpy as np
-import matplotlib.pyplot as plt
 from pathlib import Path
-import seaborn as sns
-import statsmodels.api as sm
-from statsmodels.iolib.summary2 import summary_col
-from stargazer.stargazer import Stargazer, LineLocation
 import time
 import os
 import io
 # Third-party Imports
-import altair as alt
-import boto3
-from botocore.exceptions import ClientError
 # Local Imports
 from ..utils.config import PATHS, AWS
+from ..utils.geo_cache import load_layer, load_sensor_table
+from ..utils.lazy import lazy_import
+
+# Plotting, geo, statistics and cloud packages take seconds to import, so they
+# are only imported when a function that uses them is first called
+gpd = lazy_import('geopandas')
+plt = lazy_import('matplotlib.pyplot')
+sns = lazy_import('seaborn')
+sm = lazy_import('statsmodels.api')
+alt = lazy_import('altair')
+boto3 = lazy_import('boto3')
 
 logger = logging.getLogger(__name__)
 DTYPES = {"county_code": str, "county": str, "County Code": str, "State Code": str,
@@ -63,6 +62,10 @@ def make_hourly_avg_plots(df_pa, df_epa, sensor_id):
     plt.show()
 
 
+def site_figure_path(county, site, figure):
+    return PATHS.output / 'figures' / 'epa_vs_pa' / f'site-{county}-{site}_{figure}.png'
+
+
 def plot_epa_vs_pa(df_epa, county, site, color_category = 'hour of day'):
     if color_category == 'hour of day':
         df_epa[color_category] = df_epa['time_local'].str.split(':').str[0].astype(int)
@@ -79,7 +82,7 @@ def plot_epa_vs_pa(df_epa, county, site, color_category = 'hour of day'):
     max_pm = df_epa['pm2.5_epa'].max()
     ax.plot([0, max_pm], [0, max_pm], color='red')
     plt.tight_layout()
-    p = PATHS.output / 'figures' / 'epa_vs_pa' / f'site-{county}-{site}_epa-pa-hourly-plot.png'
+    p = site_figure_path(county, site, 'epa-pa-hourly-plot')
     plt.savefig(p, dpi=200)
     plt.close(fig)
 
@@ -117,7 +120,7 @@ def density_epa_missing_vs_pa(df_epa, county, site):
     ax.set_xlim([min_, max_])
     plt.legend(fontsize=fontsize_)
     plt.tight_layout()
-    p = PATHS.output / 'figures' / 'epa_vs_pa' / f'site-{county}-{site}_epa-pa-missing-density.png'
+    p = site_figure_path(county, site, 'epa-pa-missing-density')
     plt.savefig(p, dpi=200)
     plt.close(fig)
 
@@ -135,7 +138,7 @@ def plot_pa_coverage(df_epa, county, site):
     ax.set_xlim([dt.datetime.strptime('2016', '%Y'), dt.datetime.strptime('2022', '%Y')])
     # ax.get_legend().remove()
     plt.tight_layout()
-    p = PATHS.output / 'figures' / 'epa_vs_pa' / f'site-{county}-{site}_pa-daily-covereage.png'
+    p = site_figure_path(county, site, 'pa-daily-covereage')
     plt.savefig(p, dpi=200)
     plt.close(fig)
 
@@ -172,12 +175,14 @@ def save_combined_file(df_epa, county, site):
     df_epa2.to_csv(p, index=False)
 
 
-def download_file(bucket_name, bucket_filepath):
-    """Return a pandas dataframe of a CSV from an S3 bucket
+def download_file(bucket_name, bucket_filepath, missing_ok=False):
+    """Return a pandas dataframe of a CSV (or gzipped CSV, .csv.gz) from an S3 bucket
 
     :param bucket_filepath: File to download
     :param bucket_name: Bucket to upload to
+    :param missing_ok: return None without a warning if the file doesn't exist
     """
+    from botocore.exceptions import ClientError, ResponseStreamingError
 
     # Upload the file
     s3_client = boto3.client('s3',
@@ -202,14 +207,18 @@ def download_file(bucket_name, bucket_filepath):
     while sleepy_time < 33 and func_return is None:
         try:
             obj = s3_client.get_object(Bucket=bucket_name, Key=bucket_filepath)
-            df = pd.read_csv(io.BytesIO(obj['Body'].read()), encoding='utf8', header=[0, 1])
+            compression = 'gzip' if bucket_filepath.endswith('.gz') else None
+            df = pd.read_csv(io.BytesIO(obj['Body'].read()), encoding='utf8', header=[0, 1],
+                             compression=compression)
             return df
         except ClientError as error:
+            if missing_ok and error.response['Error']['Code'] == 'NoSuchKey':
+                return None
             print()
             logging.error(error)
             logger.warning(f'Unable to retrieve S3 object {bucket_filepath}. It was probably privat when you tried to download it originally.')
             return None
-        except botocore.exceptions.ResponseStreamingError as error:
+        except ResponseStreamingError as error:
             logger.info(f"Sleeping for {sleepy_time} to give AWS time to "
                         f"connect resources.")
             time.sleep(sleepy_time)
@@ -274,14 +283,34 @@ def transform_pa_df(df):
     return df2
 
 
-def concat_sensors(sensor_list: pd.DataFrame, power=1):  # IDW power
+def download_sensor(s3_client, sensor_id, date_start=None, date_end=None):
+    """Return wide data for sensor between local dates ('YYYY-MM-DD'), None if there is none.
+
+    Sensors saved in weekly partitions only have the partitions in the date
+    range fetched (see s3_layout). Otherwise the whole file is downloaded.
+    """
+    from .aws import s3_layout
+    manifest = s3_layout.read_manifest(s3_client, AWS.bucket_name, sensor_id)
+    if manifest is not None:
+        return s3_layout.read_sensor(s3_client, AWS.bucket_name, sensor_id, date_start, date_end)
+    # Downlaod the file to dataframe (streamed uploads are gzipped)
+    df_pa = download_file(AWS.bucket_name, f'{sensor_id:07d}.csv.gz', missing_ok=True)
+    if df_pa is None:
+        df_pa = download_file(AWS.bucket_name, f'{sensor_id:07d}.csv')
+    return df_pa
+
+
+def concat_sensors(sensor_list: pd.DataFrame, power=1,  # IDW power
+                   date_start=None, date_end=None):
     logger.info(f"Loading {len(sensor_list)} PurpleAir sensors.")
+    s3_client = boto3.client('s3',
+                             region_name=AWS.region,
+                             aws_access_key_id=AWS.access_key,
+                             aws_secret_access_key=AWS.secret_key)
     df_list = []
     for sensor_id, dist in zip(sensor_list['sensor_index'], sensor_list['dist_mile']):
         print("*", end='')
-        # Downlaod the file to dataframe
-        bucket_file = f'{sensor_id:07d}.csv'
-        df_pa = download_file(AWS.bucket_name, bucket_file)
+        df_pa = download_sensor(s3_client, sensor_id, date_start, date_end)
         if df_pa is None:
             continue  # Skip this sensor if there is no file in the S3 for it
         # Transform the dataframe to get PM2.5 and humidity
@@ -312,10 +341,13 @@ def average_sensors(df):
 
 
 def filter_sensors(sensor_list, threshold, min_sensors=10):
-    if len(sensor_list.query(f"dist_mile < {threshold}")) >= min_sensors:
-        return sensor_list.sort_values('dist_mile').query(f"dist_mile < {threshold}")
+    # Lists saved by download_15_test_sites() are already nearest first
+    if not sensor_list['dist_mile'].is_monotonic_increasing:
+        sensor_list = sensor_list.sort_values('dist_mile')
+    if (sensor_list['dist_mile'] < threshold).sum() >= min_sensors:
+        return sensor_list[sensor_list['dist_mile'] < threshold]
     else:
-        return sensor_list.sort_values('dist_mile').iloc[0:min_sensors]
+        return sensor_list.iloc[0:min_sensors]
 
 
 def add_pa_pm(df_epa, county, site, threshold=5, power=1, min_sensors=10):
@@ -326,7 +358,8 @@ def add_pa_pm(df_epa, county, site, threshold=5, power=1, min_sensors=10):
     sensor_list = pd.read_csv(lookup_dir / f'county-{county}_site-{site}_pa-list.csv')
     sensor_list = filter_sensors(sensor_list, threshold, min_sensors=min_sensors)
     # For each sensor in list, download CSV from S3 to get PM2.5 values
-    df_pa = concat_sensors(sensor_list)
+    df_pa = concat_sensors(sensor_list, date_start=df_epa['date_local'].min(),
+                           date_end=df_epa['date_local'].max())
     if df_pa is False:
         return False
     # Combine PA sensors to get hourly weighted average PM2.5
@@ -389,12 +422,39 @@ def combine_15_sites(run_all=False):
             save_combined_file(df_epa, county, site)
 
 
-def make_plots_15_sites():
+def site_plot(plot_func, county, site, **kwargs):
+    """Load a site's combined EPA-PA data and make one of its site_plots() figures (a render() job).
+
+    plot_func is passed as a function, not by name, so render() keys the job on its source.
+    """
+    df_epa = pd.read_csv(PATHS.data.root / 'combined_epa_pa' / f"county-{county}_site-{site}_combined-epa-pa.csv")
+    try:
+        plot_func(df_epa, county, site, **kwargs)
+    except ValueError as e:
+        plt.close('all')
+        if plot_func is not density_epa_missing_vs_pa:
+            raise
+        # No figure is saved, so render() has to report the job as failed, not rendered
+        raise ValueError(f'No PurpleAir data overlaps with missing EPA data at site {county}-{site}') from e
+
+
+def make_plots_15_sites(workers=None, force=False):
+    """Make each site's plots in parallel, skipping plots whose data hasn't changed (see utils/render.py)."""
+    from ..utils.render import FigureJob, render
     aqs_tbl = load_15_sites()
+    jobs = []
     # For each EPA site-county in list
     for county, site in aqs_tbl:  # cs_list
-        print(f'Starting plots for {county}-{site}.')
-        site_plots(county, site)
+        p = PATHS.data.root / 'combined_epa_pa' / f"county-{county}_site-{site}_combined-epa-pa.csv"
+        if not p.exists():
+            print(f'No file {p.name}. Skipping plots for site {county}-{site}')
+            continue
+        for plot_func, figure, kwargs in [(plot_epa_vs_pa, 'epa-pa-hourly-plot', {'color_category': 'year'}),
+                                          (density_epa_missing_vs_pa, 'epa-pa-missing-density', {}),
+                                          (plot_pa_coverage, 'pa-daily-covereage', {})]:
+            jobs.append(FigureJob(site_plot, (plot_func, county, site), kwargs, inputs=(p,),
+                                  outputs=(site_figure_path(county, site, figure),)))
+    return render(jobs, workers=workers, force=force)
 
 
 def add_exceptional_indicator(df):
@@ -413,6 +473,7 @@ def fill_in_missing_with_idw(df):
 
 
 def fill_in_missing_with_OLS(df, site_dict, alpha=0.05):
+    from stargazer.stargazer import Stargazer, LineLocation
     # Remove missing values from y and x for regression
     df1 = df[~df['pm2.5_epa'].isna() & ~df['pm2.5_pa'].isna()]
     y = df1['pm2.5_epa']
@@ -467,6 +528,7 @@ def fill_in_missing_with_OLS(df, site_dict, alpha=0.05):
     stargazer.table_label = f'tab:reg_{c_s}'
     table = stargazer.render_latex()
     p = PATHS.output / 'tables' / f'epa_OLS_idw_pa_site-{c_s}.tex'
+    p.parent.mkdir(parents=True, exist_ok=True)
     with open(p, "w") as file1:
         # Writing data to a file
         file1.write(table)
@@ -727,6 +789,7 @@ def create_sample_dvs(left='epa', right_list=None):
         dv_list.append(df)
         complete_list += completeness_list
     df_dv = pd.concat(dv_list, ignore_index=True)
+    PATHS.data.temp.mkdir(parents=True, exist_ok=True)
     df_dv.to_csv(PATHS.data.temp / 'design_value_est.csv', index=False)
     df_save = pd.concat(diffs_list, ignore_index=True)
     df_save['invalid quarter DV due to too many missing days'] = df_save.isnull().any(axis=1)
@@ -765,6 +828,7 @@ def create_minimum_dvs():
         df = create_minimum_site_dvs(site_dict)
         dv_list.append(df)
     df_dv = pd.concat(dv_list, ignore_index=True)
+    PATHS.data.temp.mkdir(parents=True, exist_ok=True)
     df_dv.to_csv(PATHS.data.temp / 'referee_minimum_design_value.csv', index=False)
 
 
@@ -812,21 +876,15 @@ def drop_highest_6_hours(df):
 #                       Presentation Plots
 ################################################################################
 def add_latlon_points(df, crs, lat="Latitude", lon="Longitude"):
+    from shapely.geometry import Point
     points = [Point(lon, lat) for lon, lat in zip(df[lon], df[lat])]
     return gpd.GeoDataFrame(df, geometry=points, crs=crs)
 
 
 def load_ca_pa_locations():
-    # Load county shapefile to get CRS for purpleair locations
-    p_shp = PATHS.data.gis / 'cb_2018_us_county_500k' / 'cb_2018_us_county_500k.shp'
-    gdf = gpd.read_file(p_shp)
-    p_pa = PATHS.data.temp / 'sensors_filtered.csv'
     cols = ['sensor_index', 'date_created', 'lat', 'lon', 'STUSPS', 'geometry']
-    df = pd.read_csv(p_pa, usecols=cols)
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = gpd.GeoDataFrame(df, crs=gdf.crs)
+    gdf = load_sensor_table(columns=cols, states=['CA'])
     gdf = gdf.rename(columns={'lat': 'latitude', 'lon': 'longitude', 'STUSPS': 'state'})
-    gdf = gdf.query("state in ['CA']")
     return gdf
 
 
@@ -851,8 +909,7 @@ def load_ca_pa_insample(min_pa_sensors=5, dist_threshold=5):
 def plot_us_epa():
     """Plot all US EPA NAAQS sensors, mark my sample"""
     # Plot US shape
-    p1 = PATHS.data.gis / 'cb_2018_us_state_5m' / 'cb_2018_us_state_5m.shp'
-    gdf = gpd.read_file(p1)
+    gdf = load_layer('states')
     states_to_drop = ['02', '15']  # remove alaska and hawaii
     mask = "STATEFP < '60'"  # remove all non-states
     gdf = gdf[~gdf.STATEFP.isin(states_to_drop)].query(mask)
@@ -894,9 +951,7 @@ def plot_us_epa():
 def plot_ca_epa():
     """Plot all ca EPA NAAQS sensors, mark my sample"""
     # Plot US shape
-    p1 = PATHS.data.gis / 'cb_2018_us_state_5m' / 'cb_2018_us_state_5m.shp'
-    gdf = gpd.read_file(p1)
-    gdf = gdf.query("STATEFP == '06'")  # keep only CA
+    gdf = load_layer('states', statefp='06')  # keep only CA
     ax = gdf.plot(color='grey', figsize=(8, 8), edgecolor="face", linewidth=0.4)
 
     # Plot all EPA NAAQS monitors in black
@@ -940,9 +995,7 @@ def plot_ca_epa():
 def plot_california_pa(min_pa_sensors=5, dist_threshold=5):
     """Save plot of all CA PA """
     # Load cali shape
-    p1 = PATHS.data.gis / 'cb_2018_us_state_5m' / 'cb_2018_us_state_5m.shp'
-    gdf = gpd.read_file(p1)
-    gdf = gdf.query("STATEFP == '06'")  # keep only CA
+    gdf = load_layer('states', statefp='06')  # keep only CA
     ax = gdf.plot(color='grey', figsize=(8, 8), edgecolor="face", linewidth=0.4)
 
     # Load all PA and filter to CA
@@ -1184,22 +1237,46 @@ def plot_minimum_possible_all_tested_sites_by_site():
             plot_dv_diff_with_minimum_possible(group, dv_type, site=key, suffix='conservative')
 
 
-def generate_presentation_plots():
+def generate_presentation_plots(workers=None, force=False):
+    """Make the DV plots in parallel, skipping plots whose data hasn't changed (see utils/render.py)."""
+    from ..utils.render import FigureJob, render
+    p_diff = PATHS.data.temp / 'design_value_differences.csv'
+    p_est = PATHS.data.temp / 'design_value_est.csv'
+    p_min = PATHS.data.temp / 'referee_minimum_design_value.csv'
+    dir_final = PATHS.output / 'figures' / 'final_results'
+    dir_referee = PATHS.output / 'figures' / 'referee'
     # plot_us_epa()
     # plot_ca_epa()
     # plot_california_pa()
-    for dv_type in ['annual', 'hour']:
-        plot_all_tested_sites(dv_type=dv_type)
-        plot_site_dv(dv_type=dv_type, site='019-0500')
+    # (outputs only decide whether a job can be skipped; a wrong path just means re-rendering)
+    jobs = []
+    for suffix in ['', 'conservative']:
+        tag = f"_{suffix}" if suffix else ""
+        for dv_type in ['annual', 'hour']:
+            jobs.append(FigureJob(plot_all_tested_sites, kwargs={'dv_type': dv_type, 'suffix': suffix},
+                                  inputs=(p_diff,), outputs=(dir_final / f'DV_{dv_type}_plot_all_test_sites{tag}.png',)))
+            jobs.append(FigureJob(plot_site_dv, kwargs={'dv_type': dv_type, 'site': '019-0500', 'suffix': suffix},
+                                  inputs=(p_diff,), outputs=(dir_final / f'DV_{dv_type}_plot_site_019-0500{tag}.png',)))
     # plot_epa_completeness()
 
     # Referee plots --------------------------------
-    plot_minimum_possible_all_tested_sites()
-    plot_minimum_possible_all_tested_sites_by_site()
-    for dv_type in ['annual', 'hour']:
-        plot_all_tested_sites(dv_type=dv_type, suffix='conservative')
-        plot_site_dv(dv_type=dv_type, site='019-0500', suffix='conservative')
-    print('done?')
+    jobs.append(FigureJob(plot_minimum_possible_all_tested_sites, inputs=(p_est, p_min),
+                          outputs=tuple(dir_referee / f'room_for_manipulation_{dv_type}_DV_all_sites.png'
+                                        for dv_type in ['annual', 'hour']),
+                          helpers=(plot_dv_diff,)))
+    sites = []
+    if p_diff.exists():
+        df_sites = pd.read_csv(p_diff, usecols=['county', 'site'], dtype=DTYPES).drop_duplicates()
+        sites = (df_sites['county'] + '-' + df_sites['site']).tolist()
+    jobs.append(FigureJob(plot_minimum_possible_all_tested_sites_by_site, inputs=(p_diff, p_min),
+                          outputs=tuple(dir_referee / f'room_for_manipulation_{dv_type}_DV_site_{site}{tag}.png'
+                                        for site in sites for dv_type in ['annual', 'hour']
+                                        for tag in ['', '_conservative']),
+                          helpers=(plot_dv_diff_with_minimum_possible,)))
+    result = render(jobs, workers=workers, force=force)
+    print(f"{len(result['rendered'])} plot jobs rendered, {len(result['skipped'])} up to date, "
+          f"{len(result['failed'])} failed")
+    return result
 
 
 ################################################################################
@@ -5,24 +5,25 @@
 # Built-in Imports
 import json
 import logging
+import queue
+import threading
+import zipfile
 import pandas as pd
 from pandas.core.computation.ops import UndefinedVariableError
 import geopandas as gpd
-from shapely import wkt
-from shapely.geometry import Point
-import requests
 import matplotlib.pyplot as plt
 # Third-party Imports
-from ratelimiter import RateLimiter
 # Local Imports
-from ..utils.config import PATHS, EPA
+from ..utils.config import PATHS
+from ..utils.api_cache import aqs_request
+from ..utils.neighbors import NeighborIndex, MILE
+from ..utils.geo_cache import load_layer, load_sensor_table
 from ..build.purpleair_download import dl_sorted_sensors
 
 DTYPES = {"parameter_code": int, "state_code": str, "county_code": str, "site_number": str}
 logger = logging.getLogger(__name__)
 
 
-@RateLimiter(max_calls=1, period=6)
 def get_monitor_list_at_site(bdate: str, edate: str, state: str, county: str, site: str):
     """Returns list of PM2.5 monitors at {site} that operated between the bdate and edate
 
@@ -33,27 +34,34 @@ def get_monitor_list_at_site(bdate: str, edate: str, state: str, county: str, si
     site: The 4 digit AQS site number within the county (with leading zeroes). They may be obtained via the list sites service. Only data from this site will be returned.
     """
     param = 88101  # parameter key for NAAQS PM2.5 sensors
-    url = f"https://aqs.epa.gov/data/api/monitors/bySite?email={EPA.user_id}&key={EPA.read_key}&param={param}&bdate={bdate}&edate={edate}&state={state}&county={county}&site={site}"
-    response = requests.get(url)
-    df = pd.DataFrame(response.json()['Data'])
+    params = {'param': param, 'bdate': bdate, 'edate': edate,
+              'state': state, 'county': county, 'site': site}
+    df = pd.DataFrame(aqs_request('monitors/bySite', params)['Data'])
     df = df.query("naaqs_primary_monitor == 'Y'")
     return df
 
 
-@RateLimiter(max_calls=1, period=6)
 def get_site_list(state: str, county: str):
-    url = f"https://aqs.epa.gov/data/api/list/sitesByCounty?email={EPA.user_id}&key={EPA.read_key}&state={state}&county={county}"
-    response = requests.get(url)
-    print(response.json()['Data'])
+    data = aqs_request('list/sitesByCounty', {'state': state, 'county': county})
+    print(data['Data'])
     print()
 
 
-@RateLimiter(max_calls=1, period=6)
-def get_site_data(bdate: str, edate: str, state: str, county: str, site: str):
+def fetch_site_data(bdate: str, edate: str, state: str, county: str, site: str):
+    """Return the raw JSON response of sample data for a site.
+
+    Only the request itself is rate limited (see aqs_request()), so building the
+    dataframe and writing it to file doesn't add to the 6 seconds between
+    requests, and cached site-years don't wait at all.
+    """
     param = 88101  # parameter key for NAAQS PM2.5 sensors
-    url = f"https://aqs.epa.gov/data/api/sampleData/bySite?email={EPA.user_id}&key={EPA.read_key}&param={param}&bdate={bdate}&edate={edate}&state={state}&county={county}&site={site}"
-    response = requests.get(url)
-    d = response.json()['Data']
+    params = {'param': param, 'bdate': bdate, 'edate': edate,
+              'state': state, 'county': county, 'site': site}
+    return aqs_request('sampleData/bySite', params)
+
+
+def get_site_data(bdate: str, edate: str, state: str, county: str, site: str):
+    d = fetch_site_data(bdate, edate, state, county, site)['Data']
     df = pd.DataFrame(d)
     return df
 
@@ -66,29 +74,225 @@ def get_site_year(site, year, state="06", county="037"):
 
 
 def save_site(site, county, years = None):
-    p = PATHS.data.epa_pm25 / f"county-{county}_site-{site}_hourly.csv"
+    p = site_hourly_path(site, county)
     # Check if file already exists
     if p.exists():
         return False
     else:
         print("Downloading hourly EPA data for", site, county)
-    if years is None:
-        years = ['2016', '2017', '2018', '2019', '2020', '2021']
+    download_sites([(site, county)], years=years)
+    return True
+
+
+################################################################################
+# DOWNLOAD SCHEDULER
+################################################################################
+def site_hourly_path(site, county):
+    return PATHS.data.epa_pm25 / f"county-{county}_site-{site}_hourly.csv"
+
+
+def site_year_path(site, county, year):
+    """Path of the partial file holding one site-year of EPA data."""
+    return PATHS.data.epa_pm25 / 'partial' / f"county-{county}_site-{site}_{year}.csv"
+
+
+def save_site_year(data: dict, site, county, year):
+    """Write one site-year API response to its partial file.
+
+    A response with no data still gets an (empty) partial file so the job isn't
+    requested again. Failed responses aren't written, so they are retried on
+    the next run.
+    """
+    status = data['Header'][0]['status']
+    if status == 'Failed':
+        logger.warning(f"{county}-{site} {year}: request failed ({data['Header'][0].get('error')})")
+        return False
+    p = site_year_path(site, county, year)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    df = pd.DataFrame(data['Data'])
+    p_temp = p.with_suffix('.tmp')
+    df.to_csv(p_temp, index=False)
+    p_temp.replace(p)  # only a complete file gets the final name
+    logger.info(f"{county}-{site} {year}: saved {len(df)} rows")
+    return True
+
+
+def assemble_site(site, county, years):
+    """Concatenate a site's partial site-year files into the site-hourly file."""
     df_list = []
-    # For each year, get site-year hourly data
     for year in years:
-        df_temp = get_site_year(site, year, county=county)
-        df_list.append(df_temp)
-        print(df_temp)
-    # Concat df_list and save site-hourly file
-    df_site_hourly = pd.concat(df_list)
+        try:
+            df_list.append(pd.read_csv(site_year_path(site, county, year), dtype=DTYPES))
+        except pd.errors.EmptyDataError:  # no data for this year
+            continue
+    df_site_hourly = pd.concat(df_list) if df_list else pd.DataFrame()
+    if 'sample_duration' not in df_site_hourly.columns:
+        logger.warning(f"{county}-{site}: no EPA data for {years[0]}-{years[-1]}.")
+        return False
     df_site_hourly = (df_site_hourly
                       .query("sample_duration == '1 HOUR'")
                       .sort_values(['date_local', 'time_local']))
-    df_site_hourly.to_csv(p, index=False)
+    df_site_hourly.to_csv(site_hourly_path(site, county), index=False)
     return True
 
 
+def _write_site_years(results: queue.Queue, years_needed: dict, years):
+    """Writer thread: parse and save responses while the next request is in flight.
+
+    @param years_needed: dict of (site, county) -> set of years not saved yet
+    @param years: all years of a site, combined once none are needed
+    """
+    while True:
+        item = results.get()
+        if item is None:
+            break
+        (site, county, year), data = item
+        try:
+            if save_site_year(data, site, county, year):
+                years_needed[(site, county)].discard(year)
+                if not years_needed[(site, county)]:
+                    assemble_site(site, county, years)
+        except Exception:  # keep writing the other site-years; this one is retried next run
+            logger.exception(f"{county}-{site} {year}: couldn't save response")
+
+
+def download_sites(site_counties, years=None, state="06"):
+    """Download hourly EPA data for many sites through one rate-limited request pipeline.
+
+    All (site, year) jobs go into one global queue. Requests are made one at a
+    time at the API's rate limit (see fetch_site_data()), and a writer thread
+    parses each response and writes it to a partial site-year file, so there
+    are no gaps between requests while responses are parsed. Site-years that
+    already have a partial file are skipped, so an interrupted download picks
+    up where it stopped. When all years of a site are done, they are combined
+    into the site-hourly file.
+
+    @param site_counties: list of (site, county) pairs
+    @param years: list of year strings, defaults to 2016-2021
+    @param state: 2-digit state FIPS code
+    @return: number of requests made
+    """
+    if years is None:
+        years = ['2016', '2017', '2018', '2019', '2020', '2021']
+    years_needed = {}
+    jobs = []
+    for site, county in site_counties:
+        if site_hourly_path(site, county).exists():
+            continue
+        needed = {year for year in years if not site_year_path(site, county, year).exists()}
+        years_needed[(site, county)] = needed
+        if not needed:  # downloaded before, but not combined
+            assemble_site(site, county, years)
+        jobs += [(site, county, year) for year in years if year in needed]
+    logger.info(f"Downloading {len(jobs)} EPA site-years "
+                f"(~{len(jobs) * 6 / 60:.0f} minutes at the API rate limit).")
+
+    results = queue.Queue()
+    writer = threading.Thread(target=_write_site_years, args=(results, years_needed, years))
+    writer.start()
+    try:
+        for site, county, year in jobs:
+            data = fetch_site_data(bdate=f"{year}0101", edate=f"{year}1231",
+                                   state=state, county=county, site=site)
+            results.put(((site, county, year), data))
+    finally:
+        results.put(None)  # stop the writer once it has saved everything queued
+        writer.join()
+    return len(jobs)
+
+
+################################################################################
+# BULK FILE INGEST
+################################################################################
+# Bulk hourly file columns -> AQS API sampleData columns (as written by save_site())
+BULK_COLUMNS = {"State Code": "state_code", "County Code": "county_code",
+                "Site Num": "site_number", "Parameter Code": "parameter_code",
+                "POC": "poc", "Latitude": "latitude", "Longitude": "longitude",
+                "Datum": "datum", "Parameter Name": "parameter",
+                "Date Local": "date_local", "Time Local": "time_local",
+                "Date GMT": "date_gmt", "Time GMT": "time_gmt",
+                "Sample Measurement": "sample_measurement",
+                "Units of Measure": "units_of_measure", "MDL": "detection_limit",
+                "Uncertainty": "uncertainty", "Qualifier": "qualifier",
+                "Method Type": "method_type", "Method Code": "method_code",
+                "Method Name": "method", "State Name": "state", "County Name": "county",
+                "Date of Last Change": "date_of_last_change"}
+BULK_DTYPES = {"State Code": str, "County Code": str, "Site Num": str,
+               "Parameter Code": int, "Qualifier": str}
+
+
+def bulk_zip_paths(params=(88101,), years=None):
+    """Return paths of downloaded EPA bulk hourly zip files, e.g. data/epa/bulk/hourly_88101_2020.zip.
+
+    Bulk files are downloaded from https://aqs.epa.gov/aqsweb/airdata/download_files.html
+    """
+    if years is None:
+        years = ['2016', '2017', '2018', '2019', '2020', '2021']
+    return [PATHS.data.epa_bulk / f'hourly_{param}_{year}.zip' for param in params for year in years]
+
+
+def bulk_site_path(param, state, county, site):
+    return (PATHS.data.epa_bulk_sites / f'{param}' / f'state-{state}'
+            / f"county-{county}_site-{site}_hourly.csv")
+
+
+def ingest_bulk_hourly(zip_paths, states=None, sites=None, params=(88101,),
+                       chunksize=500000, site_state='06'):
+    """Write per-site hourly files from EPA bulk hourly zip files in one pass.
+
+    Each zip is streamed in chunks, filtered to the wanted parameters, states and
+    sites, and appended to one file per parameter-site, with the same columns as
+    the AQS API sampleData files written by save_site(). PM2.5 (88101) sites in
+    site_state are also saved where save_site() saves them (site_hourly_path()),
+    unless that file exists, so load_epa() reads them and download_sites()
+    doesn't request them. This replaces one rate-limited API request per
+    site-year.
+
+    @param zip_paths: list of bulk hourly zip files (see bulk_zip_paths())
+    @param states: list of 2-digit state FIPS codes to keep, None for all
+    @param sites: list of (site, county) pairs to keep, None for all
+    @param params: parameter codes to keep
+    @param chunksize: rows to read at a time
+    @param site_state: state of the sites the pipeline uses (its site files
+        aren't named by state)
+    @return: list of per-site files written
+    """
+    site_keys = None if sites is None else {f'{county}-{site}' for site, county in sites}
+    written = {}
+    for zip_path in zip_paths:
+        logger.info(f'Ingesting {zip_path}')
+        with zipfile.ZipFile(zip_path) as zipped:
+            with zipped.open(zipped.namelist()[0]) as f:
+                for chunk in pd.read_csv(f, chunksize=chunksize, dtype=BULK_DTYPES):
+                    keep = chunk['Parameter Code'].isin(params)
+                    if states is not None:
+                        keep &= chunk['State Code'].isin(states)
+                    if site_keys is not None:
+                        keep &= (chunk['County Code'] + '-' + chunk['Site Num']).isin(site_keys)
+                    chunk = chunk[keep].rename(columns=BULK_COLUMNS)
+                    chunk['sample_duration'] = '1 HOUR'
+                    groups = chunk.groupby(['parameter_code', 'state_code', 'county_code', 'site_number'])
+                    for (param, state, county, site), df in groups:
+                        p = bulk_site_path(param, state, county, site)
+                        first = p not in written
+                        if first:
+                            p.parent.mkdir(parents=True, exist_ok=True)
+                            written[p] = (param, state, county, site)
+                        df.to_csv(p, mode='w' if first else 'a', header=first, index=False)
+
+    # Sort each site file by time, as the API files are
+    for p, (param, state, county, site) in written.items():
+        df = pd.read_csv(p, dtype=DTYPES)
+        df = df.sort_values(['date_local', 'time_local'], kind='stable')
+        df.to_csv(p, index=False)
+        p_site = site_hourly_path(site, county)
+        if param == 88101 and state == site_state and not p_site.exists():
+            p_site.parent.mkdir(parents=True, exist_ok=True)
+            df.to_csv(p_site, index=False)
+    logger.info(f'Wrote {len(written)} site files from {len(zip_paths)} bulk files.')
+    return sorted(written)
+
+
 def load_small_sample_ids():
     p = PATHS.data.epa.monitors / 'aqs_monitors_88101_smallsample.csv'
     df = pd.read_csv(p, dtype=DTYPES)
@@ -98,16 +302,9 @@ def load_small_sample_ids():
 
 
 def load_pa_locations():
-    # Load county shapefile to get CRS for purpleair locations
-    p_shp = PATHS.data.gis / 'cb_2018_us_county_500k' / 'cb_2018_us_county_500k.shp'
-    gdf = gpd.read_file(p_shp)
-    p_pa = PATHS.data.temp / 'sensors_filtered.csv'
     cols = ['sensor_index', 'date_created', 'lat', 'lon', 'STUSPS', 'geometry']
-    df = pd.read_csv(p_pa, usecols=cols)
-    df['geometry'] = df['geometry'].apply(wkt.loads)
-    gdf = gpd.GeoDataFrame(df, crs=gdf.crs)
+    gdf = load_sensor_table(columns=cols, states=['CA', 'OR', 'NV', 'AZ'])
     gdf = gdf.rename(columns={'lat': 'latitude', 'lon': 'longitude', 'STUSPS': 'state'})
-    gdf = gdf.query("state in ['CA', 'OR', 'NV', 'AZ']")
     return gdf
 
 
@@ -136,8 +333,7 @@ def plot_hour_distributions(df, site, year):
 
 
 def plot_epa_pa_sensors(df1, point, site, county):
-    p_shp = PATHS.data.gis / 'cb_2018_us_county_500k' / 'cb_2018_us_county_500k.shp'
-    gdf = gpd.read_file(p_shp).query("STATEFP == '06'")
+    gdf = load_layer('counties', statefp='06')
     ax = gdf.plot(color='grey', figsize=(8, 8))
     df1.to_crs(gdf.crs).plot(ax=ax, color='blue')
     # for thresh in [25, 10, 5]:
@@ -196,9 +392,13 @@ def download_15_test_sites():
     df1 = pd.read_csv(p1, dtype=DTYPES)
     site_counties = [pair for pair in zip(df1.site_number, df1.county_code)]
 
+    # Use the bulk files if all years have been downloaded (one pass instead of
+    # one API request per site-year), then download whatever is still missing
+    zip_paths = bulk_zip_paths()
+    if all(p.exists() for p in zip_paths):
+        ingest_bulk_hourly(zip_paths, states=['06'], sites=site_counties)
     # For each EPA site, download hourly data and save csv if it doesn't exist
-    for site, county in site_counties:
-        save_site(site, county)
+    download_sites(site_counties)
 
     # Merge EPA site IDs with EPA site characteristics from small_sample
     p2 = PATHS.data.epa_monitors / 'aqs_monitors_88101_smallsample.csv'
@@ -208,39 +408,19 @@ def download_15_test_sites():
     # Load CA PA sensors with locations
     df_pa = load_pa_locations()
 
-    # for each EPA monitor
-    mile_to_meter = 1609.34
+    # PA sensors within 50 miles of each EPA monitor, or the closest min_pa_sensors
     threshold = 5  # miles
     min_pa_sensors = 5
-    idw_power = 1
-
-    df_list = []
-    for site, county, lat, lon in zip(df1.site_number, df1.county_code, df1.latitude, df1.longitude):
-        print('Finding nearest PA sensors for', site, county)
-        df_temp = df_pa.copy().to_crs('EPSG:3310')
-        # translate lat lon to meter coordinate system
-        point = (gpd.GeoDataFrame(geometry=[Point(lon, lat)], crs=df_pa.crs)
-                 .to_crs('EPSG:3310')
-                 .geometry[0])
-        # calulate distance of all PA monitors to EPA site location
-        df_temp['dist_mile'] = df_temp.geometry.distance(point) / mile_to_meter
-        # plot_epa_pa_sensors(df_temp, point, site, county)
-        # get PA sensors within threshold miles or closest 3
-        if len(df_temp.query(f'dist_mile < 50')) > min_pa_sensors:
-            df_temp = df_temp.query(f'dist_mile < 50')
-        else:
-            df_temp = df_temp.sort_values('dist_mile').head(min_pa_sensors)
-
+    print('Finding nearest PA sensors for', len(df1), 'EPA monitors')
+    index = NeighborIndex.from_geodataframe(df_pa, id_col='sensor_index')
+    df_all = index.site_table(df1.rename(columns={'site_number': 'site', 'county_code': 'county'}),
+                              radius=50 * MILE, min_count=min_pa_sensors)
+    # plot_epa_pa_sensors(df_temp, point, site, county)
+    cols = ['sensor_index', 'dist_mile']
+    for (county, site), df_temp in df_all.groupby(['county', 'site'], sort=False):
         p_temp = PATHS.data.tables / 'epa_pa_lookups' / f'county-{county}_site-{site}_pa-list.csv'
-        cols = ['sensor_index', 'dist_mile']
         df_temp.to_csv(p_temp, columns=cols, index=False)
-        # Save dataframe of all PAsensor-EPAmonitor-distance pairs
-        df_temp['site'] = site
-        df_temp['county'] = county
-        df_temp['dist_order'] = df_temp['dist_mile'].rank(method='max')
-        df_list.append(df_temp[['site', 'county', 'sensor_index', 'dist_mile', 'dist_order']])
-    # Save dataframe of PA-EPA distances
-    df_all = pd.concat(df_list, ignore_index=True)
+    # Save dataframe of all PAsensor-EPAmonitor-distance pairs
     df_all.to_csv(PATHS.data.tables / 'epa_pa_lookups' / f'aqs_monitors_to_pa_sensors.csv', index=False)
 
     # For live loading the data during debugging (603 sensors to download as of 2022-02-22)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+
+"""
+PURPOSE:
+Load test the design value pipeline offline, on synthetic data at any scale.
+
+make_dataset() writes everything combine_15_sites() and create_sample_dvs()
+read, for n_sites EPA monitors with n_sensors PurpleAir sensors between them:
+    - EPA hourly files for each site, as save_site() writes them (also served
+      by the fake AQS API)
+    - each sensor's data in the fake S3 bucket, in the flat ({id}.csv.gz) or
+      partitioned layout written by thread_test
+    - the site to sensor lookup tables and the AQS qualifier table
+
+run_load_test() points PATHS at a scratch directory, starts the fake API
+server (utils/fake_api.py) and runs the pipeline against it, timing each step.
+The first aqs_sites sites' EPA data is downloaded again through the fake AQS
+API (download_sites() and aqs_request()), at the API rate limit of one
+site-year per 6 seconds; the rest is read as make_dataset() wrote it.
+The current 15 sites have ~600 sensors; the defaults are 10x that.
+
+Usage:
+    python -m acwatt_syp_code.build.load_test --sites 150 --sensors 6000 --root /tmp/are219-load
+"""
+
+# Built-in Imports
+import argparse
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+# Third-party Imports
+import numpy as np
+import pandas as pd
+
+# Local Imports
+from . import calculate_pm
+from .aws import s3_layout
+from .epa_download import download_sites, site_hourly_path, site_year_path
+from ..utils import synthetic
+from ..utils.config import PATHS, AWS, Data
+from ..utils.fake_api import FakeAPIServer, LocalS3Client
+from ..utils.timing import TIMER
+
+logger = logging.getLogger(__name__)
+# create_sample_dvs() needs more than 12 quarters of data (see quarter_list())
+MIN_YEARS = 4
+
+
+@contextmanager
+def use_root(root: Path):
+    """Point PATHS (data and output directories) at root for the with block."""
+    root = Path(root)
+    saved = PATHS.root, PATHS.data, PATHS.output
+    PATHS.root, PATHS.data, PATHS.output = root, Data(root / 'data'), root / 'output'
+    PATHS.data.make_directories()
+    for p in [PATHS.data.root / 'combined_epa_pa', PATHS.data.tables / 'epa_pa_lookups',
+              PATHS.data.epa_pm25, PATHS.output / 'tables']:
+        p.mkdir(parents=True, exist_ok=True)
+    try:
+        yield root
+    finally:
+        PATHS.root, PATHS.data, PATHS.output = saved
+
+
+def write_sensor(s3_client, bucket: str, sensor_id: int, df, layout: str = 'partitioned'):
+    """Save wide sensor data to the bucket like thread_test does.
+
+    @param layout: 'partitioned' for weekly partitions with a manifest (see
+        s3_layout), 'flat' for one gzipped csv of the whole history
+    """
+    if len(df) == 0:  # e.g. a sensor that came online during an outage
+        return
+    if layout == 'flat':
+        body = s3_layout.gzip_bytes(df.to_csv(index=False).encode())
+        s3_client.put_object(Bucket=bucket, Key=f'{int(sensor_id):07d}.csv.gz', Body=body)
+    else:
+        entries = s3_layout.write_wide(s3_client, bucket, sensor_id, df)
+        s3_layout.write_manifest(s3_client, bucket, sensor_id, entries)
+
+
+def write_epa_site(df_epa, county: str, site: str, api_root: Path = None):
+    """Save a site's EPA hourly data where save_site() does, and for the fake AQS API if api_root is given."""
+    df_epa.to_csv(site_hourly_path(site, county), index=False)
+    if api_root is not None:
+        p = Path(api_root) / 'aqs' / f'county-{county}_site-{site}_hourly.csv'
+        p.parent.mkdir(parents=True, exist_ok=True)
+        df_epa.to_csv(p, index=False)
+
+
+def write_lookups(sites: pd.DataFrame):
+    """Save the site to sensor lookup tables download_15_test_sites() makes."""
+    lookup_dir = PATHS.data.tables / 'epa_pa_lookups'
+    sites = sites.copy()
+    sites['dist_order'] = sites.groupby(['county', 'site'])['dist_mile'].rank(method='max')
+    sites[['site', 'county', 'sensor_index', 'dist_mile', 'dist_order']].to_csv(
+        lookup_dir / 'aqs_monitors_to_pa_sensors.csv', index=False)
+    for (county, site), df in sites.groupby(['county', 'site']):
+        df.to_csv(lookup_dir / f'county-{county}_site-{site}_pa-list.csv',
+                  columns=['sensor_index', 'dist_mile'], index=False)
+
+
+def make_dataset(api_root: Path, n_sites: int = 150, n_sensors: int = 6000, seed: int = 0,
+                 date_start: str = '2016-01-01', years: int = 6, layout: str = 'partitioned',
+                 epa_missing: float = 0.02, epa_outages: float = 0.03, smoke: float = 0.01,
+                 pa_missing: float = 0.02, pa_outages: float = 0.1, disagree: float = 0.01,
+                 sensor_coverage: float = 0.5, no_data: float = 0.05):
+    """Write a synthetic dataset for the pipeline into PATHS and the fake API's directory.
+
+    Sensors come online at random times, so the PurpleAir data is sparse
+    early on like the real network's.
+    @param api_root: FakeAPIServer root directory (bucket and AQS data)
+    @param years: years of data starting at date_start, at least MIN_YEARS
+    @param layout: S3 layout of the sensor data, 'partitioned' or 'flat'
+    @param epa_missing, epa_outages: share of EPA hours missing at random / in outages
+    @param smoke: share of days in wildfire smoke events, flagged with qualifiers
+    @param pa_missing, pa_outages: share of sensor hours missing at random / in outages
+    @param disagree: share of sensor hours where the A and B channels disagree
+    @param sensor_coverage: mean share of the period a sensor has data for
+    @param no_data: share of sensors with no data in the bucket at all
+    @return: the site to sensor lookup
+    """
+    if years < MIN_YEARS:
+        raise ValueError(f'years must be at least {MIN_YEARS} for create_sample_dvs(), not {years}')
+    rng = np.random.default_rng(seed)
+    s3_client = LocalS3Client(api_root)
+    synthetic.QUALIFIERS.to_csv(PATHS.data.tables / 'aqs_qualifiers.csv', index=False)
+    sites = synthetic.make_sites(n_sites, n_sensors, rng)
+    write_lookups(sites)
+    times = synthetic.hourly_times(date_start, int(years * 365.25 * 24))
+    for i, ((county, site), sensor_list) in enumerate(sites.groupby(['county', 'site'])):
+        logger.info(f"Site {i + 1}/{n_sites} ({county}-{site}): {len(sensor_list)} sensors")
+        smoke_multiplier = synthetic.smoke_events(times, rng, smoke)
+        ambient = synthetic.ambient_pm(times, rng) * smoke_multiplier
+        df_epa = synthetic.epa_hourly_df(county, site, times, ambient, rng, missing=epa_missing,
+                                         outage_share=epa_outages, smoke=smoke_multiplier > 1)
+        write_epa_site(df_epa, county, site, api_root)
+        for sensor_id in sensor_list['sensor_index']:
+            if rng.random() < no_data:
+                continue
+            start = int(len(times) * (1 - min(1.0, rng.exponential(sensor_coverage))))
+            df = synthetic.wide_sensor_df(sensor_id, times[start:], ambient[start:], rng,
+                                          missing=pa_missing, outage_share=pa_outages,
+                                          disagree=disagree)
+            write_sensor(s3_client, AWS.bucket_name, sensor_id, df, layout)
+    return sites
+
+
+def download_epa_sites(n_sites: int):
+    """Replace the first n_sites sites' EPA hourly files with downloads from the (fake) AQS API.
+
+    @return: number of AQS requests made
+    """
+    lookup = pd.read_csv(PATHS.data.tables / 'epa_pa_lookups' / 'aqs_monitors_to_pa_sensors.csv',
+                         dtype={'site': str, 'county': str})
+    site_counties = list(lookup[['site', 'county']].drop_duplicates()
+                         .head(n_sites).itertuples(index=False, name=None))
+    years = set()
+    for site, county in site_counties:
+        p = site_hourly_path(site, county)
+        years |= set(pd.read_csv(p, usecols=['date_local'])['date_local'].str[:4])
+        p.unlink()
+    years = sorted(years)
+    for site, county in site_counties:
+        for year in years:
+            if site_year_path(site, county, year).exists():  # from a previous run on this root
+                site_year_path(site, county, year).unlink()
+    return download_sites(site_counties, years=years)
+
+
+def run_load_test(root: Path, n_sites: int = 150, n_sensors: int = 6000, latency: float = 0.0,
+                  error_rate: float = 0.0, make_data: bool = True, aqs_sites: int = 1, **kwargs):
+    """Run combine_15_sites() and create_sample_dvs() on synthetic data, offline.
+
+    @param root: scratch directory for the synthetic data, pipeline outputs and fake API
+    @param latency, error_rate: see FakeAPIServer
+    @param make_data: write a new dataset first; False reuses the one in root
+    @param aqs_sites: number of sites to download through the fake AQS API first
+        (see download_epa_sites())
+    @param kwargs: passed to make_dataset()
+    @return: TIMER report of the run
+    """
+    root = Path(root)
+    TIMER.reset()
+    with use_root(root), FakeAPIServer(root / 'fake_api', latency=latency, error_rate=error_rate) as server:
+        saved_environ = {k: os.environ.get(k) for k in server.environ()}
+        os.environ.update(server.environ())
+        try:
+            if make_data:
+                with TIMER.span('make_dataset', sites=n_sites, sensors=n_sensors):
+                    make_dataset(root / 'fake_api', n_sites, n_sensors, **kwargs)
+            if aqs_sites > 0:
+                with TIMER.span('download_epa_sites', sites=aqs_sites):
+                    download_epa_sites(aqs_sites)
+            with TIMER.span('combine_15_sites', sites=n_sites, sensors=n_sensors):
+                calculate_pm.combine_15_sites(run_all=True)
+            with TIMER.span('create_sample_dvs', sites=n_sites, sensors=n_sensors):
+                calculate_pm.create_sample_dvs()
+        finally:
+            for k, v in saved_environ.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+    report = TIMER.report()
+    logger.info(f"Load test of {n_sites} sites, {n_sensors} sensors:\n{report}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--root', type=Path, required=True, help="scratch directory")
+    parser.add_argument('--sites', type=int, default=150)
+    parser.add_argument('--sensors', type=int, default=6000)
+    parser.add_argument('--years', type=int, default=6, help=f"years of data, at least {MIN_YEARS}")
+    parser.add_argument('--layout', choices=['partitioned', 'flat'], default='partitioned')
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each fake API request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of S3 requests that get a 503")
+    parser.add_argument('--aqs-sites', type=int, default=1,
+                        help="sites to download through the fake AQS API (6 s per site-year)")
+    parser.add_argument('--reuse-data', action='store_true', help="don't write a new dataset")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.years < MIN_YEARS:
+        parser.error(f"--years must be at least {MIN_YEARS}, since create_sample_dvs() needs more than 12 quarters")
+    logging.basicConfig(level=logging.INFO)
+    print(run_load_test(args.root, args.sites, args.sensors, latency=args.latency,
+                        error_rate=args.error_rate, make_data=not args.reuse_data, aqs_sites=args.aqs_sites,
+                        years=args.years, layout=args.layout, seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
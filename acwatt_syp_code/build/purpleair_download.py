@@ -4,6 +4,8 @@
 
 # Built-in Imports
 import datetime as dt
+import gzip
+import io
 import os
 import logging
 import time
@@ -19,23 +21,33 @@ from multiprocessing.pool import ThreadPool
 from http.server import BaseHTTPRequestHandler
 
 # Third-party Imports
+import boto3
+from botocore.exceptions import ClientError
 from timezonefinder import TimezoneFinder
 
 # Local imports
 from ..utils.config import PATHS, PA, AWS
+from ..utils.timing import TIMER
 from ..analyze.maps import sensor_df_to_geo
+from ..utils.geo_cache import save_sensor_table, sensor_table_paths
 from ..build.aws.lambda_services import (
-    create_function,
+    ensure_function,
     run_function,
+    run_batch_function,
     teardown_aws_objects,
     setup_aws_objects
 )
 from ..build.aws.lambda_timing_test_script import thread_test
+from ..build.aws.work_queue import SQLiteWorkQueue, job_key, run_worker
+from ..build.aws import s3_layout
+from ..build.aws.s3_layout import read_wide_csv
 
 logger = logging.getLogger(__name__)
 SAVE_DIR = "/tmp/purple_air_data"
 WRITE_LOCK = threading.Lock()
 PRINT_LOCK = threading.Lock()
+TS_ROW_LIMIT = 8000  # max raw datapoints ThingSpeak will use for one request
+TS_MINUTES_PER_POINT = 2  # PurpleAir channels post a raw datapoint every 2 minutes
 
 # If retrieving data from multiple sensors at once, please send a single request
 # rather than individual requests in succession.
@@ -108,8 +120,9 @@ def generate_halfyear_list(sensor_id: int):
 def get_sensor_timezone(info):
     """Return timezone of sensor located at lat,lon decimal coordinates."""
     lat, lon = info['latitude'], info['longitude']
-    obj = TimezoneFinder()
-    timezone = obj.timezone_at(lng=lon, lat=lat)
+    with TIMER.span('timezone'):
+        obj = TimezoneFinder()
+        timezone = obj.timezone_at(lng=lon, lat=lat)
     return timezone
 
 
@@ -142,7 +155,8 @@ def pa_request_single_sensor(sensor_id):
              'pm2.5, primary_id_a, primary_key_a, secondary_id_a, secondary_key_a, ' \
              'primary_id_b, primary_key_b, secondary_id_b, secondary_key_b'
     query = {'api_key': api_key, 'fields': fields.replace(' ', '')}
-    response = requests.get(url, params=query)
+    with TIMER.span('metadata', sensor=int(sensor_id)):
+        response = requests.get(url, params=query)
     return response.json()
 
 
@@ -205,14 +219,78 @@ def dl_sensor_list_in_geography(extent: str='US',
 
 def make_data_dir():
     dir_ = SAVE_DIR
-    if not(os.path.isdir(dir_)):  # doesn't exist
-        os.mkdir(dir_)
+    os.makedirs(dir_, exist_ok=True)  # threads may create it at the same time
     return dir_
 
 
 ################################################################################
 # THINGSPEAK FUNCTIONS
 ################################################################################
+class AdaptiveWindow:
+    """Request window for one sensor that adapts to how much data the sensor has.
+
+    ThingSpeak only uses the most recent 8000 raw datapoints of a request, so
+    a fixed 7-day window (<=5040 2-min points) is safe for a sensor that
+    reports all the time. Sparse or intermittent sensors return far fewer rows
+    per week, so the window is widened until the estimated number of raw
+    datapoints approaches target_points, and narrowed again when a request
+    comes back close to the limit (the request is then repeated, since
+    ThingSpeak would have dropped the oldest part of the window).
+
+    Keep one instance per sensor; it carries the learned window size, the
+    number of windows requested for that sensor (4 channel requests each) and
+    the (start, end) windows that failed to download. A failed window says
+    nothing about the sensor's data density, so it doesn't resize the window.
+
+    @param days: starting window size in days
+    @param min_days: smallest window allowed
+    @param max_days: largest window allowed
+    @param target_points: number of raw datapoints to aim for in each request
+    @param max_growth: largest factor the window can grow by after one request
+    """
+    def __init__(self, days: float = 7, min_days: float = 1, max_days: float = 180,
+                 target_points: int = 6000, max_growth: float = 4):
+        self.days = days
+        self.min_days = min_days
+        self.max_days = max_days
+        self.target_points = target_points
+        self.max_growth = max_growth
+        self.requests = 0
+        self.failed = []
+
+    def __repr__(self):
+        return f'AdaptiveWindow(days={self.days:.2f}, requests={self.requests})'
+
+    def end_of(self, date_start):
+        """Return the end of the window starting at date_start."""
+        return date_start + dt.timedelta(days=self.days)
+
+    @staticmethod
+    def raw_points(rows: int, average: Optional[int] = None):
+        """Estimate the raw datapoints behind rows returned with the given average."""
+        if average is None:
+            return rows
+        return rows * average / TS_MINUTES_PER_POINT
+
+    def truncated(self, rows: int, average: Optional[int] = None):
+        """Return True if the request was close enough to the limit to have lost data."""
+        return (self.raw_points(rows, average) >= 0.95 * TS_ROW_LIMIT
+                and self.days > self.min_days)
+
+    def narrow(self):
+        """Halve the window after a truncated request."""
+        self.days = max(self.min_days, self.days / 2)
+
+    def update(self, rows: int, average: Optional[int] = None):
+        """Resize the window using the rows returned for the last request."""
+        points = self.raw_points(rows, average)
+        if points == 0:
+            factor = self.max_growth
+        else:
+            factor = min(self.max_growth, self.target_points / points)
+        self.days = min(self.max_days, max(self.min_days, self.days * factor))
+
+
 # @RateLimiter(max_calls=1, period=1)
 def ts_request(channel_id, start_date, api_key,
                end_date=None, average=None, timezone=None):
@@ -241,11 +319,13 @@ def ts_request(channel_id, start_date, api_key,
     status_code = 300
     wait_time = 0.5
     while status_code >= 300 and wait_time < 100:
-        response = requests.get(url, params=query_str)
+        with TIMER.span('thingspeak_request', channel=int(channel_id)):
+            response = requests.get(url, params=query_str)
         status_code = response.status_code
         m = f"Got status code {status_code} for TS channel {channel_id}. Waiting {wait_time}."
         if status_code >= 300: print_with_lock(m, PRINT_LOCK)
-        time.sleep(wait_time)
+        # The wait after a successful request keeps us under the rate limit
+        TIMER.sleep(wait_time, 'backoff' if status_code >= 300 else 'throttle')
         wait_time = wait_time*2
 
     if response.status_code >= 300:
@@ -282,19 +362,26 @@ def ts_example():
     return df
 
 
-def dl_sensor_week(sensor_info: dict, date_start: dt.datetime,
-                   average: int = 60, print_lock: threading.Lock = None):
-    """Download a week's (hourly) averages of data for sensor from all 4 channels.
+def dl_sensor_window(sensor_info: dict, date_start: dt.datetime, date_end: dt.datetime,
+                     average: int = 60, timezone: Optional[str] = None):
+    """Download (hourly) averages of data for sensor from all 4 channels between two dates.
 
     @param sensor_info: information about sensor
-    @param date_start: date to start downloading from, with the 6 days following
+    @param date_start: date to start downloading from
+    @param date_end: date to stop downloading at
     @param average: number of minutes to average over
+    @param timezone: timezone of the sensor (see get_sensor_timezone()). Looked
+        up from sensor_info if None.
+    @return (df, rows): dataframe of the channels that returned data (None if
+        none did) and the largest number of rows returned by a channel.
+        Raises ConnectionError if a channel can't be downloaded, so a failed
+        window isn't mistaken for an empty one.
     """
-    date_end = date_start + dt.timedelta(days=7)
-    timezone = get_sensor_timezone(sensor_info)
-    # with print_lock: print(date_start)
+    if timezone is None:
+        timezone = get_sensor_timezone(sensor_info)
 
     df_list = []
+    rows = 0
     # Iterate through the different channels of the device to get all the data
     for channel in ['a', 'b']:
         for type_ in ['primary', 'secondary']:
@@ -307,37 +394,100 @@ def dl_sensor_week(sensor_info: dict, date_start: dt.datetime,
                     df = ts_request(channel_id, date_start, api_key,
                                     end_date=date_end, average=average, timezone=timezone)
                     break
-                except ConnectionError or requests.exceptions.HTTPError:
+                except (ConnectionError, requests.exceptions.RequestException):
                     print(f'ts_request failed. Trying again. Previous errors = {errors}')
-                    time.sleep(0.1)
+                    TIMER.sleep(0.1, 'retry')
                     errors += 1
-            if errors == 5:
-                print(f'Reached maximum tries for channel {channel}, type {type_}, date {date_start} - {date_end}.')
-                print('Skipping')
-                continue
-            if df is not None:
-                if len(df) > 0:
-                    df.insert(loc=1, column='sensor_id', value=sensor_info['sensor_index'])
-                    df.insert(loc=2, column='channel', value=channel)
-                    df.insert(loc=3, column='subchannel_type', value=type_)
-                    # Drop any "unused" or "Unused" columns to prevent pd.concat error
-                    for col in set([col for col in df.columns if col.lower() == "unused"]):
-                        df = df.drop(col, axis=1)
-                    df_list.append(df)
-                else:  # if any of the channels are empty, the data isn't useful
-                    return None
-    if len(df_list) == 4:
+            if errors == 5 or df is None:
+                raise ConnectionError(f'Reached maximum tries for channel {channel}, '
+                                      f'type {type_}, date {date_start} - {date_end}.')
+            rows = max(rows, len(df))
+            # An empty channel doesn't make the other channels' data useless
+            if len(df) > 0:
+                df.insert(loc=1, column='sensor_id', value=sensor_info['sensor_index'])
+                df.insert(loc=2, column='channel', value=channel)
+                df.insert(loc=3, column='subchannel_type', value=type_)
+                # Drop any "unused" or "Unused" columns to prevent pd.concat error
+                for col in set([col for col in df.columns if col.lower() == "unused"]):
+                    df = df.drop(col, axis=1)
+                df_list.append(df)
+    if len(df_list) > 0:
         df2 = pd.concat(df_list, ignore_index=True)
-        return df2
+        return df2, rows
     else:
-        return None
+        return None, rows
+
+
+def dl_sensor_week(sensor_info: dict, date_start: dt.datetime,
+                   average: int = 60, print_lock: threading.Lock = None):
+    """Download a week's (hourly) averages of data for sensor from all 4 channels.
+
+    @param sensor_info: information about sensor
+    @param date_start: date to start downloading from, with the 6 days following
+    @param average: number of minutes to average over
+    @return: dataframe, None if there was no data. Raises ConnectionError if a
+        channel can't be downloaded.
+    """
+    date_end = date_start + dt.timedelta(days=7)
+    df, _ = dl_sensor_window(sensor_info, date_start, date_end, average=average)
+    return df
+
+
+def dl_sensor_range(sensor_info: dict, date_start: dt.datetime,
+                    date_final: Optional[dt.datetime] = None,
+                    average: Optional[int] = None,
+                    window: Optional[AdaptiveWindow] = None):
+    """Download all data for sensor from date_start to date_final, one window at a time.
+
+    @param sensor_info: information about sensor (see pa_request_single_sensor())
+    @param date_start: date to start downloading from (sensor's local time)
+    @param date_final: date to stop downloading at, defaults to now
+    @param average: number of minutes to average over, defaults to 60
+    @param window: AdaptiveWindow for this sensor, a new one is used if None.
+        Windows that fail to download are skipped and added to window.failed.
+    @return: dataframe of concatenated windows, None if there was no data
+    """
+    if average is None:
+        average = 60
+    if window is None:
+        window = AdaptiveWindow()
+    if date_final is None:
+        date_final = dt.datetime.today()
+    date_start, date_final = pd.Timestamp(date_start), pd.Timestamp(date_final)
+    timezone = get_sensor_timezone(sensor_info)
+    df_list = []
+    while date_start < date_final:
+        date_end = min(window.end_of(date_start), date_final)
+        window.requests += 1
+        try:
+            df_window, rows = dl_sensor_window(sensor_info, date_start, date_end,
+                                               average=average, timezone=timezone)
+        except ConnectionError as error:
+            logger.warning(f"{sensor_info['sensor_index']}: {error} Skipping the window.")
+            window.failed.append((date_start, date_end))
+            date_start = date_end
+            continue
+        # Too close to the row limit: ThingSpeak dropped the start of the window
+        if window.truncated(rows, average):
+            window.narrow()
+            continue
+        window.update(rows, average)
+        if df_window is not None:
+            df_list.append(df_window)
+        date_start = date_end
+
+    if len(df_list) > 0:
+        with TIMER.span('concat'):
+            return pd.concat(df_list, ignore_index=True)
+    return None
 
 
 def dl_sensor_weeks(sensor_id: Union[str, int, float],
                     print_lock: threading.Lock,
                     date_start: Optional[str] = None,
-                    average: Optional[int] = None):
-    """Download all data for PurpleAir sensor, one week at a time, then concatenate.
+                    average: Optional[int] = None,
+                    window: Optional[AdaptiveWindow] = None):
+    """Download all data for PurpleAir sensor, one window at a time, then concatenate.
 
     The API works by calling all raw datapoints in a date window, then calculating
     any averages we ask for. ThingsSpeak also has a rate limit of 1 call per second
@@ -350,14 +500,18 @@ def dl_sensor_weeks(sensor_id: Union[str, int, float],
     so I still must limit calls to 1 week even when asking for averages.
     Note that ts_requst() is decorated by a RateLimiter that prevents it from
     being called more than once per second.
+    Sparse or intermittent sensors have far fewer than 5040 datapoints in a
+    week, so the window starts at 1 week and is resized after every request
+    by an AdaptiveWindow (wider when few rows come back, narrower near the
+    8000-row limit).
 
     Flow of script:
     1. Get metadata about sensor from PurpleAir API
     2. Use location of sensor from (1) to get timezone of sensor
-    3. Generate a list of Sunday dates to download the weeks for
-    4a. Iterate through the Sundays,
+    3. Start at the first Sunday to download
+    4a. Iterate through windows until today, resizing the window after each one
     4b. Iterate through the 4 channels (a-primary, a-secondary, b-primary, b-secondary)
-    4c. Download one week of data from each channel and add to dataframe
+    4c. Download one window of data from each channel and add to dataframe
     4d. Add some metadata about the sensor and channel to the dataframe
     4e. Add dataframe to list of dataframes
     5. Concatenate all dataframes into one large dataframe
@@ -379,35 +533,34 @@ def dl_sensor_weeks(sensor_id: Union[str, int, float],
                             downloaded (only including full Sun-Sat weeks)
     :param average: str: Get average of this many minutes,
                     valid values: 10, 15, 20, 30, 60, 240, 720, 1440 (this is daily)
+    :param window: AdaptiveWindow: window state for this sensor. A new one
+                   (starting at 7 days) is used if omitted.
     :return: pandas.DataFrame: concatenated data from sensors
     """
     # todo: use info['latitude'], lon, to update dataframe of sensor
     #       see load_current_sensor_data() and update_loc_lookup()
-    sensor_info = pa_request_single_sensor(sensor_id)['sensor']
-    week_starts = generate_weeks_list(sensor_info, date_start=date_start)
-    # Time how long the downloading takes
-    time1 = dt.datetime.now()
-    df_list = []
-    logging.debug(f'\nDownloading all weeks for sensor {sensor_id} ===================')
-    for start_date in week_starts:
-        df_week = dl_sensor_week(sensor_info, start_date, print_lock=print_lock)
-        if df_week is None:
-            continue
+    if window is None:
+        window = AdaptiveWindow()
+    with TIMER.span('sensor', sensor=int(sensor_id)):
+        sensor_info = pa_request_single_sensor(sensor_id)['sensor']
+        week_starts = generate_weeks_list(sensor_info, date_start=date_start)
+        # Time how long the downloading takes
+        time1 = dt.datetime.now()
+        logging.debug(f'\nDownloading all windows for sensor {sensor_id} ===================')
+        if len(week_starts) > 0:
+            df = dl_sensor_range(sensor_info, week_starts[0], average=average, window=window)
         else:
-            df_list.append(df_week)
-
-    if len(df_list) > 0:
-        df = pd.concat(df_list, ignore_index=True)
-    else:
-        df = None
-    time_taken = dt.datetime.now() - time1
+            df = None
+        time_taken = dt.datetime.now() - time1
     with print_lock:
-        print(f'{sensor_id :07d} total time: {time_taken}')
+        print(f'{sensor_id :07d} total time: {time_taken} ({window.requests} windows, '
+              f'{len(window.failed)} failed)')
     return df, time_taken
 
 
 def save_success(sensor_id, time_taken):
     filepath = PATHS.data.purpleair / 'sensors_downloaded.csv'
+    filepath.parent.mkdir(parents=True, exist_ok=True)
     df = pd.DataFrame({'sensor_id': sensor_id, 'time_taken': time_taken},
                       index=[sensor_id])
     try:
@@ -431,7 +584,7 @@ def dl_sensor(sensor_id, write_lock, print_lock):
     print_with_lock(f'Starting sensor {sensor_id}', print_lock)
     df, time_taken = dl_sensor_weeks(sensor_id, print_lock)
     df = df.sort_values(by=['created_at', 'sensor_id', 'channel', 'subchannel_type'])
-    filepath = f'{SAVE_DIR}/{sensor_id:07d}.csv'
+    filepath = f'{make_data_dir()}/{sensor_id:07d}.csv'
     df.to_csv(filepath, index=False)
     # Sensor done, write success to file
     save_success(sensor_id, time_taken)
@@ -441,10 +594,377 @@ def dl_sensors(sensor_list, write_lock, print_lock, i: int = None):
     """Save data for each sensor to local CSV"""
     for sensor_id in sensor_list:
         dl_sensor(sensor_id, write_lock, print_lock)
+    save_timings()
+
+
+def save_timings():
+    """Append the recorded spans to timings.jsonl, write timings.prom (OpenMetrics) and print a summary."""
+    TIMER.to_jsonl(PATHS.data.purpleair / 'timings.jsonl')
+    TIMER.to_openmetrics(PATHS.data.purpleair / 'timings.prom')
+    print(TIMER.report())
+    TIMER.reset()
+
+
+################################################################################
+# INCREMENTAL REFRESH
+################################################################################
+def get_s3_client():
+    return boto3.client('s3',
+                        region_name=AWS.region,
+                        aws_access_key_id=AWS.access_key,
+                        aws_secret_access_key=AWS.secret_key)
+
+
+def get_sensor_object(s3_client, sensor_id: int):
+    """Return (key, S3 object) of sensor's stored data, preferring gzipped CSV; (None, None) if none."""
+    for key in [f'{sensor_id:07d}.csv.gz', f'{sensor_id:07d}.csv']:
+        try:
+            return key, s3_client.get_object(Bucket=AWS.bucket_name, Key=key)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'NoSuchKey':
+                raise
+    return None, None
+
+
+def compression_of(key: str):
+    return 'gzip' if key.endswith('.gz') else None
+
+
+def widen_sensor_df(df):
+    """Return sensor data with primary and secondary subchannels side by side.
+
+    This is the layout thread_test() saves to S3: one row per hour and channel,
+    two header rows (field, subchannel_type).
+    """
+    index = ['created_at', 'channel', 'sensor_id']
+    values = [col for col in df.columns if col not in index + ['subchannel_type']]
+    df = df.copy()
+    df[values] = df[values].apply(pd.to_numeric, errors='coerce')
+    df = df.pivot_table(index=index, columns='subchannel_type', values=values).reset_index()
+    df = df.dropna(subset=[('PM2.5 (CF=1)', 'primary'), ('2.5um', 'secondary')])
+    return df
+
+
+def read_stored_created_at(sensor_id: int, storage: str = 'local'):
+    """Return the created_at column stored for sensor (UTC), None if nothing is stored.
+
+    @param sensor_id: PurpleAir sensor ID
+    @param storage: 'local' to look in SAVE_DIR (written by dl_sensor()), or
+        's3' to look in the AWS bucket (written by thread_test())
+    """
+    filename = f'{sensor_id:07d}.csv'
+    if storage == 'local':
+        filepath = Path(SAVE_DIR) / filename
+        if not filepath.exists():
+            return None
+        created = pd.read_csv(filepath, usecols=['created_at'])['created_at']
+    elif storage == 's3':
+        s3_client = get_s3_client()
+        df = s3_layout.read_sensor(s3_client, AWS.bucket_name, sensor_id)
+        if df is not None:
+            return pd.to_datetime(df[s3_layout.CREATED], utc=True)
+        key, obj = get_sensor_object(s3_client, sensor_id)
+        if obj is None:
+            return None
+        # created_at is the first column, below the two header rows
+        created = pd.read_csv(io.BytesIO(obj['Body'].read()), header=None, skiprows=2, usecols=[0],
+                              compression=compression_of(key))[0]
+    else:
+        raise ValueError(f'storage must be "local" or "s3", not {storage}')
+    if len(created) == 0:
+        return None
+    return pd.to_datetime(created, utc=True)
+
+
+def last_stored_timestamp(sensor_id: int, storage: str = 'local'):
+    """Return the latest created_at stored for sensor (UTC), None if nothing is stored."""
+    if storage == 's3':
+        manifest = s3_layout.read_manifest(get_s3_client(), AWS.bucket_name, sensor_id)
+        if manifest is not None:
+            return pd.to_datetime(manifest['last'], utc=True)
+    created = read_stored_created_at(sensor_id, storage=storage)
+    if created is None:
+        return None
+    return created.max()
+
+
+def save_refreshed(df_new, sensor_id: int, storage: str = 'local'):
+    """Append newly downloaded sensor data to what is already stored, dropping repeated hours."""
+    filename = f'{sensor_id:07d}.csv'
+    if storage == 'local':
+        filepath = Path(make_data_dir()) / filename
+        if filepath.exists():
+            df_new = pd.concat([pd.read_csv(filepath), df_new], ignore_index=True)
+        df_new = (df_new
+                  .drop_duplicates(['created_at', 'channel', 'subchannel_type'], keep='last')
+                  .sort_values(by=['created_at', 'sensor_id', 'channel', 'subchannel_type']))
+        df_new.to_csv(filepath, index=False)
+    else:
+        s3_client = get_s3_client()
+        df_new = widen_sensor_df(df_new)
+        # Update the data in the layout it is stored in; new sensors are partitioned
+        manifest = s3_layout.read_manifest(s3_client, AWS.bucket_name, sensor_id)
+        key, obj = (None, None) if manifest is not None else get_sensor_object(s3_client, sensor_id)
+        if obj is None:
+            with TIMER.span('s3_upload', sensor=sensor_id):
+                entries = s3_layout.write_wide(s3_client, AWS.bucket_name, sensor_id, df_new)
+                s3_layout.write_manifest(s3_client, AWS.bucket_name, sensor_id, entries)
+            return
+        df_old = read_wide_csv(io.BytesIO(obj['Body'].read()), compression=compression_of(key))
+        df_new = pd.concat([df_old, df_new], ignore_index=True)
+        df_new = (df_new
+                  .drop_duplicates([('created_at', ''), ('channel', '')], keep='last')
+                  .sort_values(by=[('created_at', ''), ('channel', '')]))
+        body = df_new.to_csv(index=False).encode()
+        if compression_of(key) == 'gzip':
+            body = gzip.compress(body)
+        with TIMER.span('s3_upload', sensor=sensor_id):
+            s3_client.put_object(Bucket=AWS.bucket_name, Key=key, Body=body)
+
+
+def refresh_sensor(sensor_id: int, storage: str = 'local', average: int = 60,
+                   print_lock: threading.Lock = PRINT_LOCK):
+    """Download only the data a sensor has reported since it was last stored.
+
+    The last stored timestamp is compared with the sensor's last_seen from the
+    PurpleAir API. Sensors with nothing new are skipped; sensors with nothing
+    stored get their full history (as in dl_sensor_weeks()).
+
+    @param sensor_id: PurpleAir sensor ID
+    @param storage: 'local' or 's3', see last_stored_timestamp()
+    @param average: number of minutes to average over
+    @param print_lock: thread lock to prevent multiple threads from printing on
+                       the same line.
+    @return: dict with sensor_id, status ('skipped', 'empty', 'refreshed') and
+        number of rows added
+    """
+    sensor_id = int(sensor_id)
+    sensor_info = pa_request_single_sensor(sensor_id)['sensor']
+    last_seen = pd.Timestamp(sensor_info['last_seen'], unit='s', tz='UTC')
+    last_stored = last_stored_timestamp(sensor_id, storage=storage)
+    result = {'sensor_id': sensor_id, 'status': 'skipped', 'rows_added': 0,
+              'last_stored': last_stored, 'last_seen': last_seen}
+
+    if last_stored is None:
+        week_starts = generate_weeks_list(sensor_info)
+        if len(week_starts) == 0:
+            return result
+        date_start = week_starts[0]
+    elif last_seen < last_stored + dt.timedelta(minutes=average):
+        print_with_lock(f'{sensor_id :07d} up to date ({last_stored}), skipping', print_lock)
+        return result
+    else:
+        # Start after the last stored average, in the sensor's local time
+        timezone = get_sensor_timezone(sensor_info)
+        date_start = (last_stored + dt.timedelta(minutes=average)).tz_convert(timezone).tz_localize(None)
+
+    print_with_lock(f'{sensor_id :07d} refreshing from {date_start}', print_lock)
+    df = dl_sensor_range(sensor_info, date_start, average=average)
+    if df is None:
+        result['status'] = 'empty'
+        return result
+    save_refreshed(df, sensor_id, storage=storage)
+    result.update({'status': 'refreshed', 'rows_added': len(df)})
+    return result
+
+
+def refresh_sensors(sensor_list, storage: str = 'local', max_threads: int = 2):
+    """Refresh each sensor in sensor_list, see refresh_sensor(); return dataframe of results."""
+    if storage == 'local':
+        make_data_dir()
+    pool = ThreadPool(processes=max_threads)
+    results = [pool.apply_async(refresh_sensor, (sensor_id, storage)) for sensor_id in sensor_list]
+    pool.close()  # Done adding tasks.
+    pool.join()  # Wait for all tasks to complete.
+    df = pd.DataFrame([result.get() for result in results])
+    logger.info(f"Refreshed {sum(df.status == 'refreshed')} sensors, "
+                f"skipped {sum(df.status == 'skipped')} up-to-date sensors.")
+    return df
+
+
+################################################################################
+# GAP BACKFILL
+################################################################################
+def save_empty_windows(sensor_id: int, windows):
+    """Record backfill windows that ThingSpeak returned no data for, so they aren't planned again."""
+    if not windows:
+        return
+    filepath = PATHS.data.purpleair / 'empty_windows.csv'
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    df = pd.DataFrame({'sensor_id': int(sensor_id),
+                       'start': [start for start, _ in windows],
+                       'end': [end for _, end in windows]})
+    with WRITE_LOCK:
+        df.to_csv(filepath, mode='a', index=False, header=not filepath.exists())
+
+
+def read_empty_windows(sensor_id: int):
+    """Return list of (start, end) windows (UTC) recorded as empty for sensor."""
+    filepath = PATHS.data.purpleair / 'empty_windows.csv'
+    if not filepath.exists():
+        return []
+    with WRITE_LOCK:
+        df = pd.read_csv(filepath)
+    df = df[df.sensor_id == int(sensor_id)]
+    return list(zip(pd.to_datetime(df.start, utc=True), pd.to_datetime(df.end, utc=True)))
+
+
+def find_missing_hours(sensor_info: dict, created=None, empty_windows=None):
+    """Return the hours (UTC) in the sensor's active period that have no stored data.
+
+    @param sensor_info: information about sensor (see pa_request_single_sensor())
+    @param created: stored created_at timestamps (see read_stored_created_at()),
+        None if nothing is stored
+    @param empty_windows: (start, end) windows already requested that came back
+        empty (see read_empty_windows()); their hours aren't missing, just absent
+    """
+    active_start = pd.Timestamp(sensor_info['date_created'], unit='s', tz='UTC').ceil('h')
+    active_end = pd.Timestamp(sensor_info['last_seen'], unit='s', tz='UTC').floor('h')
+    missing = pd.date_range(active_start, active_end, freq='h')
+    if created is not None:
+        missing = missing.difference(pd.DatetimeIndex(created.dt.floor('h').unique()))
+    for start, end in empty_windows or []:
+        missing = missing[(missing < start) | (missing >= end)]
+    return missing
+
+
+def hours_to_ranges(hours: pd.DatetimeIndex):
+    """Return list of (start, end) ranges of consecutive hours; end is exclusive."""
+    if len(hours) == 0:
+        return []
+    hours = hours.sort_values()
+    offsets = np.asarray((hours - hours[0]) // pd.Timedelta(hours=1))
+    breaks = np.flatnonzero(np.diff(offsets) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(hours)]]) - 1
+    return [(hours[i], hours[j] + dt.timedelta(hours=1)) for i, j in zip(starts, ends)]
+
+
+def plan_request_windows(hours: pd.DatetimeIndex, max_days: float = 7):
+    """Return the fewest windows of at most max_days that cover all missing hours.
+
+    Greedy from the earliest missing hour: each window starts at the first
+    uncovered hour and ends just after the last missing hour it can reach, so
+    stored hours between nearby gaps are downloaded again rather than paying
+    for another request. Gaps longer than max_days are split.
+    """
+    if len(hours) == 0:
+        return []
+    hours = hours.sort_values()
+    offsets = np.asarray((hours - hours[0]) // pd.Timedelta(hours=1))
+    length = int(max_days * 24)
+    windows, i = [], 0
+    while i < len(offsets):
+        j = np.searchsorted(offsets, offsets[i] + length, side='left')
+        windows.append((hours[i], hours[j - 1] + dt.timedelta(hours=1)))
+        i = j
+    return windows
+
+
+def split_windows(windows, days: float):
+    """Return the windows split into the pieces of at most days that dl_sensor_range() requests."""
+    step = dt.timedelta(days=days)
+    pieces = []
+    for start, end in windows:
+        while start < end:
+            pieces.append((start, min(start + step, end)))
+            start = start + step
+    return pieces
+
+
+def plan_backfill(sensor_id: int, storage: str = 'local', max_days: float = 7,
+                  sensor_info: Optional[dict] = None):
+    """Return the backfill plan for a sensor: missing hours, gaps and request windows.
+
+    The windows are at most max_days long. dl_sensor_range() starts each one
+    with an AdaptiveWindow of 7 days, so windows longer than that are split
+    into several requests; the estimate counts 4 channel requests per piece
+    (an upper bound, since the window widens for sparse sensors). Windows
+    recorded as empty by an earlier backfill aren't planned again.
+    """
+    sensor_id = int(sensor_id)
+    if sensor_info is None:
+        sensor_info = pa_request_single_sensor(sensor_id)['sensor']
+    created = read_stored_created_at(sensor_id, storage=storage)
+    missing = find_missing_hours(sensor_info, created, read_empty_windows(sensor_id))
+    windows = plan_request_windows(missing, max_days=max_days)
+    return {'sensor_id': sensor_id,
+            'sensor_info': sensor_info,
+            'missing_hours': len(missing),
+            'gaps': len(hours_to_ranges(missing)),
+            'windows': windows,
+            'estimated_requests': 4 * len(split_windows(windows, AdaptiveWindow().days))}
+
+
+def backfill_sensor(plan: dict, storage: str = 'local', average: int = 60):
+    """Download the request windows in a plan from plan_backfill() and merge them into storage.
+
+    Windows where every channel came back with no rows are recorded as empty
+    (see save_empty_windows()). Windows that failed to download aren't, so
+    the next backfill plans them again.
+    @return: dict of # of rows added, empty windows and failed windows
+    """
+    sensor_info = plan['sensor_info']
+    timezone = get_sensor_timezone(sensor_info)
+    window = AdaptiveWindow()
+    df_list, empty, failed = [], [], []
+    for window_start, window_end in plan['windows']:
+        # ThingSpeak reads start and end in the sensor's local time
+        df = dl_sensor_range(sensor_info,
+                             window_start.tz_convert(timezone).tz_localize(None),
+                             window_end.tz_convert(timezone).tz_localize(None),
+                             average=average, window=window)
+        window_failed, window.failed = len(window.failed) > 0, []
+        if window_failed:
+            failed.append((window_start, window_end))
+        if df is not None:
+            df_list.append(df)
+        elif not window_failed:
+            empty.append((window_start, window_end))
+    save_empty_windows(plan['sensor_id'], empty)
+    if failed:
+        logger.warning(f"{plan['sensor_id']}: {len(failed)} backfill windows failed, "
+                       f"they will be retried next time: {failed}")
+    result = {'rows_added': 0, 'empty_windows': len(empty), 'failed_windows': len(failed)}
+    if df_list:
+        df = pd.concat(df_list, ignore_index=True)
+        save_refreshed(df, plan['sensor_id'], storage=storage)
+        result['rows_added'] = len(df)
+    return result
+
+
+def backfill_sensors(sensor_list, storage: str = 'local', max_days: float = 7,
+                     dry_run: bool = False):
+    """Plan and fill the gaps in stored data for each sensor in sensor_list.
+
+    The plan (gaps, windows and estimated ThingSpeak requests per sensor) is
+    logged before anything is downloaded. Use dry_run=True to only plan.
+    @return: dataframe with one row of plan summary per sensor, and the rows
+        added and windows that were empty or failed (see backfill_sensor())
+    """
+    plans = [plan_backfill(sensor_id, storage=storage, max_days=max_days)
+             for sensor_id in sensor_list]
+    df = pd.DataFrame([{'sensor_id': plan['sensor_id'],
+                        'missing_hours': plan['missing_hours'],
+                        'gaps': plan['gaps'],
+                        'windows': len(plan['windows']),
+                        'estimated_requests': plan['estimated_requests']} for plan in plans])
+    logger.info(f"Backfill plan: {df.missing_hours.sum()} missing hours in {df.gaps.sum()} gaps, "
+                f"{df.windows.sum()} windows, ~{df.estimated_requests.sum()} ThingSpeak requests.")
+    print(df.to_string(index=False))
+    if dry_run:
+        return df
+    if storage == 'local':
+        make_data_dir()
+    results = pd.DataFrame([backfill_sensor(plan, storage=storage) for plan in plans])
+    df = pd.concat([df, results], axis=1)
+    if df.failed_windows.sum() > 0:
+        logger.warning(f"{df.failed_windows.sum()} windows failed to download; run the backfill again to retry them.")
+    return df
 
 
 def save_sensor_list(geography, download_oldest_first=True):
-    fp = PATHS.data.temp / 'sensors_filtered.csv'
+    fp, _ = sensor_table_paths()
     if fp.exists():
         print(f'Loading sensor list from {fp}')
         df = pd.read_csv(fp)
@@ -454,6 +974,7 @@ def save_sensor_list(geography, download_oldest_first=True):
         print("# of US Purple Air sensors:", len(gdf))
         gdf = filter_data(gdf)
         gdf.to_csv(fp, index=False)
+        save_sensor_table(gdf)  # binary copy for load_sensor_table()
         df = pd.read_csv(fp)
         print("# of US Purple Air sensors after filtering:", len(df))
     # Sort so oldest are downloaded first
@@ -463,26 +984,49 @@ def save_sensor_list(geography, download_oldest_first=True):
     return df
 
 
-def save_sensors_to_s3(sensor_df, max_threads: int = 2, time_between_lambdas: float = 1.0):
+def save_sensors_to_s3(sensor_df, max_threads: int = 2, time_between_lambdas: float = 1.0,
+                       batch_size: int = None, weeks_per_unit: int = None,
+                       local: bool = False, teardown: bool = False, queue=None):
     """Create and use a lambda function to save Purple Air data to S3 bucket.
 
     @param sensor_df: pandas dataframe of Purple Air sensors to download data for.
     @param max_threads: max # of lambda function uses to run at the same time.
                         # between 1 and 1000
     @param time_between_lambdas: time to sleep between launching lambda functions
+    @param batch_size: if given, send this many work units to each invocation
+        of the batch handler instead of one sensor per invocation
+    @param weeks_per_unit: weeks of data in each work unit, see make_work_units()
+    @param local: run the lambda handler in local processes instead of AWS Lambda
+    @param teardown: delete the function and IAM role when done. By default they
+        are kept, and the next run reuses them if the code hasn't changed.
+    @param queue: SQLiteWorkQueue or SQSWorkQueue; if given, sensor-weeks are
+        added to the queue and max_threads workers pull batch_size jobs at a
+        time from it. Rerunning with the same queue picks up where it stopped.
     """
     # Setup AWS objects
     lambda_function_filename = 'lambda_download_script.py'
     lambda_function_filename = 'lambda_timing_test_script.py'
     lambda_role_name = 'demo-lambda-role-S3-ip-upload'
-    aws_objects = setup_aws_objects(lambda_function_filename, lambda_role_name)
+    aws_objects = setup_aws_objects(lambda_function_filename, lambda_role_name,
+                                    local=local, local_concurrency=max_threads)
     aws_objects['lambda_handler_name'] = 'lambda_download_script.lambda_ip_s3_writer'
     aws_objects['lambda_handler_name'] = 'lambda_timing_test_script.thread_test'
+    if batch_size is not None or queue is not None:
+        aws_objects['lambda_handler_name'] = 'lambda_timing_test_script.batch_handler'
     # Create lambda function
     lambda_function_name = f'PA_download'
     lambda_function_name = f'time_test_function'
     try:
-        create_function(lambda_function_name, aws_objects, concurrency=max_threads+50)
+        ensure_function(lambda_function_name, aws_objects, concurrency=max_threads+50)
+        if queue is not None:
+            queue_sensor_weeks(sensor_df, queue)
+            return process_queue(queue, lambda_function_name, aws_objects,
+                                 workers=max_threads, batch_size=batch_size or 10)
+        if batch_size is not None:
+            units = make_work_units(sensor_df, weeks_per_unit=weeks_per_unit)
+            return process_sensor_batches(units, lambda_function_name, aws_objects,
+                                          batch_size=batch_size, max_threads=max_threads,
+                                          time_between_lambdas=time_between_lambdas)
         # Apply function to each sensor, with max_threads functions running simultaneously
         results = process_sensors(sensor_df, lambda_function_name, aws_objects,
                                   max_threads=max_threads,
@@ -495,7 +1039,9 @@ def save_sensors_to_s3(sensor_df, max_threads: int = 2, time_between_lambdas: fl
                 pass
     # Delete all roles and functions
     finally:
-        teardown_aws_objects(aws_objects, [lambda_function_name])
+        save_timings()
+        if teardown or local:
+            teardown_aws_objects(aws_objects, [lambda_function_name])
 
 
 def process_sensors(df, function_name, aws_objects,
@@ -520,6 +1066,123 @@ def process_sensors(df, function_name, aws_objects,
     return results
 
 
+def make_work_units(df, weeks_per_unit: int = None):
+    """Return list of (sensor, week-range) work units for the lambda batch handler.
+
+    @param df: dataframe of sensors with column sensor_index
+    @param weeks_per_unit: split each sensor's history into ranges of this many
+        weeks, so long-lived sensors don't dominate a batch. Ranges start on
+        Sundays, like the S3 partitions, so two units never write the same
+        partition. If None, each sensor's full history is one unit (saved as
+        {sensor_id}.csv).
+    """
+    units = []
+    for sensor_id in df.sensor_index:
+        sensor_info = pa_request_single_sensor(sensor_id)['sensor']
+        unit = {'sensor_id': int(sensor_id),
+                'timezone': get_sensor_timezone(sensor_info)}
+        if weeks_per_unit is None:
+            units.append(unit)
+            continue
+        date_start = s3_layout.sunday_of(dt.datetime.utcfromtimestamp(sensor_info['date_created'])).date()
+        date_final = dt.datetime.utcfromtimestamp(sensor_info['last_seen']).date() + dt.timedelta(days=1)
+        step = dt.timedelta(weeks=weeks_per_unit)
+        while date_start < date_final:
+            date_end = min(date_start + step, date_final)
+            units.append(dict(unit, date_start=date_start.strftime('%Y-%m-%d'),
+                              date_end=date_end.strftime('%Y-%m-%d')))
+            date_start = date_end
+    logger.info(f"Made {len(units)} work units for {len(df)} sensors.")
+    return units
+
+
+def process_sensor_batches(units, function_name, aws_objects, batch_size: int = 20,
+                           max_threads: int = 2, time_between_lambdas: float = 1.0):
+    """Send work units to the lambda batch handler, batch_size units per invocation.
+
+    @param units: list of work units from make_work_units()
+    @param batch_size: number of work units per lambda invocation
+    @param max_threads: max # of lambda invocations running at the same time
+    @return: dataframe with one row of results for each work unit
+    """
+    pool = ThreadPool(processes=max_threads)
+    results = []
+    lambda_params = {'bucket_name': AWS.bucket_name,
+                     'PA_api_key': PA.read_key,
+                     'max_threads': 4}
+    logger.info(f"Processing {len(units)} work units in batches of {batch_size}.")
+    for i in range(0, len(units), batch_size):
+        params = dict(lambda_params, work_units=units[i:i + batch_size])
+        results.append(pool.apply_async(run_batch_function, (function_name, aws_objects, params)))
+        time.sleep(time_between_lambdas)
+
+    pool.close()  # Done adding tasks.
+    pool.join()  # Wait for all tasks to complete.
+    return pd.DataFrame([r for result in results for r in result.get()])
+
+
+def queue_sensor_weeks(sensor_df, queue=None):
+    """Add a job for each week of each sensor's history to the work queue.
+
+    Weeks already in the queue (done or not) aren't added again, and neither
+    are weeks with a finished result in work_units_downloaded.csv (an SQS
+    queue only remembers jobs for 5 minutes).
+    @return: the queue
+    """
+    queue = queue if queue is not None else SQLiteWorkQueue()
+    done = completed_work_units()
+    units = [unit for unit in make_work_units(sensor_df, weeks_per_unit=1) if job_key(unit) not in done]
+    added = queue.enqueue(units)
+    print(f"Added {added} sensor-week jobs to the queue: {queue.counts()}")
+    return queue
+
+
+def completed_work_units():
+    """Return set of job keys (see work_queue.job_key()) of work units saved as uploaded or empty."""
+    filepath = PATHS.data.purpleair / 'work_units_downloaded.csv'
+    if not filepath.exists():
+        return set()
+    df = pd.read_csv(filepath, dtype={'date_start': str, 'date_end': str},
+                     usecols=['sensor_id', 'date_start', 'date_end', 'status'])
+    df = df[df.status.isin(['uploaded', 'empty'])].astype(object).where(lambda x: x.notna(), None)
+    return {job_key(row) for row in df.to_dict('records')}
+
+
+def process_queue(queue, function_name, aws_objects, workers: int = 2, batch_size: int = 10,
+                  resume: bool = True):
+    """Run workers that pull sensor-week jobs from queue and send them to the lambda batch handler.
+
+    @param workers: # of workers (lambda invocations running at the same time)
+    @param batch_size: # of jobs sent to each lambda invocation
+    @param resume: release jobs a previous (crashed) run left hidden in a local
+        SQLiteWorkQueue, so they're retried now. Set False if other workers are
+        using the same queue file.
+    @return: dict of # of jobs in each status when the workers are done
+    """
+    if resume and isinstance(queue, SQLiteWorkQueue):
+        released = queue.release()
+        if released:
+            logger.info(f"Released {released} jobs left in flight by a previous run")
+    lambda_params = {'bucket_name': AWS.bucket_name,
+                     'PA_api_key': PA.read_key,
+                     'max_threads': 4}
+
+    def handle_jobs(units):
+        results = run_batch_function(function_name, aws_objects, dict(lambda_params, work_units=units))
+        return [None if r['status'] in ('uploaded', 'empty') else r.get('error', r['status'])
+                for r in results]
+
+    pool = ThreadPool(processes=workers)
+    results = [pool.apply_async(run_worker, (queue, handle_jobs, batch_size)) for _ in range(workers)]
+    pool.close()
+    pool.join()
+    for result in results:
+        print_with_lock(f"Worker finished: {result.get()}", PRINT_LOCK)
+    counts = queue.counts()
+    logger.info(f"Work queue: {counts}")
+    return counts
+
+
 def test_lambda():
     logger.info('testing lambda function code thread_test()')
     params = {'max_threads': 10,
@@ -602,6 +1265,7 @@ def update_loc_lookup(df, output=False):
 
 
 if __name__ == "__main__":
+    PATHS.data.make_directories()
     """
     sensor_df = load_current_sensor_data()
     sensor_df2 = pd.concat([sensorid_to_df(id) for id in sensor_df.index[:21]])
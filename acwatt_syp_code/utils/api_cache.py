@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Persistent cache of API responses, so reruns don't request data that can't change."""
+
+# Built-in Imports
+import datetime as dt
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+# Third-party Imports
+import requests
+from ratelimiter import RateLimiter
+# Local Imports
+from .config import PATHS, EPA
+
+logger = logging.getLogger(__name__)
+AQS_URL = 'https://aqs.epa.gov/data/api'
+CREDENTIAL_PARAMS = ['email', 'key', 'api_key']
+
+
+class ResponseCache:
+    """JSON responses saved to disk, keyed by endpoint and request parameters.
+
+    Responses for closed periods (e.g. a past year) never expire. Responses that
+    can still change are reused for ttl seconds.
+
+    @param cache_dir: directory to save responses in
+    @param ttl: seconds before responses for open periods expire, None to never expire
+    @param base_url: API the responses come from, part of the key so responses
+        of another server (e.g. utils.fake_api) are never mixed in. None for
+        the default API.
+    """
+    def __init__(self, cache_dir: Path, ttl: float = None, base_url: str = None):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.base_url = base_url
+
+    def key(self, endpoint: str, params: dict):
+        """Return hash of base URL, endpoint and parameters, leaving out credentials."""
+        params = {k: str(v) for k, v in params.items() if k not in CREDENTIAL_PARAMS}
+        request = {'endpoint': endpoint, 'params': params}
+        if self.base_url is not None:  # keys of the default API's responses stay the same
+            request['base_url'] = self.base_url
+        text = json.dumps(request, sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def path(self, endpoint: str, params: dict):
+        return self.cache_dir / endpoint.replace('/', '_') / f'{self.key(endpoint, params)}.json'
+
+    def get(self, endpoint: str, params: dict, closed: bool = True):
+        """Return cached response, None if there is none or it has expired."""
+        p = self.path(endpoint, params)
+        if not p.exists():
+            return None
+        age = time.time() - p.stat().st_mtime
+        if not closed and self.ttl is not None and age > self.ttl:
+            return None
+        with open(p) as f:
+            return json.load(f)['response']
+
+    def put(self, endpoint: str, params: dict, response):
+        p = self.path(endpoint, params)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        entry = {'endpoint': endpoint,
+                 'params': {k: v for k, v in params.items() if k not in CREDENTIAL_PARAMS},
+                 'saved': dt.datetime.now().isoformat(),
+                 'response': response}
+        p_temp = p.with_suffix('.tmp')
+        with open(p_temp, 'w') as f:
+            json.dump(entry, f)
+        p_temp.replace(p)  # readers never see a half-written response
+
+    def clear(self, endpoint: str = None):
+        """Delete cached responses for endpoint, or for all endpoints if None."""
+        pattern = '*/*.json' if endpoint is None else f"{endpoint.replace('/', '_')}/*.json"
+        for p in self.cache_dir.glob(pattern):
+            p.unlink()
+
+
+def aqs_base_url():
+    """Return base URL of the AQS API; AQS_URL in the environment points requests elsewhere, e.g. at utils.fake_api."""
+    return os.environ.get('AQS_URL', AQS_URL)
+
+
+def aqs_cache():
+    """Return the AQS response cache in the current PATHS.data.epa_cache, for the current base URL."""
+    base_url = aqs_base_url()
+    return ResponseCache(PATHS.data.epa_cache, ttl=EPA.cache_ttl,
+                         base_url=base_url if base_url != AQS_URL else None)
+
+
+def is_closed_period(params: dict):
+    """Return True if the request's end date is in a past year, so its data won't change."""
+    edate = params.get('edate')
+    if edate is None:
+        return False
+    return int(str(edate)[:4]) < dt.date.today().year
+
+
+@RateLimiter(max_calls=1, period=6)
+def _aqs_fetch(endpoint: str, params: dict):
+    """Request from the AQS API. One limiter for all endpoints keeps us under 10 requests/minute."""
+    query = {'email': EPA.user_id, 'key': EPA.read_key}
+    query.update(params)
+    response = requests.get(f'{aqs_base_url()}/{endpoint}', params=query)
+    return response.json()
+
+
+def aqs_request(endpoint: str, params: dict, refresh: bool = False):
+    """Return the JSON response of an EPA AQS API request, from the cache if possible.
+
+    Cached responses don't wait on the rate limiter. Responses for past years
+    are kept forever; others expire after EPA.cache_ttl seconds. Failed
+    responses aren't cached.
+
+    @param endpoint: AQS service path, e.g. 'sampleData/bySite'
+    @param params: request parameters other than email and key
+    @param refresh: ignore any cached response and request again
+    """
+    cache = aqs_cache()
+    if not refresh:
+        data = cache.get(endpoint, params, closed=is_closed_period(params))
+        if data is not None:
+            return data
+    data = _aqs_fetch(endpoint, params)
+    if data['Header'][0]['status'] != 'Failed':
+        cache.put(endpoint, params, data)
+    return data
@@ -3,32 +3,41 @@
 # File name: config.py
 # Authors: Aaron Watt
 # Date: 2021-11-03
-"""Module to be imported for project settings and paths."""
+"""Module to be imported for project settings and paths.
+
+Importing this module has no side effects: credentials are read the first
+time they are used (see Credential), and data directories and the log file
+are only set up when an entry point (e.g. run.py) calls
+PATHS.data.make_directories() and start_log().
+"""
 
 # Built-in Imports
+import functools
 import time
+import os
+import threading
 from pathlib import Path
-import keyring
 import logging
-import keyring.util.platform_ as keyring_platform
-import requests
+
+
+_CREDENTIAL_LOCK = threading.RLock()
 
 
 # CLASSES --------------------------
 class Paths:
     """Inner paths class to store project paths commonly used.
 
-    This will search the current working directory path for the name of the
-    repo (beecensus). Since this code is only called from main.py, and main.py
-    is inside the repo, it should be able to find the beecensus path.
-    This also means the name of the repo cannot be changed.
-    Since this is an inner class, paths will be accessible in the following way:
-    Project = ProjectSettings()  # instance of the outer class
-    Project.paths.root  # this will be the pathlib path to the github repo root
+    The root is found by find_root(), so it doesn't depend on the directory
+    the code is run from (e.g. process pool workers, Lambda, containers).
+    Pickles as just the root, so it is cheap to send to workers.
+    Paths will be accessible in the following way:
+    PATHS.root  # this will be the pathlib path to the github repo root
+    PATHS.data.tables  # data subdirectories
+    @param root: project root, default find_root()
     """
-    def __init__(self):
+    def __init__(self, root=None):
         # add root path of the project / git repo
-        self.root = Path(*Path.cwd().parts[:Path.cwd().parts.index('are219') + 1])
+        self.root = Path(root) if root is not None else find_root()
         # Top-level paths
         self.code = self.root / 'acwatt_syp_code'
         self.docs = self.root / 'docs'
@@ -37,6 +46,9 @@ class Paths:
         # Data directories
         self.data = Data(self.root / 'data')
 
+    def __reduce__(self):
+        return Paths, (self.root,)
+
 
 class Data:
     """Inner inner paths class to store data file paths."""
@@ -47,10 +59,14 @@ class Data:
         self.epa = self.root / 'epa'
         self.epa_monitors = self.epa / 'epa_monitors' / 'epa_monitors'
         self.epa_pm25 = self.epa_monitors / 'data_from_api' / '88101'
+        self.epa_cache = self.epa / 'api_cache'
+        self.epa_bulk = self.epa / 'bulk'
+        self.epa_bulk_sites = self.epa_monitors / 'data_from_bulk'
         self.gis = self.root / 'gis'
         self.gis_county = self.gis / 'cb_2018_us_county_500k' / 'cb_2018_us_county_500k.shp'
         self.gis_state = self.gis / 'cb_2018_us_state_5m' / 'cb_2018_us_state_5m.shp'
         self.gis_windspeed = self.gis / 'windspeed'
+        self.gis_cache = self.gis / 'cache'
         self.purpleair = self.root / 'purpleair'
         self.tables = self.root / 'tables'
         self.temp = self.root / 'temp'
@@ -59,8 +75,6 @@ class Data:
         self.lookup_location = self.tables / 'tbl_location_lookup.csv'
         self.lookup_fips = self.tables / 'tbl_fips_lookup.csv'
 
-        self.make_directories()
-
     def make_directories(self):
         for _, path in self.__dict__.items():
             if path.suffix == '':
@@ -78,47 +92,72 @@ class GISSettings:
         self.geographical_name = 'California'
 
 
+class Credential:
+    """Setting read the first time it is used, from an environment variable or the keyring.
+
+    If neither has it, the user is asked to paste it, and it is saved to the
+    keyring. The value is then kept on the settings instance, so later uses
+    are plain attribute lookups.
+    @param namespace: keyring service name
+    @param env: environment variable checked before the keyring
+    @param on_new: name of a settings method to call after a new value is entered
+    """
+    def __init__(self, namespace: str, env: str = None, on_new: str = None):
+        self.namespace = namespace
+        self.env = env
+        self.on_new = on_new
+
+    def __set_name__(self, owner, name):
+        self.attr = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with _CREDENTIAL_LOCK:  # threads using a setting at once are only asked for it once
+            if self.attr in instance.__dict__:
+                return instance.__dict__[self.attr]
+            value = os.environ.get(self.env) if self.env else None
+            new = False
+            if not value:
+                value, new = get_password(self.attr, self.namespace)
+            # Instance attribute shadows this (non-data) descriptor from now on
+            setattr(instance, self.attr, value)
+        if new and self.on_new:
+            getattr(instance, self.on_new)()
+        return value
+
+
 class PurpleAirSettings:
     """Class to hold settings for Purple Air API when downloading data."""
+    read_key = Credential("purpleair_api", env='PURPLEAIR_READ_KEY')
+
     def __init__(self):
         self.url = 'https://api.purpleair.com/v1/sensors'
-        namespace = "purpleair_api"
-        self.read_key = None  # placeholder to be filled in below
-
-        for attr in ["read_key"]:
-            set_password(self, attr, namespace)
 
 
 class EPASettings:
     """Class to hold settings for Purple Air API when downloading data."""
-    def __init__(self):
-
-        namespace = "epa_api"
-        self.read_key = None  # placeholder to be filled in below
-        self.user_id = None
-
-        # Check if this computer has a valid EPA API user
-        value = keyring.get_credential(namespace, "user_id").password
-        # If not, sign up a new user
-        if value is None:
-            self.signup()
+    # A new email address is signed up for the API when it is first entered
+    user_id = Credential("epa_api", env='EPA_AQS_EMAIL', on_new='signup')
+    read_key = Credential("epa_api", env='EPA_AQS_KEY')
 
-        for attr in ["read_key", "user_id"]:
-            set_password(self, attr, namespace)
+    def __init__(self):
+        # Seconds to reuse cached API responses that can still change (current year)
+        self.cache_ttl = 24 * 60 * 60
 
     def signup(self):
         """This signs up the email address to use the EPA AWI API.
 
         A verification email will be sent to the email account specified.
-        This only needs to be done once per email, so this function should
-        only run if the email is new.
-        Currently, this function runs if the email has not been setup on this
-        computer. Which means it will reset the read_key of an already signed up
+        This only needs to be done once per email, so this function only runs
+        when the email is first entered on this computer (see Credential).
+        Which means it will reset the read_key of an already signed up
         email address if that email address was used on another computer.
         So if you are running this program on one computer after using it on a
         different computer, you will probably need to delete the epa_api read_key
         and user_id so it can be reset and reverified.
         """
+        import requests
         url = f"https://aqs.epa.gov/data/api/signup?email={self.user_id}"
         requests.get(url)
         print('Wait for the new signup email to arrive (this may take several minutes\n'
@@ -128,21 +167,40 @@ class EPASettings:
 
 class AWSSettings:
     """Class to hold settings for Amazon AWS info."""
+    # Same environment variables boto3 reads
+    account_id = Credential("aws_purpleair_downloader", env='AWS_ACCOUNT_ID')
+    access_key = Credential("aws_purpleair_downloader", env='AWS_ACCESS_KEY_ID')
+    secret_key = Credential("aws_purpleair_downloader", env='AWS_SECRET_ACCESS_KEY')
+
     def __init__(self):
-        namespace = "aws_purpleair_downloader"
         self.bucket_arn = 'arn:aws:s3:::purpleair-data/*'
         self.bucket_name = 'purpleair-data'
         self.region = 'us-west-1'  # Northern CA
         self.python_version = '3.8'
-        self.account_id = None  # placeholder for autocomplete, to be filled in below
-        self.access_key = None
-        self.secret_key = None
-
-        for attr in ["account_id", "access_key", "secret_key"]:
-            set_password(self, attr, namespace)
 
 
 # FUNCTIONS --------------------------
+@functools.lru_cache(maxsize=None)
+def find_root():
+    """Return the project root, found once per process.
+
+    In order: the ARE219_ROOT environment variable, the repo this package is
+    in (if it has the data or .git directory, i.e. it isn't an installed
+    copy), then the 'are219' directory in the current working directory path.
+    """
+    env_root = os.environ.get('ARE219_ROOT')
+    if env_root:
+        return Path(env_root).expanduser().resolve()
+    package_root = Path(__file__).resolve().parents[2]
+    if (package_root / 'data').is_dir() or (package_root / '.git').exists():
+        return package_root
+    cwd_parts = Path.cwd().parts
+    if 'are219' in cwd_parts:
+        return Path(*cwd_parts[:cwd_parts.index('are219') + 1])
+    raise FileNotFoundError(f"Couldn't find the project root from {package_root} or {Path.cwd()}; "
+                            "set the ARE219_ROOT environment variable to the repo directory.")
+
+
 def start_log():
     format_ = '%(asctime)s (%(levelname)s) %(name)s: %(message)s'
     datetime_ = '%Y-%m-%d %H:%M:%S'
@@ -154,30 +212,34 @@ def start_log():
     logging.getLogger().addHandler(streamer)
 
 
-def set_password(self, attr, namespace):
+def get_password(attr, namespace):
+    """Return (value saved to keyring, False), or (value pasted by the user, True) if there isn't one."""
+    import keyring
     try:
         value = keyring.get_credential(namespace, attr).password
         if value is None:
             raise AttributeError
+        return value, False
     except AttributeError:
         value = input(f"Please paste your {namespace} {attr.replace('_', ' ')} here\n"
                       "This will be saved to your computer's encrypted keyring:")
         keyring.set_password(namespace, attr, value)
-    setattr(self, attr, value)
+        return value, True
 
 
 def delete_passwords(namespace, attr_list):
     """Helper function for deleting attributes saved to keyring."""
+    import keyring
     for attr in attr_list:
         keyring.delete_password(namespace, attr)
 
 
 # MAIN -------------------------------
 # Create instances of each class to be called from other
+# (cheap: no credentials are read, no directories or log files are made)
 PATHS = Paths()
 GIS = GISSettings()
 PA = PurpleAirSettings()
 EPA = EPASettings()
 AWS = AWSSettings()
-start_log()
 YEARS = [2015, 2016, 2017, 2018, 2019, 2020, 2021]
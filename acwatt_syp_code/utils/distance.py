@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Vectorized great-circle distances between latitude/longitude points.
+
+All functions take degrees, broadcast like numpy arrays and return meters.
+haversine() treats the earth as a sphere (error up to ~0.5%); ellipsoidal()
+adds Lambert's correction for the WGS84 flattening (error ~10 m at these
+distances). pairwise() and nearest() compute (points x points) distances in
+blocks of rows, so memory stays bounded for e.g. monitors x all sensors.
+
+Usage:
+    from ..utils.distance import haversine, nearest, MILE
+    df['dist_mile'] = haversine(lat, lon, df['latitude'], df['longitude']) / MILE
+    dist, idx = nearest(monitor_lat, monitor_lon, sensor_lat, sensor_lon, k=5)
+"""
+
+# Third-party Imports
+import numpy as np
+
+EARTH_RADIUS = 6371008.8  # meters, mean radius
+WGS84_A = 6378137.0  # meters, equatorial radius
+WGS84_F = 1 / 298.257223563  # flattening
+MILE = 1609.34  # meters
+CHUNK_SIZE = 2**22  # max distances computed at once by pairwise() and nearest()
+
+
+def _central_angle(lat1, lon1, lat2, lon2):
+    """Return central angle (radians) between points given in radians, by the haversine formula."""
+    h = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def haversine(lat1, lon1, lat2, lon2, radius: float = EARTH_RADIUS):
+    """Return great-circle distance in meters between points on a sphere."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    return radius * _central_angle(lat1, lon1, lat2, lon2)
+
+
+def ellipsoidal(lat1, lon1, lat2, lon2):
+    """Return distance in meters on the WGS84 ellipsoid, by Lambert's formula."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    # Reduced latitudes
+    b1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    b2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sigma = _central_angle(b1, lon1, b2, lon2)
+    p, q = (b1 + b2) / 2, (b2 - b1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = (sigma - np.sin(sigma)) * np.sin(p)**2 * np.cos(q)**2 / np.cos(sigma / 2)**2
+        y = (sigma + np.sin(sigma)) * np.cos(p)**2 * np.sin(q)**2 / np.sin(sigma / 2)**2
+        dist = WGS84_A * (sigma - WGS84_F / 2 * (x + y))
+    return np.where(sigma == 0, 0.0, dist)
+
+
+METHODS = {'haversine': haversine, 'ellipsoidal': ellipsoidal}
+
+
+def blocks(lat1, lon1, lat2, lon2, method: str = 'haversine', chunk_size: int = CHUNK_SIZE):
+    """Yield (first row, distance block) for blocks of rows of the (len(lat1) x len(lat2)) distance matrix."""
+    func = METHODS[method]
+    lat1, lon1 = np.atleast_1d(np.asarray(lat1, dtype=float)), np.atleast_1d(np.asarray(lon1, dtype=float))
+    lat2, lon2 = np.atleast_1d(np.asarray(lat2, dtype=float)), np.atleast_1d(np.asarray(lon2, dtype=float))
+    rows = max(1, chunk_size // max(len(lat2), 1))
+    for i in range(0, len(lat1), rows):
+        yield i, func(lat1[i:i + rows, None], lon1[i:i + rows, None], lat2[None, :], lon2[None, :])
+
+
+def pairwise(lat1, lon1, lat2, lon2, method: str = 'haversine', chunk_size: int = CHUNK_SIZE):
+    """Return (len(lat1) x len(lat2)) matrix of distances in meters.
+
+    @param method: 'haversine' or 'ellipsoidal'
+    @param chunk_size: max # of distances computed at once (bounds temporary arrays)
+    """
+    out = np.empty((np.size(lat1), np.size(lat2)))
+    for i, block in blocks(lat1, lon1, lat2, lon2, method, chunk_size):
+        out[i:i + len(block)] = block
+    return out
+
+
+def nearest(lat1, lon1, lat2, lon2, k: int, method: str = 'haversine', chunk_size: int = CHUNK_SIZE):
+    """Return (distances, indexes) of the k points 2 nearest each point 1, nearest first.
+
+    Only one block of the distance matrix is held at a time.
+    @return: two (len(lat1) x k) arrays, distances in meters and indexes into lat2/lon2
+    """
+    k = min(k, np.size(lat2))
+    dist = np.empty((np.size(lat1), k))
+    idx = np.empty((np.size(lat1), k), dtype=int)
+    for i, block in blocks(lat1, lon1, lat2, lon2, method, chunk_size):
+        part = np.argpartition(block, k - 1, axis=1)[:, :k] if k < block.shape[1] else \
+            np.tile(np.arange(block.shape[1]), (len(block), 1))
+        d = np.take_along_axis(block, part, axis=1)
+        order = np.argsort(d, axis=1, kind='stable')
+        idx[i:i + len(block)] = np.take_along_axis(part, order, axis=1)
+        dist[i:i + len(block)] = np.take_along_axis(d, order, axis=1)
+    return dist, idx
+
+
+def within(lat1, lon1, lat2, lon2, radius: float, method: str = 'haversine', chunk_size: int = CHUNK_SIZE):
+    """Return list of index arrays of the points 2 within radius meters of each point 1."""
+    result = []
+    for _, block in blocks(lat1, lon1, lat2, lon2, method, chunk_size):
+        result.extend(np.flatnonzero(row <= radius) for row in block)
+    return result
+
+
+def unit_xyz(lat, lon):
+    """Return (n x 3) array of points on the unit sphere, for KD-trees (chord length grows with distance)."""
+    lat, lon = np.radians(np.asarray(lat, dtype=float)), np.radians(np.asarray(lon, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def chord(distance, radius: float = EARTH_RADIUS):
+    """Return unit-sphere chord length of a great-circle distance in meters (inverse of arc())."""
+    return 2 * np.sin(np.minimum(np.asarray(distance, dtype=float) / radius, np.pi) / 2)
+
+
+def arc(chord_length, radius: float = EARTH_RADIUS):
+    """Return great-circle distance in meters of a unit-sphere chord length."""
+    return 2 * radius * np.arcsin(np.clip(np.asarray(chord_length, dtype=float) / 2, 0, 1))
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+"""Local stand-ins for the S3 and EPA AQS APIs, for running the pipeline offline.
+
+FakeAPIServer serves, over HTTP on localhost:
+    - the S3 object calls the pipeline makes (get, put, head, delete and list
+      objects, path-style: http://127.0.0.1:{port}/{bucket}/{key})
+    - the AQS sampleData/bySite service, from EPA hourly csv files
+with all state kept in a local directory. boto3 (>= 1.28) sends every client's
+requests to the server when AWS_ENDPOINT_URL is set, and api_cache does the
+same for AQS requests when AQS_URL is set; server.environ() returns both.
+
+LocalS3Client reads and writes the same directory in-process, for filling the
+fake bucket without going through HTTP.
+
+Usage:
+    with FakeAPIServer(root, latency=0.02) as server:
+        os.environ.update(server.environ())
+        ...  # code that uses boto3.client('s3') / aqs_request()
+"""
+
+# Built-in Imports
+import datetime as dt
+import hashlib
+import io
+import json
+import logging
+import random
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+# Third-party Imports
+import pandas as pd
+from botocore.exceptions import ClientError
+
+# Local Imports
+
+logger = logging.getLogger(__name__)
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+_PUT_LOCK = threading.Lock()
+
+
+class LocalObjectStore:
+    """S3 buckets kept in a local directory.
+
+    Objects are saved at {root}/s3/{bucket}/{key}, and their metadata at
+    {root}/s3-meta/{bucket}/{key}.json. Puts can be conditional on the
+    object's etag, like S3's If-Match / If-None-Match.
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, bucket: str, key: str, meta: bool = False):
+        if '..' in Path(key).parts or key.startswith('/'):
+            raise ValueError(f'Invalid key: {key}')
+        if meta:
+            return self.root / 's3-meta' / bucket / f'{key}.json'
+        return self.root / 's3' / bucket / key
+
+    def put(self, bucket: str, key: str, body: bytes, metadata: dict = None, content_type: str = None,
+            if_match: str = None, if_none_match: bool = False):
+        """Save object and return its etag, None if the if_match / if_none_match condition failed."""
+        with _PUT_LOCK:
+            if if_match is not None or if_none_match:
+                info = self.head(bucket, key)
+                if (if_none_match and info is not None) or (
+                        if_match is not None and (info is None or info['etag'] != if_match.strip('"'))):
+                    return None
+            p = self._path(bucket, key)
+            p.parent.mkdir(parents=True, exist_ok=True)
+            p_temp = p.with_name(p.name + '.tmp')
+            p_temp.write_bytes(body)
+            p_temp.replace(p)  # readers never see a half-written object
+            info = {'etag': hashlib.md5(body).hexdigest(),
+                    'metadata': metadata or {},
+                    'content_type': content_type or 'binary/octet-stream'}
+            p_meta = self._path(bucket, key, meta=True)
+            p_meta.parent.mkdir(parents=True, exist_ok=True)
+            p_temp = p_meta.with_name(p_meta.name + '.tmp')
+            p_temp.write_text(json.dumps(info))
+            p_temp.replace(p_meta)
+            return info['etag']
+
+    def head(self, bucket: str, key: str):
+        """Return dict of object size, etag, last_modified, metadata and content_type, None if missing."""
+        p = self._path(bucket, key)
+        if not p.is_file():
+            return None
+        p_meta = self._path(bucket, key, meta=True)
+        info = json.loads(p_meta.read_text()) if p_meta.exists() else {
+            'etag': hashlib.md5(p.read_bytes()).hexdigest(), 'metadata': {}, 'content_type': 'binary/octet-stream'}
+        info['key'] = key
+        info['size'] = p.stat().st_size
+        info['last_modified'] = dt.datetime.fromtimestamp(p.stat().st_mtime, tz=dt.timezone.utc)
+        return info
+
+    def get(self, bucket: str, key: str):
+        """Return (body, head() info), None if missing."""
+        info = self.head(bucket, key)
+        if info is None:
+            return None
+        return self._path(bucket, key).read_bytes(), info
+
+    def delete(self, bucket: str, key: str):
+        for p in [self._path(bucket, key), self._path(bucket, key, meta=True)]:
+            if p.exists():
+                p.unlink()
+
+    def list(self, bucket: str, prefix: str = ''):
+        """Return head() info of every object in bucket with key starting with prefix, sorted by key."""
+        bucket_dir = self.root / 's3' / bucket
+        keys = sorted(p.relative_to(bucket_dir).as_posix() for p in bucket_dir.rglob('*')
+                      if p.is_file() and not p.name.endswith('.tmp'))
+        return [self.head(bucket, key) for key in keys if key.startswith(prefix)]
+
+
+class _ListPaginator:
+    def __init__(self, store: LocalObjectStore):
+        self.store = store
+
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        contents = [{'Key': o['key'], 'Size': o['size'], 'ETag': f'"{o["etag"]}"',
+                     'LastModified': o['last_modified']} for o in self.store.list(Bucket, Prefix)]
+        page = {'KeyCount': len(contents), 'IsTruncated': False}
+        if contents:
+            page['Contents'] = contents
+        yield page
+
+
+class LocalS3Client:
+    """Stand-in for boto3.client('s3') that reads and writes a LocalObjectStore directly.
+
+    Supports get_object, put_object (with IfMatch / IfNoneMatch), head_object,
+    delete_object and the list_objects_v2 paginator, raising the same
+    ClientErrors as boto3.
+    """
+    def __init__(self, root: Path):
+        self.store = LocalObjectStore(root)
+
+    @staticmethod
+    def _error(code: str, operation: str, message: str):
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        obj = self.store.get(Bucket, Key)
+        if obj is None:
+            raise self._error('NoSuchKey', 'GetObject', 'The specified key does not exist.')
+        body, info = obj
+        return {'Body': io.BytesIO(body), 'ContentLength': info['size'], 'ETag': f'"{info["etag"]}"',
+                'LastModified': info['last_modified'], 'Metadata': info['metadata'],
+                'ContentType': info['content_type']}
+
+    def put_object(self, Bucket, Key, Body=b'', Metadata=None, ContentType=None,
+                   IfMatch=None, IfNoneMatch=None, **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode()
+        etag = self.store.put(Bucket, Key, Body, Metadata, ContentType,
+                              if_match=IfMatch, if_none_match=IfNoneMatch == '*')
+        if etag is None:
+            raise self._error('PreconditionFailed', 'PutObject',
+                              'At least one of the pre-conditions you specified did not hold')
+        return {'ETag': f'"{etag}"'}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        info = self.store.head(Bucket, Key)
+        if info is None:
+            raise self._error('404', 'HeadObject', 'Not Found')
+        return {'ContentLength': info['size'], 'ETag': f'"{info["etag"]}"',
+                'LastModified': info['last_modified'], 'Metadata': info['metadata'],
+                'ContentType': info['content_type']}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.store.delete(Bucket, Key)
+        return {}
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(f'LocalS3Client has no {operation_name} paginator')
+        return _ListPaginator(self.store)
+
+
+def _decode_chunks(body: bytes):
+    """Return payload of a body in (aws-)chunked encoding: {hex size}[;...]\\r\\n{data}\\r\\n ... 0\\r\\n"""
+    data, pos = bytearray(), 0
+    while True:
+        eol = body.index(b'\r\n', pos)
+        size = int(body[pos:eol].split(b';')[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[eol + 2:eol + 2 + size]
+        pos = eol + 2 + size + 2
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'FakeAPI/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def _send(self, status: int, body: bytes = b'', content_type: str = 'application/xml',
+              headers: dict = None, content_length: int = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body) if content_length is None else content_length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _s3_error(self, status: int, code: str, message: str, key: str = ''):
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{code}</Code>'
+                f'<Message>{escape(message)}</Message><Key>{escape(key)}</Key></Error>').encode()
+        self._send(status, body if self.command != 'HEAD' else b'')
+
+    def _read_body(self):
+        if 'chunked' in self.headers.get('Transfer-Encoding', ''):
+            raw = bytearray()
+            while True:
+                line = self.rfile.readline()
+                raw += line
+                size = int(line.split(b';')[0], 16)
+                raw += self.rfile.read(size + 2)
+                if size == 0:
+                    break
+            body = _decode_chunks(bytes(raw))
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            body = _decode_chunks(body)
+        return body
+
+    def _route(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        body = self._read_body() if self.command in ('PUT', 'POST') else b''
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        if url.path.startswith('/aqs/'):
+            return self._aqs(url.path[len('/aqs/'):], query)
+        if self.fake.error_rate and random.random() < self.fake.error_rate:
+            return self._s3_error(503, 'SlowDown', 'Please reduce your request rate.')
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        bucket, key = unquote(bucket), unquote(key)
+        store = self.fake.store
+        if not key:
+            if self.command == 'GET' and query.get('list-type') == '2':
+                return self._list(bucket, query.get('prefix', ''))
+            if self.command in ('PUT', 'HEAD'):  # create bucket / bucket exists
+                (store.root / 's3' / bucket).mkdir(parents=True, exist_ok=True)
+                return self._send(200)
+        elif self.command in ('GET', 'HEAD'):
+            info = store.head(bucket, key)
+            if info is None:
+                return self._s3_error(404, 'NoSuchKey', 'The specified key does not exist.', key)
+            headers = {'ETag': f'"{info["etag"]}"',
+                       'Last-Modified': formatdate(info['last_modified'].timestamp(), usegmt=True)}
+            headers.update({f'x-amz-meta-{k}': v for k, v in info['metadata'].items()})
+            content = store.get(bucket, key)[0] if self.command == 'GET' else b''
+            return self._send(200, content, info['content_type'], headers, content_length=info['size'])
+        elif self.command == 'PUT' and not query:
+            # S3 lowercases metadata names
+            metadata = {k[len('x-amz-meta-'):].lower(): v for k, v in self.headers.items()
+                        if k.lower().startswith('x-amz-meta-')}
+            etag = store.put(bucket, key, body, metadata, self.headers.get('Content-Type'),
+                             if_match=self.headers.get('If-Match'),
+                             if_none_match=self.headers.get('If-None-Match') == '*')
+            if etag is None:
+                return self._s3_error(412, 'PreconditionFailed',
+                                      'At least one of the pre-conditions you specified did not hold', key)
+            return self._send(200, headers={'ETag': f'"{etag}"'})
+        elif self.command == 'DELETE' and not query:
+            store.delete(bucket, key)
+            return self._send(204)
+        self._s3_error(501, 'NotImplemented', f'The fake API does not support {self.command} {self.path}')
+
+    def _list(self, bucket: str, prefix: str):
+        objects = self.fake.store.list(bucket, prefix)
+        contents = ''.join(
+            f'<Contents><Key>{escape(o["key"])}</Key>'
+            f'<LastModified>{o["last_modified"].strftime("%Y-%m-%dT%H:%M:%S.000Z")}</LastModified>'
+            f'<ETag>"{o["etag"]}"</ETag><Size>{o["size"]}</Size>'
+            f'<StorageClass>STANDARD</StorageClass></Contents>' for o in objects)
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult xmlns="{S3_XMLNS}">'
+                f'<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>'
+                f'<KeyCount>{len(objects)}</KeyCount><MaxKeys>1000</MaxKeys>'
+                f'<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>').encode()
+        self._send(200, body)
+
+    def _aqs(self, endpoint: str, query: dict):
+        """Answer an AQS request from {root}/aqs/county-{county}_site-{site}_hourly.csv."""
+        def respond(status: str, rows, error=None):
+            header = {'status': status, 'request_time': dt.datetime.now().isoformat(), 'rows': len(rows)}
+            if error is not None:
+                header['error'] = [error]
+            self._send(200, json.dumps({'Header': [header], 'Data': rows}).encode(), 'application/json')
+
+        if endpoint != 'sampleData/bySite':
+            return respond('Failed', [], f'The fake API has no {endpoint} service.')
+        p = self.fake.store.root / 'aqs' / f"county-{query.get('county')}_site-{query.get('site')}_hourly.csv"
+        if not p.exists():
+            return respond('No data matched your selection', [])
+        df = pd.read_csv(p, dtype={'state_code': str, 'county_code': str, 'site_number': str})
+        bdate, edate = (f'{d[:4]}-{d[4:6]}-{d[6:]}' for d in [query['bdate'], query['edate']])
+        df = df[(df['date_local'] >= bdate) & (df['date_local'] <= edate)]
+        if df.empty:
+            return respond('No data matched your selection', [])
+        respond('Success', json.loads(df.to_json(orient='records')))
+
+    do_GET = do_PUT = do_HEAD = do_DELETE = do_POST = _route
+
+
+class FakeAPIServer:
+    """HTTP server faking S3 and the AQS API, with state kept in directory root.
+
+    @param root: directory holding the buckets (see LocalObjectStore) and the
+        AQS data (aqs/county-{county}_site-{site}_hourly.csv)
+    @param port: port to listen on, 0 for any free port
+    @param latency: seconds added to every request, to mimic network round trips
+    @param error_rate: share of S3 requests answered with 503 SlowDown, to
+        exercise retries
+    """
+    def __init__(self, root: Path, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, error_rate: float = 0.0):
+        self.store = LocalObjectStore(root)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def environ(self):
+        """Return environment variables that point boto3 and aqs_request() at this server.
+
+        Includes dummy AWS keys, so AWS credentials aren't looked up in the keyring.
+        """
+        return {'AWS_ENDPOINT_URL': self.url,
+                'AQS_URL': f'{self.url}/aqs',
+                'AWS_ACCESS_KEY_ID': 'fake-access-key',
+                'AWS_SECRET_ACCESS_KEY': 'fake-secret-key'}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='fake-api', daemon=True)
+        self._thread.start()
+        logger.info(f"Fake API serving {self.store.root} at {self.url}")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
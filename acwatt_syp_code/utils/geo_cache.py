@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""Cache of the map layers (world, US states, US counties), so each is read from its shapefile once.
+
+Each layer is read in full once and saved as GeoParquet in
+PATHS.data.gis_cache, so later runs skip the shapefile too. Filtering by
+state FIPS code is done on the full layer in memory, and the filtered layers
+are kept for the process as well. A cached file is rebuilt when its shapefile
+is newer.
+
+Usage:
+    from ..utils.geo_cache import load_layer, layer_crs
+    ca_counties = load_layer('counties', statefp='06')
+    crs = layer_crs('counties')  # without loading the layer
+
+Layers returned are shared between callers: filter or copy them, don't
+change them in place.
+
+The filtered PurpleAir sensor table (see save_sensor_list) is loaded by
+load_sensor_table(), from GeoParquet (geometry stored as WKB), or from the
+csv with points rebuilt from lat/lon.
+"""
+
+# Built-in Imports
+import logging
+import threading
+from pathlib import Path
+
+# Local Imports
+from .config import PATHS
+from .lazy import lazy_import
+
+gpd = lazy_import('geopandas')
+
+logger = logging.getLogger(__name__)
+_LAYERS = {}
+_CRS = {}
+_LOCK = threading.Lock()
+
+
+def layer_path(name: str):
+    """Return path to the source file of layer name ('world', 'states' or 'counties')."""
+    if name == 'world':
+        return Path(gpd.datasets.get_path('naturalearth_lowres'))
+    paths = {'states': PATHS.data.gis_state, 'counties': PATHS.data.gis_county}
+    if name not in paths:
+        raise ValueError(f"{name} is not a layer, use one of 'world', {', '.join(map(repr, paths))}")
+    return paths[name]
+
+
+def _fips_list(statefp):
+    if statefp is None:
+        return None
+    return sorted({statefp} if isinstance(statefp, str) else set(statefp))
+
+
+def _read(name: str):
+    """Return full layer from its GeoParquet cache, making the cache from the source if needed."""
+    source = layer_path(name)
+    p = PATHS.data.gis_cache / f'{name}.parquet'
+    if p.exists() and p.stat().st_mtime >= source.stat().st_mtime:
+        try:
+            return gpd.read_parquet(p)
+        except ImportError:
+            return gpd.read_file(source)
+    gdf = gpd.read_file(source)
+    try:
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p_temp = p.with_suffix('.tmp')
+        gdf.to_parquet(p_temp)
+        p_temp.replace(p)
+        logger.info(f"Cached {name} layer to {p}")
+    except ImportError:
+        logger.info("pyarrow isn't installed, map layers are only cached in memory.")
+    return gdf
+
+
+def load_layer(name: str, statefp=None):
+    """Return GeoDataFrame of layer name, loaded once per process.
+
+    @param name: 'world', 'states' or 'counties'
+    @param statefp: state FIPS code (e.g. '06') or list of codes to keep
+        (states and counties only), None for the whole layer
+    """
+    statefp = _fips_list(statefp)
+    key = (name, None if statefp is None else tuple(statefp))
+    with _LOCK:
+        if key not in _LAYERS:
+            if (name, None) not in _LAYERS:
+                _LAYERS[(name, None)] = _read(name)
+                _CRS.setdefault(name, _LAYERS[(name, None)].crs)
+            gdf = _LAYERS[(name, None)]
+            # keeps the shapefile's row index, as before
+            _LAYERS[key] = gdf.loc[gdf['STATEFP'].isin(statefp)]
+        return _LAYERS[key]
+
+
+def layer_crs(name: str):
+    """Return CRS of layer name, from its .prj file if the layer isn't loaded yet."""
+    if name not in _CRS:
+        prj = layer_path(name).with_suffix('.prj')
+        if prj.exists():
+            from pyproj import CRS
+            _CRS[name] = CRS.from_wkt(prj.read_text())
+        else:
+            _CRS[name] = load_layer(name).crs
+    return _CRS[name]
+
+
+def sensor_table_paths():
+    """Return (csv, GeoParquet) paths of the filtered PurpleAir sensor table."""
+    return PATHS.data.temp / 'sensors_filtered.csv', PATHS.data.temp / 'sensors_filtered.parquet'
+
+
+def save_sensor_table(gdf):
+    """Save GeoDataFrame of filtered sensors as GeoParquet, if pyarrow is installed."""
+    _, p = sensor_table_paths()
+    try:
+        p_temp = p.with_suffix('.tmp')
+        gdf.to_parquet(p_temp, index=False)
+        p_temp.replace(p)
+    except ImportError:
+        logger.info("pyarrow isn't installed, the sensor table is only saved as csv.")
+
+
+def load_sensor_table(columns=None, states=None):
+    """Return GeoDataFrame of the filtered PurpleAir sensors.
+
+    Reads the GeoParquet copy if it is at least as new as the csv. Otherwise
+    the csv is read without its WKT geometry column, points are made from
+    lat/lon in one call, and the GeoParquet copy is saved for next time.
+    @param columns: columns to keep (geometry is always kept), None for all
+    @param states: state abbreviations (STUSPS) to keep, None for all
+    """
+    p_csv, p_parquet = sensor_table_paths()
+    gdf = None
+    if p_parquet.exists() and (not p_csv.exists() or p_parquet.stat().st_mtime >= p_csv.stat().st_mtime):
+        try:
+            gdf = gpd.read_parquet(p_parquet)
+        except ImportError:
+            pass
+    if gdf is None:
+        import pandas as pd
+        df = pd.read_csv(p_csv, usecols=lambda col: col != 'geometry')
+        # save_sensor_list's points were made from lon/lat in the county layer's CRS
+        gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df['lon'], df['lat']),
+                               crs=layer_crs('counties'))
+        save_sensor_table(gdf)
+    if states is not None:
+        gdf = gdf.loc[gdf['STUSPS'].isin(states)]
+    if columns is not None:
+        gdf = gdf[[col for col in columns if col != 'geometry'] + ['geometry']]
+    return gdf
+
+
+def clear():
+    """Empty the in-memory cache (the GeoParquet files are kept)."""
+    with _LOCK:
+        _LAYERS.clear()
+        _CRS.clear()
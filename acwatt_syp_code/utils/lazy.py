@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+"""Deferred imports, so heavy packages are only loaded by the code that uses them.
+
+Usage:
+    from ..utils.lazy import lazy_import
+    plt = lazy_import('matplotlib.pyplot')
+    ...
+    plt.figure()  # matplotlib is imported here, the first time plt is used
+
+A missing package raises ModuleNotFoundError on first use instead of on import,
+so e.g. design values can be computed without the plotting packages installed.
+"""
+
+# Built-in Imports
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module that imports it the first time one of its attributes is used."""
+    def __getattr__(self, attr):
+        # Only called for attributes not set on the stand-in; after the first
+        # call the import is a lookup in sys.modules
+        return getattr(importlib.import_module(self.__name__), attr)
+
+    def __repr__(self):
+        return f"<lazy module '{self.__name__}'>"
+
+
+def lazy_import(name: str):
+    """Return stand-in for module name (e.g. 'matplotlib.pyplot'), imported when first used."""
+    return LazyModule(name)
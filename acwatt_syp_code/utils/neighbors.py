@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""Nearest-neighbor search from EPA monitors to PurpleAir sensors.
+
+Sensor locations are put in a KD-tree once (scipy's cKDTree over points on
+the unit sphere, or a chunked brute-force search with utils/distance.py if
+scipy isn't installed). k-nearest and radius queries are then answered for
+all monitors in one batch, anywhere in the country, with great-circle
+distances from utils/distance.py.
+
+Usage:
+    index = NeighborIndex.from_geodataframe(df_pa, id_col='sensor_index')
+    df = index.site_table(df_monitors, radius=50 * MILE, min_count=5)
+"""
+
+# Built-in Imports
+import logging
+
+# Third-party Imports
+import numpy as np
+import pandas as pd
+
+# Local Imports
+from . import distance
+from .distance import MILE
+
+logger = logging.getLogger(__name__)
+GEOGRAPHIC_CRS = 'EPSG:4326'
+
+
+class _BruteForceTree:
+    """Minimal stand-in for cKDTree's query and query_ball_point, on great-circle distances."""
+    def __init__(self, lat, lon):
+        self.lat, self.lon = lat, lon
+
+    def query(self, lat, lon, k):
+        return distance.nearest(lat, lon, self.lat, self.lon, k)[1]
+
+    def query_ball_point(self, lat, lon, radius):
+        return distance.within(lat, lon, self.lat, self.lon, radius)
+
+
+class _SphereTree:
+    """cKDTree over unit-sphere points; chord length is monotonic in great-circle distance."""
+    def __init__(self, lat, lon):
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(distance.unit_xyz(lat, lon))
+
+    def query(self, lat, lon, k):
+        return np.asarray(self.tree.query(distance.unit_xyz(lat, lon), k=k)[1]).reshape(len(lat), k)
+
+    def query_ball_point(self, lat, lon, radius):
+        return self.tree.query_ball_point(distance.unit_xyz(lat, lon), distance.chord(radius))
+
+
+class NeighborIndex:
+    """KD-tree of point locations (e.g. PurpleAir sensors) for batch neighbor queries.
+
+    @param lat, lon: point coordinates in degrees
+    @param ids: id of each point, returned by the queries (default 0..n-1)
+    @param method: distance reported by the queries, 'haversine' or 'ellipsoidal'
+    """
+    def __init__(self, lat, lon, ids=None, method: str = 'haversine'):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.ids = np.arange(len(self.lat)) if ids is None else np.asarray(ids)
+        self.method = method
+        try:
+            self.tree = _SphereTree(self.lat, self.lon)
+        except ImportError:
+            logger.info("scipy isn't installed, using brute-force neighbor search.")
+            self.tree = _BruteForceTree(self.lat, self.lon)
+
+    @classmethod
+    def from_geodataframe(cls, gdf, id_col: str = None, **kwargs):
+        """Build from a GeoDataFrame of points (any CRS)."""
+        geometry = gdf.geometry if gdf.crs is None else gdf.geometry.to_crs(GEOGRAPHIC_CRS)
+        ids = None if id_col is None else gdf[id_col].to_numpy()
+        return cls(geometry.y.to_numpy(), geometry.x.to_numpy(), ids, **kwargs)
+
+    def _distances(self, lat, lon, idx):
+        return distance.METHODS[self.method](lat, lon, self.lat[idx], self.lon[idx])
+
+    def knn(self, lat, lon, k: int):
+        """Return (distances in meters, ids) arrays of shape (# query points, k), nearest first."""
+        k = min(k, len(self.ids))
+        lat, lon = np.atleast_1d(np.asarray(lat, dtype=float)), np.atleast_1d(np.asarray(lon, dtype=float))
+        idx = self.tree.query(lat, lon, k)
+        dist = self._distances(lat[:, None], lon[:, None], idx)
+        order = np.argsort(dist, axis=1, kind='stable')
+        return np.take_along_axis(dist, order, axis=1), self.ids[np.take_along_axis(idx, order, axis=1)]
+
+    def within(self, lat, lon, radius: float):
+        """Return list of (distances, ids) arrays of points within radius meters of each query point, nearest first."""
+        lat, lon = np.atleast_1d(np.asarray(lat, dtype=float)), np.atleast_1d(np.asarray(lon, dtype=float))
+        result = []
+        # Search a little past radius, since ellipsoidal distances can be longer than the sphere's
+        for la, lo, idx in zip(lat, lon, self.tree.query_ball_point(lat, lon, radius * 1.01)):
+            idx = np.asarray(idx, dtype=int)
+            dist = self._distances(la, lo, idx)
+            keep = dist <= radius
+            order = np.argsort(dist[keep], kind='stable')
+            result.append((dist[keep][order], self.ids[idx[keep][order]]))
+        return result
+
+    def site_table(self, df_sites, radius: float, min_count: int, id_name: str = 'sensor_index'):
+        """Return long dataframe of the points near each site, nearest first.
+
+        Each site gets the points within radius meters if there are more than
+        min_count of them, else its min_count nearest points.
+        @param df_sites: dataframe with site, county, latitude and longitude columns
+        @return: dataframe with site, county, {id_name}, dist_mile and dist_order
+            (rank of the distance at the site) columns
+        """
+        lat, lon = df_sites['latitude'].to_numpy(dtype=float), df_sites['longitude'].to_numpy(dtype=float)
+        near = self.within(lat, lon, radius)
+        few = np.array([len(ids) <= min_count for _, ids in near])
+        if few.any():
+            dist, ids = self.knn(lat[few], lon[few], min_count)
+            for i, d, n in zip(np.flatnonzero(few), dist, ids):
+                near[i] = (d, n)
+        counts = [len(ids) for _, ids in near]
+        df = pd.DataFrame({'site': np.repeat(df_sites['site'].to_numpy(), counts),
+                           'county': np.repeat(df_sites['county'].to_numpy(), counts),
+                           id_name: np.concatenate([ids for _, ids in near]) if near else [],
+                           'dist_mile': np.concatenate([d for d, _ in near]) / MILE if near else []})
+        df['dist_order'] = df.groupby(np.repeat(np.arange(len(near)), counts))['dist_mile'].rank(method='max')
+        return df
@@ -6,38 +6,37 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-import requests
 # Third-party Imports
-from ratelimiter import RateLimiter
 # Local Imports
-from ..utils.config import PATHS, EPA
+from ..utils.config import PATHS
+from ..utils.api_cache import aqs_request
+from ..utils.distance import haversine, MILE
 
 
 def plot_ca_monitors(df):
     from shapely.geometry import Point
-    import geopandas as gpd
     from geopandas import GeoDataFrame
+    from .geo_cache import load_layer
     geometry = [Point(xy) for xy in zip(df['longitude'], df['latitude'])]
     gdf = GeoDataFrame(df, geometry=geometry)
-    cali = gpd.read_file(PATHS.data.gis / 'cb_2018_us_county_500k').query("STATEFP == '06'")
+    cali = load_layer('counties', statefp='06')
     gdf.plot(ax=cali.plot(figsize=(10, 6)), marker='o', color='red', markersize=15)
     plt.show()
 
 
-def latlon_distance(x1, y1, x2, y2):
-    return ((x1-x2)**2 + (y1-y2)**2)**0.5
+def latlon_distance(lat1, lon1, lat2, lon2):
+    """Return great-circle distance in miles between points (degrees, arrays broadcast)."""
+    return haversine(lat1, lon1, lat2, lon2) / MILE
 
 
 def distance_from(center: dict, lat: np.float64, lon: np.float64):
     return latlon_distance(center['lat'], center['lon'], lat, lon)
 
 
-@RateLimiter(max_calls=1, period=6)
 def get_monitors_in_state(state: str, bdate: str, edate: str):
     param = 88101  # parameter key for NAAQS PM2.5 sensors
-    url = f"https://aqs.epa.gov/data/api/monitors/byState?email={EPA.user_id}&key={EPA.read_key}&param={param}&bdate={bdate}&edate={edate}&state={state}"
-    response = requests.get(url)
-    df = pd.DataFrame(response.json()['Data'])
+    params = {'param': param, 'bdate': bdate, 'edate': edate, 'state': state}
+    df = pd.DataFrame(aqs_request('monitors/byState', params)['Data'])
     # plot_ca_monitors(df)
     print(f"Open Date Range: {df.open_date.min()} - {df.open_date.max()}")
     print(f"Last Method Begin Date Range: {df.last_method_begin_date.min()} - {df.last_method_begin_date.max()}")
@@ -92,7 +91,7 @@ def save_pm25_locations(small_sample=False, n=50):
                     "state_code", "county_code", "city_name",
                     'open_date', 'last_method_begin_date']
     df.to_csv(p3, columns=cols_to_keep, index=False)
-    # calculate distance to point of interest (in LA)
+    # calculate distance (miles) to point of interest (in LA)
     df = df.assign(distance=distance_from(center, df.latitude, df.longitude))
     cols_to_keep.append("distance")
     # Pick top n closest points
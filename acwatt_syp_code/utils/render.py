@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+"""Render batches of figures in a process pool, skipping figures whose inputs haven't changed.
+
+Each FigureJob names a module-level plotting function, its arguments, the
+data files it reads and (optionally) the files it writes. A job's key hashes
+all of these plus the source code of the function, of any functions passed
+as arguments and of the helpers it lists; jobs whose key matches the last
+successful render, and whose outputs still exist, are skipped. Changes to
+other code the plot depends on aren't noticed, so use render(force=True)
+after those. Workers use matplotlib's Agg backend and close every figure
+after each job.
+
+Usage:
+    from ..utils.render import FigureJob, render
+    jobs = [FigureJob(plot_site_dv, kwargs={'site': s}, inputs=[p_dv], outputs=[p_fig]) for s in sites]
+    render(jobs)
+"""
+
+# Built-in Imports
+import hashlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import NamedTuple, Callable
+
+# Local Imports
+from .config import PATHS
+
+logger = logging.getLogger(__name__)
+
+
+class FigureJob(NamedTuple):
+    """Figure(s) made by calling func(*args, **kwargs) in a worker process.
+
+    @param func: module-level function (so it can be sent to a worker)
+    @param args, kwargs: arguments of func; functions among them are part of the key
+    @param inputs: paths of the data files func reads
+    @param outputs: paths of the files func writes, if known
+    @param helpers: other functions func calls to plot, whose source is part of the key
+    """
+    func: Callable
+    args: tuple = ()
+    kwargs: dict = {}
+    inputs: tuple = ()
+    outputs: tuple = ()
+    helpers: tuple = ()
+
+    @property
+    def name(self):
+        params = [_param_name(a) for a in self.args] + [f'{k}={_param_name(v)}'
+                                                        for k, v in sorted(self.kwargs.items())]
+        return f"{_param_name(self.func)}({', '.join(params)})"
+
+    @property
+    def functions(self):
+        """Return func, the functions passed as arguments and the helpers."""
+        params = list(self.args) + list(self.kwargs.values())
+        return [self.func] + [p for p in params if callable(p)] + list(self.helpers)
+
+
+def _param_name(value):
+    """Return module.name of a function (the same in every process), repr of anything else."""
+    if callable(value):
+        return f'{value.__module__}.{value.__qualname__}'
+    return repr(value)
+
+
+def file_hash(path: Path):
+    """Return sha1 of file contents, '' if the file doesn't exist."""
+    h = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+    except FileNotFoundError:
+        return ''
+    return h.hexdigest()
+
+
+def function_source(func: Callable):
+    """Return source code of func, '' if it isn't available."""
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return ''
+
+
+def job_key(job: FigureJob, hashes: dict = None):
+    """Return hash of the job's function sources, parameters and input file contents.
+
+    @param hashes: dict of path -> file hash, filled in and reused across jobs
+    """
+    hashes = {} if hashes is None else hashes
+    for p in job.inputs:
+        if str(p) not in hashes:
+            hashes[str(p)] = file_hash(p)
+    text = json.dumps({'job': job.name,
+                       'source': [function_source(f) for f in job.functions],
+                       'inputs': [hashes[str(p)] for p in job.inputs]})
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _run_job(job: FigureJob):
+    import matplotlib.pyplot as plt
+    try:
+        job.func(*job.args, **job.kwargs)
+    finally:
+        plt.close('all')
+
+
+class RenderCache:
+    """Keys of successfully rendered jobs, saved as JSON (job name -> key)."""
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        try:
+            with open(self.path) as f:
+                self.keys = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.keys = {}
+
+    def is_current(self, job: FigureJob, key: str):
+        return self.keys.get(job.name) == key and all(Path(p).exists() for p in job.outputs)
+
+    def put(self, job: FigureJob, key: str):
+        self.keys[job.name] = key
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        p_temp = self.path.with_suffix('.tmp')
+        with open(p_temp, 'w') as f:
+            json.dump(self.keys, f, indent=1, sort_keys=True)
+        p_temp.replace(self.path)
+
+
+def render(jobs, workers: int = None, force: bool = False, cache_path: Path = None):
+    """Run figure jobs in a process pool, skipping ones whose inputs haven't changed.
+
+    @param workers: # of worker processes, default # of CPUs
+    @param force: render every job, even if it is up to date
+    @param cache_path: JSON file of rendered job keys, default output/figures/render_cache.json
+    @return: dict of lists of job names: rendered, skipped and failed
+    """
+    cache = RenderCache(cache_path or PATHS.output / 'figures' / 'render_cache.json')
+    hashes = {}
+    todo, result = [], {'rendered': [], 'skipped': [], 'failed': []}
+    for job in jobs:
+        key = job_key(job, hashes)
+        if not force and cache.is_current(job, key):
+            result['skipped'].append(job.name)
+        else:
+            todo.append((job, key))
+    logger.info(f"Rendering {len(todo)} figure jobs, {len(result['skipped'])} up to date.")
+    if not todo:
+        return result
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    # Spawned workers start clean (no parent figures or GUI backend) and import only what the jobs need
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker) as pool:
+        futures = {pool.submit(_run_job, job): (job, key) for job, key in todo}
+        for future in as_completed(futures):
+            job, key = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Figure job {job.name} failed: {type(e).__name__}: {e}")
+                result['failed'].append(job.name)
+            else:
+                cache.put(job, key)
+                result['rendered'].append(job.name)
+    return result
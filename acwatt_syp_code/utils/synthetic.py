@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""Synthetic PurpleAir and EPA data in the shapes the calculate_pm pipeline uses.
+
+Used to benchmark and load test the design value pipeline without S3, API keys
+or downloads. PurpleAir sensors and the EPA monitor they are matched to share
+one ambient PM2.5 series per site, so regressions of one on the other behave
+like the real data. Every generator takes a numpy random Generator, so the
+same seed gives the same data.
+
+The data can have the problems the real data has: scattered missing hours
+and multi-day outages, wildfire smoke events flagged with AQS qualifier codes,
+and hours where a sensor's A and B channels disagree.
+See build/load_test.py for writing a whole synthetic dataset to disk and S3.
+"""
+
+# Built-in Imports
+# Third-party Imports
+import numpy as np
+import pandas as pd
+# Local Imports
+
+TZ_OFFSET = '-08:00'  # PurpleAir data is requested in local (Pacific) time
+# ThingSpeak fields of each channel, as they come out of make_wide()
+PRIMARY_FIELDS = {'a': ['PM1.0 (CF=1)', 'PM2.5 (CF=1)', 'PM10.0 (CF=1)', 'UptimeMinutes',
+                        'RSSI', 'Temperature', 'Humidity', 'PM2.5 (ATM)'],
+                  'b': ['PM1.0 (CF=1)', 'PM2.5 (CF=1)', 'PM10.0 (CF=1)', 'UptimeMinutes',
+                        'ADC', 'Pressure', 'PM2.5 (ATM)']}
+SECONDARY_FIELDS = ['0.3um', '0.5um', '1.0um', '2.5um', '5.0um', '10.0um', 'PM1.0 (ATM)', 'PM10.0 (ATM)']
+# Columns of the combined EPA-PA files (see save_combined_file())
+COMBINED_COLUMNS = ['state_code', 'county_code', 'site_number', 'year', 'quarter', 'date_local',
+                    'time_local', 'pm2.5_epa', 'pm2.5_pa', 'sample_duration', 'qualifier']
+# (# of EPA sites, # of PurpleAir sensors) to benchmark at
+SCALES = [(1, 5), (5, 50), (20, 500), (100, 5000)]
+# AQS qualifiers used in the synthetic EPA data, as in data/tables/aqs_qualifiers.csv
+QUALIFIERS = pd.DataFrame(
+    [['RT', 'Wildfire-U. S.', 'REQEXC', 'Request Exclusion'],
+     ['IT', 'Wildfire-U. S.', 'INFORM', 'Informational Only'],
+     ['AN', 'Machine Malfunction.', 'NULL', 'Null Data Qualifier'],
+     ['BA', 'Maintenance/Routine Repairs.', 'NULL', 'Null Data Qualifier'],
+     ['V', 'Validated Value.', 'QA', 'Quality Assurance Qualifier']],
+    columns=['Qualifier Code', 'Qualifier Description', 'Qualifier Type Code', 'Qualifier Type Description'])
+
+
+def hourly_times(date_start: str, periods: int):
+    """Return local hourly timestamps starting at midnight of date_start ('YYYY-MM-DD')."""
+    return pd.date_range(date_start, periods=periods, freq='h')
+
+
+def ambient_pm(times: pd.DatetimeIndex, rng: np.random.Generator):
+    """Return hourly ambient PM2.5 (ug/m^3) for one site.
+
+    Log concentration is a persistent random walk around a seasonal mean
+    (higher in winter) with a diurnal cycle peaking in the evening.
+    """
+    n = len(times)
+    persistence = 0.95 ** np.arange(min(n, 200))
+    noise = np.convolve(rng.normal(0, 0.12, n), persistence)[:n]
+    season = 0.4 * np.cos(2 * np.pi * (times.dayofyear.values - 15) / 365.25)
+    diurnal = 0.2 * np.cos(2 * np.pi * (times.hour.values - 20) / 24)
+    return np.exp(2.1 + season + diurnal + noise)
+
+
+def missing_mask(n: int, rng: np.random.Generator, share: float = 0.0,
+                 outage_share: float = 0.0, outage_hours: float = 72):
+    """Return boolean mask of missing hours: scattered hours plus multi-hour outages.
+
+    @param share: share of hours missing at random
+    @param outage_share: approximate share of hours lost to outages
+    @param outage_hours: mean length of an outage
+    """
+    mask = rng.random(n) < share
+    if outage_share > 0:
+        # Series too short for a whole outage only get one some of the time
+        expected = n * outage_share / outage_hours
+        n_outages = int(round(expected)) if expected >= 1 else int(rng.random() < expected)
+        starts = rng.integers(0, n, n_outages)
+        lengths = rng.geometric(1 / outage_hours, n_outages)
+        for start, length in zip(starts, lengths):
+            mask[start:start + length] = True
+    return mask
+
+
+def smoke_events(times: pd.DatetimeIndex, rng: np.random.Generator, share: float = 0.0,
+                 event_days: float = 4):
+    """Return hourly multiplier of ambient PM2.5 for wildfire smoke events (1 outside events).
+
+    @param share: approximate share of days with smoke, in summer and fall
+    @param event_days: mean length of an event in days
+    """
+    multiplier = np.ones(len(times))
+    if share <= 0:
+        return multiplier
+    season = np.flatnonzero(times.month.isin([7, 8, 9, 10, 11]))
+    if len(season) == 0:
+        return multiplier
+    n_events = max(1, int(round(len(times) / 24 * share / event_days)))
+    for start in rng.choice(season, n_events):
+        hours = int(rng.geometric(1 / event_days) * 24)
+        multiplier[start:start + hours] = rng.uniform(3, 10)
+    return multiplier
+
+
+def make_sites(n_sites: int, n_sensors: int, rng: np.random.Generator):
+    """Return EPA site to PurpleAir sensor lookup, sensors split evenly between sites.
+
+    Has the columns of the county-{county}_site-{site}_pa-list.csv lookups
+    used by add_pa_pm(): county, site, sensor_index and dist_mile.
+    """
+    site_number = np.arange(n_sensors) % n_sites
+    return pd.DataFrame({'county': [f'{901 + i // 10:03d}' for i in site_number],
+                         'site': [f'{i % 10 + 1:04d}' for i in site_number],
+                         'sensor_index': np.arange(1, n_sensors + 1) * 7 + 10000,
+                         'dist_mile': rng.uniform(0.2, 5, n_sensors).round(3)})
+
+
+def wide_sensor_df(sensor_id: int, times: pd.DatetimeIndex, ambient: np.ndarray,
+                   rng: np.random.Generator, missing: float = 0.0, outage_share: float = 0.0,
+                   disagree: float = 0.0):
+    """Return wide sensor data like make_wide(): one row per hour and channel.
+
+    Columns are (field, subchannel_type) pairs, with ('created_at', ''),
+    ('channel', '') and ('sensor_id', '') first. PurpleAir CF=1 readings run
+    high relative to the ambient (EPA-equivalent) concentration.
+    @param missing: share of hours missing from each channel, at random
+    @param outage_share: share of hours the whole sensor is offline, see missing_mask()
+    @param disagree: share of hours one channel reads far from the other
+        (a multiple of the true reading, or close to zero)
+    """
+    n = len(times)
+    offline = missing_mask(n, rng, outage_share=outage_share)
+    bad_hours = rng.random(n) < disagree
+    bad_channel = rng.choice(['a', 'b'], n)
+    bad_factor = np.where(rng.random(n) < 0.5, rng.uniform(2, 5, n), rng.uniform(0, 0.2, n))
+    created_at = np.asarray(times.strftime('%Y-%m-%dT%H:%M:%S')) + TZ_OFFSET
+    gain = rng.uniform(1.3, 1.9)
+    humidity = np.clip(50 - 20 * np.cos(2 * np.pi * (times.hour.values - 4) / 24)
+                       + rng.normal(0, 5, n), 5, 100).round(0)
+    temperature = (65 + 12 * np.cos(2 * np.pi * (times.hour.values - 15) / 24)
+                   + rng.normal(0, 2, n)).round(0)
+    df_list = []
+    for channel in ['a', 'b']:
+        pm25 = np.clip(ambient * gain * rng.uniform(0.95, 1.05) + rng.normal(0, 1, n), 0, None)
+        pm25 = np.where(bad_hours & (bad_channel == channel), pm25 * bad_factor, pm25)
+        primary = {'PM1.0 (CF=1)': 0.65 * pm25,
+                   'PM2.5 (CF=1)': pm25,
+                   'PM10.0 (CF=1)': 1.15 * pm25,
+                   'UptimeMinutes': 60 * np.arange(n),
+                   'RSSI': rng.normal(-65, 5, n).round(0),
+                   'Temperature': temperature,
+                   'Humidity': humidity,
+                   'ADC': np.full(n, 0.02),
+                   'Pressure': rng.normal(1013, 3, n),
+                   'PM2.5 (ATM)': np.where(pm25 < 30, pm25, 0.67 * pm25 + 10)}
+        secondary = {'0.3um': 200 * pm25, '0.5um': 60 * pm25, '1.0um': 12 * pm25,
+                     '2.5um': 1.2 * pm25, '5.0um': 0.3 * pm25, '10.0um': 0.1 * pm25,
+                     'PM1.0 (ATM)': 0.65 * pm25, 'PM10.0 (ATM)': 1.1 * pm25}
+        columns = {('created_at', ''): created_at,
+                   ('channel', ''): channel,
+                   ('sensor_id', ''): sensor_id}
+        columns.update({(field, 'primary'): primary[field].round(2) for field in PRIMARY_FIELDS[channel]})
+        columns.update({(field, 'secondary'): secondary[field].round(2) for field in SECONDARY_FIELDS})
+        keep = ~(offline | missing_mask(n, rng, share=missing))
+        df_list.append(pd.DataFrame(columns)[keep])
+    df = pd.concat(df_list, ignore_index=True)
+    index_cols = [('created_at', ''), ('channel', ''), ('sensor_id', '')]
+    df = df[index_cols + sorted(c for c in df.columns if c not in index_cols)]
+    df.columns = pd.MultiIndex.from_tuples(df.columns)
+    return df.sort_values(by=index_cols[:2]).reset_index(drop=True)
+
+
+def epa_hourly_df(county: str, site: str, times: pd.DatetimeIndex, ambient: np.ndarray,
+                  rng: np.random.Generator, missing: float = 0.05, outage_share: float = 0.0,
+                  smoke: np.ndarray = None, exclusion_requested: float = 0.8):
+    """Return hourly 88101 PM2.5 data like the AQS API's sampleData, as save_site() writes it.
+
+    Missing hours have a null sample_measurement and a NULL-type qualifier.
+    @param missing: share of hours with no sample_measurement, at random
+    @param outage_share: share of hours lost to monitor outages, see missing_mask()
+    @param smoke: boolean array of hours in wildfire smoke events
+    @param exclusion_requested: share of smoke hours flagged 'RT' (exceptional
+        event, dropped from design values); the rest are flagged 'IT'
+        (informational only)
+    """
+    n = len(times)
+    measurement = np.clip(ambient + rng.normal(0, 1.5, n), 0, None).round(1)
+    is_missing = missing_mask(n, rng, share=missing, outage_share=outage_share)
+    measurement[is_missing] = np.nan
+    qualifier = np.full(n, None, dtype=object)
+    if smoke is not None:
+        excluded = rng.random(n) < exclusion_requested
+        qualifier[smoke & excluded] = 'RT - Wildfire-U. S.'
+        qualifier[smoke & ~excluded] = 'IT - Wildfire-U. S.'
+    qualifier[is_missing] = np.where(rng.random(is_missing.sum()) < 0.7,
+                                     'AN - Machine Malfunction.', 'BA - Maintenance/Routine Repairs.')
+    times_gmt = times + pd.Timedelta(hours=8)
+    return pd.DataFrame({'state_code': '06',
+                         'county_code': county,
+                         'site_number': site,
+                         'parameter_code': '88101',
+                         'poc': 1,
+                         'latitude': 37.0,
+                         'longitude': -120.0,
+                         'datum': 'WGS84',
+                         'parameter': 'PM2.5 - Local Conditions',
+                         'date_local': times.strftime('%Y-%m-%d'),
+                         'time_local': times.strftime('%H:%M'),
+                         'date_gmt': times_gmt.strftime('%Y-%m-%d'),
+                         'time_gmt': times_gmt.strftime('%H:%M'),
+                         'sample_measurement': measurement,
+                         'units_of_measure': 'Micrograms/cubic meter (LC)',
+                         'units_of_measure_code': '105',
+                         'sample_duration': '1 HOUR',
+                         'sample_duration_code': '1',
+                         'sample_frequency': 'HOURLY',
+                         'detection_limit': 2.0,
+                         'uncertainty': np.nan,
+                         'qualifier': qualifier,
+                         'method_type': 'FEM',
+                         'method': 'Teledyne T640 at 5.0 LPM - Broadband spectroscopy',
+                         'method_code': '236',
+                         'state': 'California',
+                         'county': 'Synthetic',
+                         'date_of_last_change': '2022-01-01',
+                         'cas_number': None})
+
+
+def combined_df(county: str, site: str, rng: np.random.Generator, date_start: str = '2017-01-01',
+                years: int = 4, epa_missing: float = 0.05, pa_missing: float = 0.02):
+    """Return combined EPA-PA hourly data like load_combined() reads.
+
+    pm2.5_pa is the (corrected) weighted PurpleAir average, so it tracks the
+    EPA data with a small bias and more noise.
+    """
+    times = hourly_times(date_start, int(years * 365.25 * 24))
+    ambient = ambient_pm(times, rng)
+    df = epa_hourly_df(county, site, times, ambient, rng, missing=epa_missing)
+    n = len(df)
+    pa = np.clip(1.1 * ambient + 1 + rng.normal(0, 3, n), 0, None)
+    pa[rng.random(n) < pa_missing] = np.nan
+    df = df.rename(columns={'sample_measurement': 'pm2.5_epa'})
+    df['pm2.5_pa'] = pa
+    df['year'] = times.year.values
+    df['quarter'] = times.quarter.values
+    return df[COMBINED_COLUMNS]
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""Timed spans around pipeline stages, with JSONL / OpenMetrics export and a summary.
+
+Usage:
+    from ..utils.timing import TIMER
+    with TIMER.span('thingspeak_request', channel=channel_id):
+        response = requests.get(url)
+    TIMER.sleep(wait_time, 'backoff')
+    print(TIMER.report())
+
+This module is also shipped in the lambda deployment package, so it only uses
+the standard library and pandas.
+"""
+
+# Built-in Imports
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Third-party Imports
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """Thread-safe collection of timed spans.
+
+    Each span is a dict with the stage name, kind ('work' or 'sleep'), start
+    time (unix seconds), duration in seconds, thread name, depth (# of spans
+    it is nested in, in the same thread) and any labels.
+    """
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, name: str, seconds: float, start: float = None, kind: str = 'work', **labels):
+        span = {'name': name, 'kind': kind,
+                'start': round(time.time() - seconds if start is None else start, 3),
+                'seconds': round(seconds, 6),
+                'thread': threading.current_thread().name,
+                'depth': getattr(self._local, 'depth', 0)}
+        span.update(labels)
+        with self._lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, kind: str = 'work', **labels):
+        """Time the with block as a span; recorded even if the block raises."""
+        start, t0 = time.time(), time.perf_counter()
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            self.record(name, time.perf_counter() - t0, start=start, kind=kind, **labels)
+
+    def sleep(self, seconds: float, name: str = 'sleep', **labels):
+        """time.sleep(), recorded as a span of kind 'sleep'."""
+        with self.span(name, kind='sleep', **labels):
+            time.sleep(seconds)
+
+    def extend(self, spans, **labels):
+        """Add spans recorded elsewhere (e.g. returned by a lambda function)."""
+        with self._lock:
+            self.spans.extend(dict(span, **labels) for span in spans)
+
+    def reset(self):
+        """Remove and return all spans."""
+        with self._lock:
+            spans, self.spans = self.spans, []
+        return spans
+
+    def to_jsonl(self, path: Path, append: bool = True):
+        """Write one JSON object per span to path."""
+        with self._lock:
+            spans = list(self.spans)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a' if append else 'w') as f:
+            for span in spans:
+                f.write(json.dumps(span) + '\n')
+
+    def summary(self):
+        """Return dataframe with count, total, p50, p95 and max seconds of each stage."""
+        with self._lock:
+            df = pd.DataFrame(self.spans)
+        if df.empty:
+            return pd.DataFrame(columns=['name', 'kind', 'count', 'total', 'p50', 'p95', 'max'])
+        return (df.groupby(['name', 'kind'])['seconds']
+                .agg(count='count', total='sum',
+                     p50=lambda x: x.quantile(0.5), p95=lambda x: x.quantile(0.95), max='max')
+                .reset_index()
+                .sort_values('total', ascending=False))
+
+    def to_openmetrics(self, path: Path = None, prefix: str = 'pipeline'):
+        """Return (and write to path if given) stage summaries in OpenMetrics text format."""
+        lines = [f'# TYPE {prefix}_span_seconds summary',
+                 f'# HELP {prefix}_span_seconds Time spent in each pipeline stage.']
+        for row in self.summary().itertuples():
+            labels = f'name="{row.name}",kind="{row.kind}"'
+            lines += [f'{prefix}_span_seconds{{{labels},quantile="0.5"}} {row.p50:.6f}',
+                      f'{prefix}_span_seconds{{{labels},quantile="0.95"}} {row.p95:.6f}',
+                      f'{prefix}_span_seconds_sum{{{labels}}} {row.total:.6f}',
+                      f'{prefix}_span_seconds_count{{{labels}}} {row.count}']
+        lines.append('# EOF')
+        text = '\n'.join(lines) + '\n'
+        if path is not None:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def totals(self):
+        """Return dict of seconds sleeping and working, here and in lambda functions.
+
+        Taken from the outermost spans of each thread. Spans added from a
+        lambda function (source='lambda') already ran inside an 'invoke' span
+        here, so they are totalled separately rather than added to it. The
+        outermost spans of a thread can't overlap; if they add up to more than
+        the thread's wall time, something was counted twice and a warning is
+        logged.
+        """
+        with self._lock:
+            spans = pd.DataFrame(self.spans)
+        if spans.empty:
+            return {'sleeping': 0.0, 'working': 0.0, 'lambda_sleeping': 0.0, 'lambda_working': 0.0}
+        if 'source' not in spans:
+            spans['source'] = None
+        remote = spans['source'] == 'lambda'
+        totals = {}
+        for prefix, df in [('', spans[~remote]), ('lambda_', spans[remote])]:
+            outer = df[df['depth'].fillna(0) == 0]
+            timed = outer['seconds'].sum()
+            sleeping = df.loc[df['kind'] == 'sleep', 'seconds'].sum()
+            totals[f'{prefix}sleeping'] = sleeping
+            totals[f'{prefix}working'] = max(timed - sleeping, 0.0)
+            if prefix == '' and not outer.empty:
+                ends = outer['start'] + outer['seconds']
+                wall = (ends.groupby(outer['thread']).max() - outer.groupby('thread')['start'].min()).sum()
+                # start is rounded to the millisecond
+                if timed > wall + 0.001 * len(outer) + 0.01:
+                    logger.warning(f'Timed spans add up to {timed:.1f} s, more than the '
+                                   f'{wall:.1f} s of wall time in their threads')
+        return totals
+
+    def report(self):
+        """Return text table of stage latencies and time spent sleeping versus working.
+
+        Spans nest (e.g. requests inside a sensor's download), so totals of
+        different stages can add up to more than the wall time. Sleeping versus
+        working is taken from totals(), so nothing is counted twice.
+        """
+        df = self.summary()
+        if df.empty:
+            return 'No spans recorded.'
+        totals = self.totals()
+        text = (df.to_string(index=False, float_format='{:.3f}'.format)
+                + f"\n\nSleeping: {totals['sleeping']:.1f} s   Working: {totals['working']:.1f} s")
+        if totals['lambda_sleeping'] or totals['lambda_working']:
+            text += (f"\nIn lambda functions: Sleeping: {totals['lambda_sleeping']:.1f} s   "
+                     f"Working: {totals['lambda_working']:.1f} s")
+        return text
+
+
+TIMER = Timer()
@@ -8,13 +8,15 @@ import logging
 import pandas
 # Third-party Imports
 # Local Imports
-import acwatt_syp_code.analyze.maps as am
-from acwatt_syp_code.build import (purpleair_download,
-                                   epa_download,
-                                   calculate_pm)
-from acwatt_syp_code.utils.parse_epa import save_pm25_locations
-from acwatt_syp_code.utils.config import PATHS
-from acwatt_syp_code.build.aws import lambda_services
+from acwatt_syp_code.utils.config import PATHS, start_log
+from acwatt_syp_code.utils.lazy import lazy_import
+# Each module is only imported (with its dependencies) if a step below uses it
+am = lazy_import('acwatt_syp_code.analyze.maps')
+purpleair_download = lazy_import('acwatt_syp_code.build.purpleair_download')
+epa_download = lazy_import('acwatt_syp_code.build.epa_download')
+calculate_pm = lazy_import('acwatt_syp_code.build.calculate_pm')
+parse_epa = lazy_import('acwatt_syp_code.utils.parse_epa')
+lambda_services = lazy_import('acwatt_syp_code.build.aws.lambda_services')
 
 logger = logging.getLogger(__name__)
 
@@ -27,9 +29,11 @@ pandas.set_option('display.max_columns', 250)
 
 
 if __name__ == "__main__":
+    PATHS.data.make_directories()
+    start_log()
     logger.info('START')
     small_sample = True
-    # epa_monitorlist_path = save_pm25_locations(small_sample)
+    # epa_monitorlist_path = parse_epa.save_pm25_locations(small_sample)
     # epa_download.download_15_test_sites()
     # purpleair_download.dl_us_sensors()
     # purpleair_download.test_lambda()